@@ -17,10 +17,14 @@ Kevin Driscoll, 2012, 2013
 
 """
 
-from tweetutils import extract_tweet_id, 
-                        extract_user_id, 
-                        from_postedTime, 
-                        tweet_matches_rules
+from tweetutils import (die,
+                        extract_tweet_id,
+                        extract_user_id,
+                        from_postedTime,
+                        tweet_matches_rules,
+                        PowerTrackRules,
+                        RawPrefilter,
+                        RuleMatcher)
 import argparse
 import json
 import os
@@ -61,6 +65,12 @@ if __name__=="__main__":
                         type=str, 
                         default='', 
                         help='Path to file with Gnip rules, one per line')
+    parser.add_argument('--powertrack',
+                        action='store_true',
+                        help='Read --rules as PowerTrack rules and refuse any that do not parse')
+    parser.add_argument('--prefilter',
+                        action='store_true',
+                        help='Skip lines that cannot match before decoding the JSON')
     parser.add_argument('db', 
                         metavar='DB', 
                         type=str, 
@@ -87,6 +97,16 @@ if __name__=="__main__":
             sys.exit()
         else:
             print "Found {0} rules.".format(len(rules))
+            # Compile once so matching doesn't scale with rule count
+            # Gnip tweets are matched on their matching_rules, so
+            # PowerTrack rules here are checked for typos up front
+            if args.powertrack:
+                try:
+                    rules = PowerTrackRules(rules)
+                except ValueError as e:
+                    die(u'Could not parse rules: {0}'.format(e))
+            else:
+                rules = RuleMatcher(rules)
 
     print 'Inserting tweets from stdin into:'
     print '\tHost       :\t{0}'.format(args.host)
@@ -98,6 +118,11 @@ if __name__=="__main__":
     # connect to db
     db = init(args.host, args.port, args.db)
 
+    # Most lines get thrown out, so check the raw bytes first
+    prefilter = None
+    if args.prefilter:
+        prefilter = RawPrefilter(rules, keys=('gnip',))
+
     # read tweets in from stdin
     inserts  = 0
     failures = 0
@@ -108,6 +133,17 @@ if __name__=="__main__":
     # keep reading until there are no lines left
     line = next_line()
     while line:
+        if prefilter:
+            if not prefilter.has_keys(line):
+                notgnip += 1
+                if notgnip % 500 == 0:
+                    print '{0}\t{1}\t{2}\t{3}'.format(inserts, valueerror, notgnip, last_tweet)
+                line = next_line()
+                continue
+            if not prefilter.may_match(line):
+                line = next_line()
+                continue
+
         # try to make a json obj out of it
         try:
             tweet = json.loads(line)
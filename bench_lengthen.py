@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark URL lengthening against a local redirect farm
+
+Starts an HTTP server on 127.0.0.1 that plays a crowd of
+shorteners: each URL is a chain of redirects with a random
+number of hops, a random delay per hop, and a final answer
+drawn from a mix of 200s, 404s, 500s, timeouts and garbage
+status lines. Then drives the lengtheners against it and
+reports URLs/sec, p50/p99 latency per URL and peak RSS.
+
+Each target runs in its own process so RSS is its own.
+Nothing leaves the box.
+
+    python bench_lengthen.py --urls 2000 --hops 1-4 --latency 20
+
+Kevin Driscoll, 2013
+
+"""
+
+from lengthen_url_tweetid import *
+import BaseHTTPServer
+import SocketServer
+import lengthen_url_tweetid
+import math
+import multiprocessing
+import random
+import resource
+import tweetutils
+
+# Targets that can be benchmarked
+BENCH_TARGETS = ['lengthen', 'lengthen_url', 'lengthen_each', 'lengthen_each_async']
+
+# Default mix of final answers, in percent
+BENCH_MIX = 'ok=90,404=4,500=2,timeout=2,badstatus=2'
+
+#
+# Redirect farm
+#
+
+class FarmHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers /c/<token>/<hops>/<outcome>
+
+        Redirects to /c/<token>/<hops - 1>/<outcome> on the next
+        host of the farm until hops reaches 0, then gives the
+        outcome: ok, 404, 500, timeout (no answer until after the
+        client gives up) or badstatus.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code, headers=()):
+        body = 'x' * 64
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        farm = self.server.farm
+        farm.count()
+        parts = self.path.split('/')
+        if len(parts) != 5 or parts[1] != 'c':
+            self._send(404)
+            return
+        _, _, token, hops, outcome = parts
+        delay = farm.delay()
+        if delay:
+            sleep(delay)
+        hops = int(hops)
+        if hops > 0:
+            location = '/c/{0}/{1}/{2}'.format(token, hops - 1, outcome)
+            base = farm.host_for(int(token), hops - 1)
+            if base != self.server.base:
+                location = base + location
+            self._send(random.choice((301, 302)), [('Location', location)])
+        elif outcome == 'ok':
+            self._send(200)
+        elif outcome == 'timeout':
+            sleep(farm.timeout + 0.5)
+            self.close_connection = 1
+        elif outcome == 'badstatus':
+            self.wfile.write('HTTP/1.1 OK SURE\r\n\r\n')
+            self.close_connection = 1
+        else:
+            self._send(int(outcome))
+
+class FarmServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP/1.1 server for one host of a RedirectFarm
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, farm, address):
+        BaseHTTPServer.HTTPServer.__init__(self, (address, 0), FarmHandler)
+        self.farm = farm
+        self.base = 'http://{0}:{1}'.format(address, self.server_address[1])
+
+    def handle_error(self, request, client_address):
+        # Clients hang up on timeouts and bad status lines
+        pass
+
+class RedirectFarm(object):
+    """A set of FarmServers on 127.0.0.1, 127.0.0.2, ...
+        so the per-host scheduling sees several hosts
+
+        latency : median seconds before each answer
+        sigma : spread of the lognormal delay, 0 for a fixed delay
+        timeout : client timeout that 'timeout' answers outlast
+    """
+    def __init__(self, hosts=1, latency=0.0, sigma=0.0, timeout=HTTP_TIMEOUT):
+        self.latency = latency
+        self.sigma = sigma
+        self.timeout = timeout
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.servers = [FarmServer(self, '127.0.0.{0}'.format(i + 1))
+                        for i in range(hosts)]
+        self.bases = [server.base for server in self.servers]
+        self.hosts = [server.server_address[0] for server in self.servers]
+
+    def count(self):
+        with self.lock:
+            self.requests += 1
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+
+    def host_for(self, token, hops):
+        """Base URL of the host serving a URL with hops left to go
+        """
+        return self.bases[(token + hops) % len(self.bases)]
+
+    def delay(self):
+        if self.latency <= 0:
+            return 0
+        if self.sigma <= 0:
+            return self.latency
+        return random.lognormvariate(math.log(self.latency), self.sigma)
+
+    def start(self):
+        for server in self.servers:
+            t = threading.Thread(target=server.serve_forever)
+            t.daemon = True
+            t.start()
+
+def parse_mix(mix):
+    """Return [(outcome, cumulative weight)] from 'ok=90,404=5,...'
+    """
+    cumulative = []
+    total = 0.0
+    for part in mix.split(','):
+        outcome, weight = part.split('=')
+        outcome = outcome.strip()
+        if outcome not in ('ok', 'timeout', 'badstatus'):
+            int(outcome)
+        total += float(weight)
+        cumulative.append((outcome, total))
+    return [(outcome, weight / total) for outcome, weight in cumulative]
+
+def farm_urls(farm, count, min_hops, max_hops, mix, seed=0):
+    """Return count distinct farm URLs with random chains and outcomes
+    """
+    rng = random.Random(seed)
+    mix = parse_mix(mix)
+    urls = []
+    for i in range(count):
+        draw = rng.random()
+        outcome = mix[-1][0]
+        for name, weight in mix:
+            if draw < weight:
+                outcome = name
+                break
+        hops = rng.randint(min_hops, max_hops)
+        urls.append('{0}/c/{1}/{2}/{3}'.format(farm.host_for(i, hops), i, hops, outcome))
+    return urls
+
+#
+# Drivers
+#   Each returns (elapsed seconds, [seconds per URL])
+#
+
+def drive_pool(function, urls, threads):
+    """Call function on every URL from a pool of threads
+    """
+    pending = Queue.Queue()
+    for url in urls:
+        pending.put(url)
+    latencies = []
+    lock = threading.Lock()
+    def worker():
+        while True:
+            try:
+                url = pending.get_nowait()
+            except Queue.Empty:
+                return
+            started = time()
+            function(url)
+            took = time() - started
+            with lock:
+                latencies.append(took)
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return time() - started, latencies
+
+def drive_each(manager, urls, **options):
+    """Feed urls to lengthen_each or lengthen_each_async as tweets
+        Latency runs from when a URL is read to when it is output
+    """
+    read_at = {}
+    latencies = []
+    lock = threading.Lock()
+    def tweets():
+        for i, url in enumerate(urls):
+            read_at[i] = time()
+            yield {'_id': i, 'twitter_entities': {'urls': [{'url': url}]}}
+    def output_function(url_id, short_long):
+        took = time() - read_at[url_id]
+        with lock:
+            latencies.append(took)
+    started = time()
+    manager(tweets(), output_function, **options)
+    return time() - started, latencies
+
+def run_target(target, urls, hosts, args, results):
+    """Benchmark one target in this process and put its row on results
+    """
+    # Quiet the chatter from the lengtheners
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+
+    tweetutils.LENGTHEN_TIMEOUT = args.timeout
+    lengthen_url_tweetid.HTTP_TIMEOUT = args.timeout
+
+    classifier = ShortenerClassifier(hosts)
+    scheduler = HostScheduler(rate=args.host_rate, burst=args.host_rate,
+                              max_concurrency=max(args.threads, HOST_MAX_CONCURRENCY))
+    if target == 'lengthen':
+        elapsed, latencies = drive_pool(
+            lambda url: lengthen(url, classifier=classifier), urls, args.threads)
+    elif target == 'lengthen_url':
+        elapsed, latencies = drive_pool(
+            lambda url: lengthen_url(url, classifier=classifier), urls, args.threads)
+    elif target == 'lengthen_each':
+        lengthen_url_tweetid.THREAD_MAX = args.threads
+        elapsed, latencies = drive_each(lengthen_each, urls,
+                                        classifier=classifier,
+                                        scheduler=scheduler)
+    else:
+        elapsed, latencies = drive_each(lengthen_each_async, urls,
+                                        classifier=classifier,
+                                        scheduler=scheduler,
+                                        timeout=args.timeout)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((target, len(latencies), elapsed, sorted(latencies), peak_rss))
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return float('nan')
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark URL lengthening against a local redirect farm')
+    parser.add_argument('--urls',
+                        type=int,
+                        default=1000,
+                        help='Distinct URLs per target')
+    parser.add_argument('--hosts',
+                        type=int,
+                        default=8,
+                        help='Hosts in the farm (127.0.0.1 up); chains hop between them')
+    parser.add_argument('--hops',
+                        default='1-3',
+                        help='Redirects per URL, as N or MIN-MAX')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=10,
+                        help='Median delay per hop in milliseconds')
+    parser.add_argument('--sigma',
+                        type=float,
+                        default=0.5,
+                        help='Spread of the lognormal delay, 0 for fixed')
+    parser.add_argument('--mix',
+                        default=BENCH_MIX,
+                        help='Percent of each final answer (ok, 404, 500, timeout, badstatus)')
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=2,
+                        help='Client timeout in seconds')
+    parser.add_argument('--threads',
+                        type=int,
+                        default=THREAD_MAX,
+                        help='Threads for lengthen, lengthen_url and lengthen_each')
+    parser.add_argument('--host-rate',
+                        type=float,
+                        default=1000000,
+                        help='Scheduler requests per second for the farm host')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0)
+    parser.add_argument('targets',
+                        nargs='*',
+                        default=BENCH_TARGETS,
+                        help='Any of ' + ', '.join(BENCH_TARGETS))
+    args = parser.parse_args()
+
+    for target in args.targets:
+        if target not in BENCH_TARGETS:
+            die(u'Unknown target: {0}'.format(target))
+    if '-' in args.hops:
+        min_hops, max_hops = [int(n) for n in args.hops.split('-', 1)]
+    else:
+        min_hops = max_hops = int(args.hops)
+
+    farm = RedirectFarm(args.hosts, args.latency / 1000.0, args.sigma, args.timeout)
+    farm.start()
+
+    print u'{0:<20} {1:>6} {2:>8} {3:>9} {4:>8} {5:>8} {6:>9} {7:>9}'.format(
+        'target', 'urls', 'seconds', 'urls/sec', 'p50 ms', 'p99 ms', 'requests', 'peak MB')
+    for target in args.targets:
+        urls = farm_urls(farm, args.urls, min_hops, max_hops, args.mix, args.seed)
+        farm.reset()
+        results = multiprocessing.Queue()
+        p = multiprocessing.Process(target=run_target,
+                                    args=(target, urls, farm.hosts, args, results))
+        p.start()
+        while True:
+            try:
+                name, done, elapsed, latencies, peak_rss = results.get(timeout=1)
+                break
+            except Queue.Empty:
+                if not p.is_alive():
+                    die(u'{0} died, run it alone to see why'.format(target))
+        p.join()
+        print u'{0:<20} {1:>6} {2:>8.2f} {3:>9.1f} {4:>8.1f} {5:>8.1f} {6:>9} {7:>9.1f}'.format(
+            name, done, elapsed, done / elapsed if elapsed else 0,
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+            farm.requests, peak_rss / 1024.0)
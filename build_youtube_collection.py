@@ -16,6 +16,12 @@ if __name__=="__main__":
 
     database = ""
     input_collection = ""
+    # Raw Gnip file to read instead of input_collection, if any
+    # Each period is read through the file's time index
+    input_path = ""
+    # Fields read from each tweet in input_path, the rest is skipped
+    input_fields = ['id', 'postedTime', 'body', 'twitter_entities',
+                    'actor.id', 'actor.preferredUsername']
     output_collection = ""
 
     observation_periods = [
@@ -30,12 +36,27 @@ if __name__=="__main__":
     # Init LongURL API wrapper
     expander = longurl.LongURL()
 
+    # Resolutions from earlier runs
+    cache = tweetutils.URLCache(tweetutils.URL_CACHE_PATH)
+
+    # Only links on shortener hosts go to the expander
+    classifier = tweetutils.ShortenerClassifier()
+
     # Init connection to Mongo database instance
     mongo = pymongo.Connection()
     db = mongo[database]
-    collection = db[input_collection]
-    print "Indexing", input_collection, "on postedTimeObj"
-    collection.ensure_index('postedTimeObj')
+    if input_path:
+        # Like ensure_index, only scan the file if it has no
+        # index or has changed since it was indexed
+        try:
+            tweetutils.TweetTimeIndex(input_path)
+        except (IOError, ValueError):
+            print "Indexing", input_path, "by posting time"
+            tweetutils.build_tweet_time_index(input_path)
+    else:
+        collection = db[input_collection]
+        print "Indexing", input_collection, "on postedTimeObj"
+        collection.ensure_index('postedTimeObj')
     print "Dropping", output_collection 
     db.drop_collection(output_collection)
     
@@ -54,7 +75,12 @@ if __name__=="__main__":
                         'postedTimeObj': True,
                         'actor.id_str': True,
                         'actor.preferredUsername': True}
-        cursor = collection.find(query, projection, timeout=False)
+        if input_path:
+            cursor = tweetutils.with_mongo_ids(
+                tweetutils.itertweets_between(input_path, start, end,
+                                              fields=input_fields))
+        else:
+            cursor = collection.find(query, projection, timeout=False)
         
         tweet_ids = []
         for tweet in cursor:
@@ -66,14 +92,20 @@ if __name__=="__main__":
                     progressf.write('\n')
                 tweet_ids = []
                 progressf.flush()
-            for u in tweet['twitter_entities']['urls']:
-                if u['expanded_url']:
-                    shorturl = u['expanded_url']
-                else:
-                    shorturl = u['url']
-                youtube_id = tweetutils.parse_youtube_id(shorturl)
+            for shorturl in tweetutils.tweet_urls(tweet):
+                kind, youtube_id = classifier.classify_youtube(shorturl)
+                cached = None
+                if kind == tweetutils.URL_SHORT:
+                    cached = cache.get(shorturl)
                 if youtube_id:
                     c['expanded'] += 1
+                elif kind == tweetutils.URL_LONG:
+                    c['long'] += 1
+                elif cached is not None:
+                    c['cached'] += 1
+                    youtube_id = tweetutils.parse_youtube_id(cached.longurl or '')
+                    if youtube_id:
+                        c['longurl'] += 1
                 else:
                     try:
                         qurl = expander.expandable(shorturl)
@@ -94,6 +126,10 @@ if __name__=="__main__":
                             # It's okay to lose a few
                             c['exceptions'] += 1
                             lengthened = ''
+                        if lengthened:
+                            cache.put(shorturl, lengthened, [shorturl, lengthened], 200)
+                        else:
+                            cache.put(shorturl, lengthened, [shorturl], 'error')
                         youtube_id = tweetutils.parse_youtube_id(lengthened)
                         if youtube_id:
                             c['longurl'] += 1
@@ -101,12 +137,13 @@ if __name__=="__main__":
                     tweet['youtube_id'] = youtube_id
                     # TODO DEBUG
                     # print youtube_id, tweet['actor']['preferredUsername'], tweet['body']
-                    db[output_collection].insert(tweet)
+                    db[output_collection].insert(dict(tweet))
                     c['insert'] += 1
                     if not c['insert'] % 100:
                         print c['insert'], "out of", c['tweet'], tweet['body']
 
     progressf.close()
+    cache.close()
     print c
                 
 
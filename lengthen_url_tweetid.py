@@ -18,14 +18,23 @@ Kevin Driscoll, 2012, 2013
 """
 
 from tweetutils import *
+from time import sleep
+import argparse
+import asyncore
 import codecs
+import cPickle
 import csv 
+import errno
+import heapq
 import httplib
 import longurl
 import json
+import pymongo
 import Queue
 import requests
+import ssl
 import sys 
+import tempfile
 import threading
 import urllib
 import urllib2
@@ -96,38 +105,61 @@ def force_utf8(s):
 #
 
 class Longurl():
-    def __init__(self):
+    def __init__(self, cache=None, classifier=None):
         self._session = requests.Session()
         self._session.headers['User-Agent'] = USER_AGENT
-        self.known_services = []
-        self.update_known_services() 
-        self.cache = {}
-
-    def update_known_services(self):
+        # Known services come from the bundled list;
+        # call update_known_services to refresh it from the API
+        if classifier is None:
+            classifier = default_classifier()
+        self.classifier = classifier
+        # Share a URLCache to keep results between runs
+        if cache is None:
+            cache = URLCache(':memory:')
+        self.cache = cache
+
+    def update_known_services(self, path=None):
+        """Add longurl.org's list of services to the classifier
+            Also rewrites the list at path if given
+        """
         endpoint = u'http://api.longurl.org/v2/services'
         r = self._session.get(endpoint,
                              params={'format': 'json'})
         if r.ok:
             known_services = r.json()
-            self.known_services = known_services.keys()
+            self.classifier.update(known_services.keys())
+            if path:
+                save_shorteners(self.classifier.hosts, path)
 
     def lengthen(self, shorturl):
         # This lookup could take a very long time
-        if shorturl in self.cache:
-            return self.cache[shorturl]
-        domain = urlparse.urlsplit(shorturl).netloc
-        if domain in self.known_services:
+        entry = self.cache.get(shorturl)
+        if entry is not None:
+            return entry.longurl
+        if self.classifier.is_shortener(shorturl):
             longurl = self._expand(shorturl)
+            if not longurl:
+                self.cache.put(shorturl, None, [shorturl], 'APIError')
+                return None
+            redirects = longurl.get('all-redirects', [])
             if 'rel-canonical' in longurl:
-                lengthend = longurl['rel-canonical']
+                lengthened = longurl['rel-canonical']
+            elif redirects:
+                lengthened = redirects[-1]
             else:
-                lengthened = longurl['all-redirects'][-1]
+                lengthened = longurl.get('long-url')
 
             # Add URLs to cache
-            self.cache[shorturl] = longurl 
-            self.cache[lengthened] = lengthened
-            for i in range(len(longurl['all-redirects'])-1):
-                self.cache[longurl['all-redirects'][i]] = lengthened
+            status = longurl.get('response-code')
+            try:
+                status = int(status)
+            except (TypeError, ValueError):
+                pass
+            hops = [shorturl] + [u for u in redirects if u != shorturl]
+            self.cache.put(shorturl, lengthened, hops, status)
+            for i in range(1, len(hops)):
+                self.cache.put(hops[i], lengthened, hops[i:], status)
+            return lengthened
         else:
             return 
 
@@ -155,13 +187,43 @@ class Longurl():
 # Old lengthening function
 #
 
-def lengthen_url(u):
+def short_long_from_chain(hops):
+    """Return short_long dict pairing each URL in hops
+    with the next (None marks the end of the chain)
+    """
+    short_long = {}
+    for i in range(len(hops) - 1):
+        short_long[hops[i]] = hops[i + 1]
+    return short_long
+
+def lengthen_url(u, cache=None, memo=None, scheduler=None, classifier=None):
     """Return short_long dict of all URLs
-    between u and its ultimate location"""
+    between u and its ultimate location
+    cache : optional URLCache checked before any request
+    memo : optional RedirectMemo; the walk stops at the first
+           URL whose remaining hops are already known
+    scheduler : optional HostScheduler asked before each request;
+                raises HostDeferred if a host won't take it soon
+                and HostDown if the host is taken for down
+    classifier : ShortenerClassifier, bundled list if None;
+                 the walk stops at the first URL that isn't short"""
     
     # For description of error handling, see:
     # http://www.voidspace.org.uk/python/articles/urllib2.shtml#httperror
 
+    if classifier is None:
+        classifier = default_classifier()
+    if not classifier.is_shortener(u):
+        # Already long, nothing to ask the network
+        return {u: None}
+
+    # The cache and memo look URLs up by canonicalizer.key(),
+    # but u and every Location are requested as they are
+    if cache is not None:
+        entry = cache.get(u)
+        if entry is not None:
+            return short_long_from_chain([u] + entry.hops[1:] + [None])
+
     # Create URL opener that doesn't auto follow redirs
     opener = urllib2.build_opener(LazyHTTPRedirectHandler)
 
@@ -171,12 +233,44 @@ def lengthen_url(u):
     # Set nexturl to the first URL
     nexturl = u
 
+    # HTTP code or error name of the last request
+    status = None
+
     # Follow all redirects, adding URLs to hops 
     while nexturl and (len(hops) < HTTP_MAX_REDIRECTS):
+        if len(hops) > 1 and not classifier.is_shortener(nexturl):
+            # Landed somewhere that isn't a shortener
+            hops.append(None)
+            break
+        if memo is not None:
+            known = memo.chain(nexturl)
+            if known is not None:
+                # Someone already walked the rest of this chain
+                rest, status = known
+                hops.extend(rest[1:])
+                del hops[HTTP_MAX_REDIRECTS:]
+                break
+        if scheduler is not None:
+            host = request_host(nexturl)
+            while True:
+                wait = scheduler.acquire(host)
+                if not wait:
+                    break
+                if len(hops) == 1 or wait > HOST_MAX_SLEEP:
+                    # Nothing to lose by trying again later
+                    raise HostDeferred(host, wait)
+                sleep(wait)
+            if wait is None:
+                # Its circuit is open and it has failed every probe:
+                # that says nothing about the URL, so record nothing
+                raise HostDown(host)
+            started = time()
         request = urllib2.Request(nexturl)
+        status = None
         try:
             r = opener.open(request, timeout=HTTP_TIMEOUT)
         except urllib2.HTTPError as err:
+            status = err.code
             if err.code in HTTP_REDIRECT_CODES:
                 if u'location' in err.headers.keys():
                     loc = err.headers[u'location']
@@ -191,38 +285,854 @@ def lengthen_url(u):
                 nexturl = None
         except urllib2.URLError as err:
             # Server not found, etc.
+            status = 'URLError'
             nexturl = None
         except ValueError:
             # Most likely an invalid URL
+            status = 'ValueError'
             nexturl = None
         except urllib2.httplib.BadStatusLine as err:
             # The server sent an unfamiliar status code 
             # Not caught by urllib2, see:
             # http://bugs.python.org/issue8823
             print err
+            status = 'BadStatusLine'
             nexturl = None
         except urllib2.httplib.InvalidURL as err:
             # Usually happens when there is a colon
             # but no port number
             print err
+            status = 'InvalidURL'
+            nexturl = None
+        except urllib2.httplib.IncompleteRead:
+            # The connection closed partway through the answer
+            status = 'IncompleteRead'
+            nexturl = None
+        except socket.timeout:
+            status = 'timeout'
+            nexturl = None
+        except ssl.SSLError:
+            # Usually an HTTPS read timing out
+            status = 'SSLError'
+            nexturl = None
+        except socket.error:
+            # Connection reset, refused, etc.
+            status = 'URLError'
             nexturl = None
         else:
             # Ultimate destination reached
+            status = r.getcode()
             nexturl = None
+        finally:
+            # Give the host its slot back, whatever happened
+            if scheduler is not None:
+                scheduler.release(host, status, time() - started)
 
         # Append the result to the hops list
         # None represents the end of the chain 
         hops.append(nexturl)
 
     # Construct dict from hops chain
-    short_long = {}
-    for i in range(len(hops) - 1):
-        short_long[hops[i]] = hops[i + 1]
+    short_long = short_long_from_chain(hops)
+
+    if memo is not None:
+        memo.record(hops, status)
+    if cache is not None:
+        chain = hops[:-1] if hops[-1] is None else hops
+        cache.put(u, chain[-1], chain, status)
     
     # Return short_long dict
     return short_long
 
 
+#
+# Sharing work between lookups
+#
+
+# Most hops a RedirectMemo remembers
+MEMO_SIZE = 1000000
+# Chains that ended in a failure (timeout, open circuit, 404...)
+# are forgotten after this many seconds, like URLCache's
+MEMO_NEGATIVE_TTL = URL_CACHE_NEGATIVE_TTL
+
+class RedirectMemo(object):
+    """Remembers every hop of the redirect chains walked so far
+        and makes concurrent lookups of one URL share a single walk
+
+        A viral link is fetched once however many tweets carry it,
+        and chains that share a tail (t.co -> bit.ly -> site) stop
+        at the first hop already seen. Safe to share between threads.
+        URLs are matched by canonicalizer.key(), so spellings of
+        one URL share their hops. The last hop of a chain that
+        failed is only trusted for negative_ttl seconds.
+    """
+    def __init__(self, size=MEMO_SIZE, canonicalizer=None,
+                       negative_ttl=MEMO_NEGATIVE_TTL):
+        if canonicalizer is None:
+            canonicalizer = default_canonicalizer()
+        self.canonicalizer = canonicalizer
+        self.negative_ttl = negative_ttl
+        self._hops = LRUCache(size)
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.walks = 0
+        self.shared = 0
+
+    def chain(self, url):
+        """Return (hops, status) for the known chain from url
+            hops ends with None like lengthen_url's chain
+            Returns None if any hop is unknown
+        """
+        key = self.canonicalizer.key
+        now = time()
+        with self._lock:
+            hops = []
+            status = None
+            while url is not None and len(hops) < HTTP_MAX_REDIRECTS:
+                known = self._hops.get(key(url))
+                if known is None:
+                    return None
+                nexturl, status, expires = known
+                if expires is not None and expires < now:
+                    # Failed a while ago, worth another try
+                    return None
+                hops.append(url)
+                url = nexturl
+            if url is not None:
+                # Redirect loop or longer than we'd follow
+                return None
+            hops.append(None)
+            return hops, status
+
+    def record(self, hops, status):
+        """Remember each hop of a chain
+            status belongs to the last request in the chain
+        """
+        keys = [self.canonicalizer.key(url) for url in hops[:-1]]
+        now = time()
+        expires = None
+        if is_failure(status):
+            expires = now + self.negative_ttl
+        with self._lock:
+            for i, key in enumerate(keys):
+                nexturl = hops[i + 1]
+                if nexturl is None:
+                    known = self._hops.get(key)
+                    if expires is not None and known is not None and known[2] > now:
+                        # Already known to fail: walks through it
+                        # mustn't put off its retry
+                        continue
+                    self._hops.set(key, (None, status, expires))
+                else:
+                    self._hops.set(key, (nexturl, None, None))
+
+    def lengthen(self, u, cache=None, scheduler=None, classifier=None):
+        """Return short_long for u like lengthen_url
+            If another thread is already walking u, wait for it
+        """
+        key = self.canonicalizer.key(u)
+        while True:
+            with self._lock:
+                event = self._inflight.get(key)
+                if event is None:
+                    event = self._inflight[key] = threading.Event()
+                    owner = True
+                else:
+                    owner = False
+            if owner:
+                break
+            event.wait()
+            known = self.chain(u)
+            if known is not None:
+                self.shared += 1
+                return short_long_from_chain(known[0])
+            # Forgotten already, walk it ourselves
+        try:
+            self.walks += 1
+            return lengthen_url(u, cache, self, scheduler, classifier)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
+
+#
+# Scheduling requests per host
+#   Rate limit, adaptive concurrency and circuit breaker
+#
+
+# Requests per second to any one host, with bursts up to HOST_BURST
+HOST_RATE = 10.0
+HOST_BURST = 20
+# Hosts that need their own rate
+HOST_RATES = {}
+# Requests in flight per host start at HOST_START_CONCURRENCY and
+# grow by one per fast answer until the first trouble, then by one
+# per round of fast answers, halving on trouble
+HOST_START_CONCURRENCY = 4
+HOST_MAX_CONCURRENCY = 32
+# Halve at most once per this many seconds, so failures that
+# arrive together count once
+HOST_BACKOFF_INTERVAL = 1.0
+# Answers slower than this (in seconds) count as trouble
+HOST_SLOW_LATENCY = 5.0
+# Failures in a row that open a host's circuit,
+# and seconds before one request may probe it again
+HOST_MAX_FAILURES = 5
+HOST_COOLDOWN = 30
+# Failed probes after which a host is taken for down: while its
+# circuit is open its URLs are set aside for a later run
+HOST_MAX_PROBES = 2
+# Seconds to wait for a slot when a host is at its concurrency limit
+HOST_BUSY_WAIT = 0.25
+# Longest a walk will sleep mid-chain before giving up its slot
+HOST_MAX_SLEEP = 1.0
+
+# Statuses that say nothing about the host itself
+HOST_NEUTRAL_STATUSES = (None, 'ValueError', 'InvalidURL',
+                         'LookupError', 'UnicodeDecodeError', 'UnicodeEncodeError')
+
+class HostDeferred(Exception):
+    """A host won't take a request for wait seconds
+    """
+    def __init__(self, host, wait):
+        Exception.__init__(self, host, wait)
+        self.host = host
+        self.wait = wait
+
+class HostDown(Exception):
+    """A host has failed every probe of its circuit
+        Its URLs are set aside unfinished (not cached, memoized,
+        output or journaled) so a later run tries them again
+    """
+    def __init__(self, host):
+        Exception.__init__(self, host)
+        self.host = host
+
+def request_host(url):
+    """Return the lowercase host name of url, u'' if there isn't one
+    """
+    try:
+        return urlsplit(url).hostname or u''
+    except ValueError:
+        return u''
+
+class HostState(object):
+    """Token bucket, concurrency limit, circuit and stats for one host
+    """
+    __slots__ = ('rate', 'tokens', 'updated', 'limit', 'threshold', 'backed_off',
+                 'active', 'failures', 'opened', 'probes', 'requests', 'errors',
+                 'throttled', 'deferred', 'dropped', 'trips', 'latency')
+
+    def __init__(self, rate, burst, limit, threshold, now):
+        self.rate = rate
+        self.tokens = float(burst)
+        self.updated = now
+        self.limit = float(limit)
+        # Below threshold the limit grows quickly
+        self.threshold = float(threshold)
+        self.backed_off = 0
+        self.active = 0
+        self.failures = 0
+        self.opened = None
+        self.probes = 0
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.deferred = 0
+        self.dropped = 0
+        self.trips = 0
+        self.latency = 0.0
+
+class HostScheduler(object):
+    """Decides when each host may take another request
+
+        Each host gets a token bucket (its request rate), a limit
+        on requests in flight that grows additively while answers
+        come back fast and halves on errors, throttling or slow
+        answers, and a circuit breaker: after max_failures failures
+        in a row its requests are deferred for cooldown seconds,
+        then a single request probes whether it has recovered.
+        A host that fails max_probes probes in a row is taken for
+        down, and requests to it are set aside between probes.
+
+        Requests a host won't take are deferred rather than waited
+        for, so one slow host doesn't hold up the others. Deferred
+        work is kept here until it is due. Safe to share between
+        threads.
+    """
+    def __init__(self, rate=HOST_RATE,
+                       burst=HOST_BURST,
+                       rates=None,
+                       start_concurrency=HOST_START_CONCURRENCY,
+                       max_concurrency=HOST_MAX_CONCURRENCY,
+                       slow_latency=HOST_SLOW_LATENCY,
+                       max_failures=HOST_MAX_FAILURES,
+                       cooldown=HOST_COOLDOWN,
+                       max_probes=HOST_MAX_PROBES):
+        self.rate = rate
+        self.burst = burst
+        self.rates = dict(HOST_RATES)
+        if rates:
+            self.rates.update(rates)
+        self.start_concurrency = start_concurrency
+        self.max_concurrency = max_concurrency
+        self.slow_latency = slow_latency
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.max_probes = max_probes
+        self.hosts = {}
+        self._lock = threading.Lock()
+        self._deferred = []
+        self._seq = 0
+
+    def _host(self, host, now):
+        state = self.hosts.get(host)
+        if state is None:
+            rate = self.rates.get(host, self.rate)
+            state = self.hosts[host] = HostState(rate, self.burst,
+                                                 self.start_concurrency,
+                                                 self.max_concurrency, now)
+        return state
+
+    def acquire(self, host, now=None):
+        """Ask to send one request to host
+            Returns 0 if it may go now (call release when it's done),
+            None if the host is down and the request should be set aside,
+            otherwise the seconds to wait before asking again
+        """
+        if now is None:
+            now = time()
+        with self._lock:
+            h = self._host(host, now)
+            if h.opened is not None:
+                wait = h.opened + self.cooldown - now
+                if wait <= 0 and h.active:
+                    # Someone is already probing
+                    wait = HOST_BUSY_WAIT
+                if wait > 0:
+                    if h.probes >= self.max_probes:
+                        h.dropped += 1
+                        return None
+                    h.deferred += 1
+                    return wait
+            if h.active >= int(h.limit):
+                h.deferred += 1
+                return HOST_BUSY_WAIT
+            h.tokens = min(float(self.burst), h.tokens + (now - h.updated) * h.rate)
+            h.updated = now
+            if h.tokens < 1:
+                h.deferred += 1
+                return (1 - h.tokens) / h.rate
+            h.tokens -= 1
+            h.active += 1
+            h.requests += 1
+            return 0
+
+    def release(self, host, status, latency, now=None):
+        """A request to host finished with status after latency seconds
+        """
+        if now is None:
+            now = time()
+        with self._lock:
+            h = self._host(host, now)
+            h.active = max(0, h.active - 1)
+            if status in HOST_NEUTRAL_STATUSES:
+                return
+            h.latency += latency
+            if status == 429:
+                h.throttled += 1
+            if isinstance(status, int) and status < 500 and status != 429:
+                h.failures = 0
+                h.opened = None
+                h.probes = 0
+                if latency < self.slow_latency:
+                    if h.limit < h.threshold:
+                        h.limit += 1
+                    else:
+                        h.limit += 1 / h.limit
+                    h.limit = min(float(self.max_concurrency), h.limit)
+                else:
+                    self._back_off(h, now)
+                return
+            h.errors += 1
+            h.failures += 1
+            self._back_off(h, now)
+            if h.opened is not None or h.failures >= self.max_failures:
+                # Trip, or stay tripped after a failed probe
+                if h.opened is None:
+                    h.trips += 1
+                else:
+                    h.probes += 1
+                h.opened = now
+                h.limit = 1.0
+
+    def _back_off(self, h, now):
+        if now - h.backed_off >= HOST_BACKOFF_INTERVAL:
+            h.limit = max(1.0, h.limit / 2)
+            h.threshold = h.limit
+            h.backed_off = now
+
+    def defer(self, item, wait):
+        """Hold on to item until wait seconds from now
+        """
+        with self._lock:
+            self._seq += 1
+            heapq.heappush(self._deferred, (time() + wait, self._seq, item))
+
+    def next_due(self, now=None):
+        """Return a deferred item that is due, or None
+        """
+        if now is None:
+            now = time()
+        with self._lock:
+            if self._deferred and self._deferred[0][0] <= now:
+                return heapq.heappop(self._deferred)[2]
+            return None
+
+    def due_in(self, now=None):
+        """Return seconds until the next deferred item is due
+            or None if nothing is deferred
+        """
+        if now is None:
+            now = time()
+        with self._lock:
+            if not self._deferred:
+                return None
+            return max(0, self._deferred[0][0] - now)
+
+    def stats(self):
+        """Return {host: dict of counters and current settings}
+        """
+        now = time()
+        with self._lock:
+            stats = {}
+            for host, h in self.hosts.items():
+                if h.opened is None:
+                    circuit = 'closed'
+                elif h.opened + self.cooldown > now:
+                    circuit = 'open'
+                else:
+                    circuit = 'half-open'
+                answered = h.requests - h.active
+                stats[host] = {
+                    'requests': h.requests,
+                    'errors': h.errors,
+                    'throttled': h.throttled,
+                    'deferred': h.deferred,
+                    'dropped': h.dropped,
+                    'trips': h.trips,
+                    'active': h.active,
+                    'concurrency': h.limit,
+                    'rate': h.rate,
+                    'circuit': circuit,
+                    'mean_latency': h.latency / answered if answered else None
+                }
+            return stats
+
+    def report(self, top=20, fp=sys.stdout):
+        """Print stats for the busiest hosts
+        """
+        stats = self.stats()
+        busiest = sorted(stats, key=lambda host: stats[host]['requests'], reverse=True)
+        fp.write(u'{0:<32} {1:>8} {2:>6} {3:>6} {4:>8} {5:>7} {6:>5} {7:>7} {8:>9}\n'.format(
+                 'host', 'requests', 'errors', '429s', 'deferred', 'dropped',
+                 'conc', 'latency', 'circuit'))
+        for host in busiest[:top]:
+            h = stats[host]
+            latency = '-' if h['mean_latency'] is None else '{0:.2f}'.format(h['mean_latency'])
+            fp.write(u'{0:<32} {1:>8} {2:>6} {3:>6} {4:>8} {5:>7} {6:>5.1f} {7:>7} {8:>9}\n'.format(
+                     host[:32], h['requests'], h['errors'], h['throttled'],
+                     h['deferred'], h['dropped'], h['concurrency'], latency,
+                     h['circuit']))
+
+
+#
+# Checkpointing
+#   So a crashed run picks up where it left off
+#
+
+# Default journal of finished URLs
+JOURNAL_PATH = 'lengthen_journal.txt'
+# fsync after this many records or this many seconds, whichever comes first
+JOURNAL_SYNC_EVERY = 1000
+JOURNAL_SYNC_INTERVAL = 5.0
+
+def journal_line(url_id, shorturl):
+    """Return the journal line (without newline) for an item
+    """
+    line = u'{0}\t{1}'.format(to_unicode(unicode(url_id)), to_unicode(shorturl))
+    return line.replace(u'\n', u' ').replace(u'\r', u' ')
+
+class CheckpointJournal(object):
+    """Append-only record of (url_id, shorturl) items whose
+        results have been written, one tab-separated line each
+
+        Writes are fsynced in batches, so a crash loses at most
+        the last batch, and those items are simply done again.
+        With resume, items already in the journal are skipped by
+        pending() as the input streams past; otherwise the journal
+        starts empty. Safe to share between threads.
+    """
+    def __init__(self, path=JOURNAL_PATH,
+                       resume=False,
+                       sync_every=JOURNAL_SYNC_EVERY,
+                       sync_interval=JOURNAL_SYNC_INTERVAL):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.done = set()
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._last_sync = time()
+        if resume and os.path.exists(path):
+            self._load()
+            self._fp = open(path, 'ab')
+        else:
+            self._fp = open(path, 'wb')
+
+    def _load(self):
+        good = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    # Torn write from a crash
+                    break
+                good += len(line)
+                self.done.add(line[:-1].decode('utf-8'))
+        if good < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(good)
+
+    def __len__(self):
+        return len(self.done)
+
+    def pending(self, items):
+        """Yield the (url_id, shorturl) items not yet journaled
+        """
+        done = self.done
+        for url_id, shorturl in items:
+            if done and journal_line(url_id, shorturl) in done:
+                self.skipped += 1
+                continue
+            yield url_id, shorturl
+
+    def record(self, url_id, shorturl):
+        """Note that the result for an item has been written
+        """
+        line = journal_line(url_id, shorturl)
+        with self._lock:
+            self._fp.write(line.encode('utf-8'))
+            self._fp.write('\n')
+            self._unsynced += 1
+            if (self._unsynced >= self.sync_every or
+                    time() - self._last_sync > self.sync_interval):
+                self._sync()
+
+    def _sync(self):
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self._unsynced = 0
+        self._last_sync = time()
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            if not self._fp.closed:
+                self._sync()
+                self._fp.close()
+
+
+#
+# Sharing work between processes
+#   Workers lease batches of URLs from a shared queue; a lease
+#   that runs out before its batch is finished is handed out again
+#
+
+# Default sqlite work queue
+WORK_QUEUE_PATH = 'lengthen_queue.db'
+# URLs per lease
+WORK_BATCH_SIZE = 500
+# Seconds a lease lasts unless renewed
+WORK_LEASE_SECONDS = 600
+# Seconds between reports of finished URLs (and lease renewals)
+WORK_FLUSH_INTERVAL = 5.0
+# Seconds to wait when the rest of the queue is leased to others
+WORK_POLL_INTERVAL = 5.0
+# Leases after which a URL is given up on, so one that
+# keeps killing its worker doesn't go round forever
+WORK_MAX_ATTEMPTS = 5
+
+# States of a URL in a work queue
+WORK_PENDING = 0
+WORK_LEASED = 1
+WORK_DONE = 2
+WORK_FAILED = 3
+
+def default_worker():
+    """Name for this process in a work queue: host:pid
+    """
+    return u'{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+class WorkQueue(object):
+    """Queue of (url_id, shorturl) items shared by many workers
+
+        A worker leases a batch, lengthens it, reports each item
+        complete once its result is written and renews its lease
+        while it works. Items whose lease expires go back out to
+        the next worker that asks. Items are unique, so filling
+        the queue twice does no harm.
+
+        SQLiteWorkQueue and MongoWorkQueue provide
+            add(items) : add (url_id, shorturl) items,
+                         return how many were new
+            lease(worker, count, duration) : lease up to count
+                         pending or expired items to worker,
+                         return a list of (url_id, shorturl)
+            renew(worker, duration) : extend worker's leases
+            complete(worker, items) : mark items done if worker
+                         still holds their lease
+            release(worker) : hand back what worker still holds
+            counts() : return {state: number of items}
+    """
+    def unfinished(self):
+        """Number of items pending or leased
+        """
+        counts = self.counts()
+        return counts.get(WORK_PENDING, 0) + counts.get(WORK_LEASED, 0)
+
+    def close(self):
+        pass
+
+class SQLiteWorkQueue(WorkQueue):
+    """WorkQueue in a sqlite file
+
+        For workers on one machine: sqlite locking can't be
+        trusted on network filesystems, use MongoWorkQueue
+        to spread across machines. Safe to share between threads.
+    """
+    def __init__(self, path=WORK_QUEUE_PATH, max_attempts=WORK_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # Autocommit; leases take the write lock with BEGIN IMMEDIATE
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # url_id has no type so ints come back as ints
+        self._db.execute('CREATE TABLE IF NOT EXISTS tasks ('
+                         'id INTEGER PRIMARY KEY, '
+                         'url_id, '
+                         'shorturl TEXT, '
+                         'state INTEGER, '
+                         'worker TEXT, '
+                         'expires REAL, '
+                         'attempts INTEGER, '
+                         'UNIQUE (url_id, shorturl))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS tasks_state '
+                         'ON tasks (state, expires)')
+
+    def _write(self, sql, params, many=False):
+        """Run one statement in a write transaction, return rows changed
+            With many, params is a sequence of parameter tuples
+        """
+        with self._lock:
+            before = self._db.total_changes
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                if many:
+                    self._db.executemany(sql, params)
+                else:
+                    self._db.execute(sql, params)
+                self._db.execute('COMMIT')
+            except:
+                self._db.execute('ROLLBACK')
+                raise
+            return self._db.total_changes - before
+
+    def add(self, items):
+        return self._write('INSERT OR IGNORE INTO tasks '
+                           '(url_id, shorturl, state, attempts) VALUES (?, ?, ?, 0)',
+                           ((url_id, to_unicode(shorturl), WORK_PENDING)
+                            for url_id, shorturl in items), many=True)
+
+    def lease(self, worker, count=WORK_BATCH_SIZE, duration=WORK_LEASE_SECONDS):
+        now = time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute('UPDATE tasks SET state = ? '
+                                 'WHERE state = ? AND expires < ? AND attempts >= ?',
+                                 (WORK_FAILED, WORK_LEASED, now, self.max_attempts))
+                rows = self._db.execute('SELECT id, url_id, shorturl FROM tasks '
+                                        'WHERE state = ? OR (state = ? AND expires < ?) '
+                                        'LIMIT ?',
+                                        (WORK_PENDING, WORK_LEASED, now, count)).fetchall()
+                self._db.executemany('UPDATE tasks SET state = ?, worker = ?, expires = ?, '
+                                     'attempts = attempts + 1 WHERE id = ?',
+                                     [(WORK_LEASED, worker, now + duration, row[0])
+                                      for row in rows])
+                self._db.execute('COMMIT')
+            except:
+                self._db.execute('ROLLBACK')
+                raise
+        return [(url_id, shorturl) for _, url_id, shorturl in rows]
+
+    def renew(self, worker, duration=WORK_LEASE_SECONDS):
+        self._write('UPDATE tasks SET expires = ? WHERE state = ? AND worker = ?',
+                    (time() + duration, WORK_LEASED, worker))
+
+    def complete(self, worker, items):
+        # An item whose lease ran out and went to another worker is
+        # left to that worker, which will write its result again
+        self._write('UPDATE tasks SET state = ? '
+                    'WHERE url_id = ? AND shorturl = ? AND state = ? AND worker = ?',
+                    [(WORK_DONE, url_id, to_unicode(shorturl), WORK_LEASED, worker)
+                     for url_id, shorturl in items], many=True)
+
+    def release(self, worker):
+        self._write('UPDATE tasks SET state = ?, worker = NULL, '
+                    'attempts = attempts - 1 WHERE state = ? AND worker = ?',
+                    (WORK_PENDING, WORK_LEASED, worker))
+
+    def counts(self):
+        with self._lock:
+            return dict(self._db.execute('SELECT state, COUNT(*) FROM tasks '
+                                         'GROUP BY state').fetchall())
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class MongoWorkQueue(WorkQueue):
+    """WorkQueue in a MongoDB collection, for workers on many machines
+
+        Each lease is a find_and_modify per item, so no two
+        workers can take the same item.
+    """
+    def __init__(self, collection, max_attempts=WORK_MAX_ATTEMPTS):
+        self.collection = collection
+        self.max_attempts = max_attempts
+        collection.ensure_index([('url_id', pymongo.ASCENDING),
+                                 ('shorturl', pymongo.ASCENDING)], unique=True)
+        collection.ensure_index([('state', pymongo.ASCENDING),
+                                 ('expires', pymongo.ASCENDING)])
+        collection.ensure_index('worker')
+
+    def add(self, items):
+        added = 0
+        for url_id, shorturl in items:
+            try:
+                self.collection.insert({'url_id': url_id,
+                                        'shorturl': to_unicode(shorturl),
+                                        'state': WORK_PENDING,
+                                        'attempts': 0})
+                added += 1
+            except pymongo.errors.DuplicateKeyError:
+                pass
+        return added
+
+    def lease(self, worker, count=WORK_BATCH_SIZE, duration=WORK_LEASE_SECONDS):
+        now = time()
+        self.collection.update({'state': WORK_LEASED,
+                                'expires': {'$lt': now},
+                                'attempts': {'$gte': self.max_attempts}},
+                               {'$set': {'state': WORK_FAILED}},
+                               multi=True)
+        leased = []
+        while len(leased) < count:
+            doc = self.collection.find_and_modify(
+                query={'$or': [{'state': WORK_PENDING},
+                               {'state': WORK_LEASED, 'expires': {'$lt': now}}]},
+                update={'$set': {'state': WORK_LEASED,
+                                 'worker': worker,
+                                 'expires': now + duration},
+                        '$inc': {'attempts': 1}},
+                new=True)
+            if doc is None:
+                break
+            leased.append((doc['url_id'], doc['shorturl']))
+        return leased
+
+    def renew(self, worker, duration=WORK_LEASE_SECONDS):
+        self.collection.update({'state': WORK_LEASED, 'worker': worker},
+                               {'$set': {'expires': time() + duration}},
+                               multi=True)
+
+    def complete(self, worker, items):
+        for url_id, shorturl in items:
+            self.collection.update({'url_id': url_id,
+                                    'shorturl': to_unicode(shorturl),
+                                    'state': WORK_LEASED,
+                                    'worker': worker},
+                                   {'$set': {'state': WORK_DONE}})
+
+    def release(self, worker):
+        self.collection.update({'state': WORK_LEASED, 'worker': worker},
+                               {'$set': {'state': WORK_PENDING, 'worker': None},
+                                '$inc': {'attempts': -1}},
+                               multi=True)
+
+    def counts(self):
+        return dict((state, self.collection.find({'state': state}).count())
+                    for state in (WORK_PENDING, WORK_LEASED, WORK_DONE, WORK_FAILED))
+
+class LeaseJournal(object):
+    """Stands in for a CheckpointJournal while a worker lengthens
+        a leased batch: finished items are reported to the queue
+        every flush_interval seconds, and the worker's leases are
+        renewed well before they run out.
+    """
+    def __init__(self, queue, worker, duration=WORK_LEASE_SECONDS,
+                       flush_interval=WORK_FLUSH_INTERVAL):
+        self.queue = queue
+        self.worker = worker
+        self.duration = duration
+        self.flush_interval = flush_interval
+        self.completed = 0
+        self._finished = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._renewed = time()
+        self._thread = threading.Thread(target=self._keep)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def pending(self, items):
+        # The queue only leases unfinished items
+        return items
+
+    def record(self, url_id, shorturl):
+        with self._lock:
+            self._finished.append((url_id, shorturl))
+
+    def flush(self):
+        with self._lock:
+            finished, self._finished = self._finished, []
+        if finished:
+            self.queue.complete(self.worker, finished)
+            self.completed += len(finished)
+
+    def _keep(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+                if time() - self._renewed > self.duration / 3.0:
+                    self.queue.renew(self.worker, self.duration)
+                    self._renewed = time()
+            except Exception as e:
+                error_log(u'Work queue: {0!r}'.format(e))
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+
 #
 # Old file i/o functions
 #
@@ -271,7 +1181,7 @@ def unicode_csv_reader(utf8_fp, **kwargs):
 # Old thread worker functions
 #
 
-def lengthen_url_worker(url_queue, pairs_queue):
+def lengthen_url_worker(url_queue, pairs_queue, cache=None):
     """Lengthen URLs from url_queue
         Put output into pairs_queue
     """
@@ -282,7 +1192,7 @@ def lengthen_url_worker(url_queue, pairs_queue):
         except Queue.Empty: 
             print u'url_queue empty. Nothing left to lengthen. Returning to my cave.'
             break
-        short_long = lengthen_url(url)
+        short_long = lengthen_url(url, cache)
         # print url,
         # print len(short_long)
         pairs_queue.put(short_long)
@@ -310,7 +1220,7 @@ def short_long_writer_worker(short_long_queue, short_long_fp):
         write_short_long(pair, short_long_fp)
         short_long_queue.task_done()
 
-def lengthen_urls_parallel(url_tweetid_fp, short_long_fp):
+def lengthen_urls_parallel(url_tweetid_fp, short_long_fp, cache=None):
     """Lengthen URLs from url_tweetid_fp
         in parallel using threads
         Write pairs to short_long_fp
@@ -322,7 +1232,7 @@ def lengthen_urls_parallel(url_tweetid_fp, short_long_fp):
     threads = []
     threads.append(threading.Thread(target=row_reader_worker, args=(url_tweetid_fp, unread_urls)))
     for _ in range(THREAD_MAX):
-        threads.append(threading.Thread(target=lengthen_url_worker, args=(unread_urls, short_long_pairs)))
+        threads.append(threading.Thread(target=lengthen_url_worker, args=(unread_urls, short_long_pairs, cache)))
     threads.append(threading.Thread(target=short_long_writer_worker, args=(short_long_pairs, short_long_fp)))
     for t in threads:
         t.start()
@@ -342,96 +1252,1088 @@ def lengthen_urls_parallel(url_tweetid_fp, short_long_fp):
 #
 
 
-def shorturl_prep_worker(itertweets, shorturlq):
+# Bytes of pending URLs held in memory before the rest spill to disk
+SPILL_MEMORY_CAP = 64 * 1024 * 1024
+# Put on a queue after the last item
+END_OF_STREAM = None
+
+class SpillQueue(object):
+    """FIFO queue of pending (url_id, shorturl) items that never
+        blocks its producer and never holds more than about
+        memory_cap bytes of items in memory
+
+        Once the cap is reached, new items are pickled to a
+        temporary file in spill_dir and read back in batches as
+        consumers catch up. After close(), get() returns
+        END_OF_STREAM to every consumer once the queue is empty.
+    """
+    def __init__(self, memory_cap=SPILL_MEMORY_CAP, spill_dir=None):
+        self.memory_cap = memory_cap
+        self.spill_dir = spill_dir
+        self.spilled = 0
+        self._items = deque()
+        self._bytes = 0
+        self._closed = False
+        self._spill = None
+        self._read_pos = 0
+        self._unread = 0
+        self._cond = threading.Condition()
+
+    def _size(self, item):
+        return sys.getsizeof(item) + sum(sys.getsizeof(x) for x in item)
+
+    def put(self, item):
+        size = self._size(item)
+        with self._cond:
+            if not self._unread and self._bytes + size <= self.memory_cap:
+                self._items.append((item, size))
+                self._bytes += size
+            else:
+                # Spill, and keep spilling until the file is read back
+                if self._spill is None:
+                    self._spill = tempfile.TemporaryFile(dir=self.spill_dir)
+                self._spill.seek(0, os.SEEK_END)
+                cPickle.dump(item, self._spill, 2)
+                self._unread += 1
+                self.spilled += 1
+            self._cond.notify()
+
+    def _refill(self):
+        """Read spilled items back until half the cap is in memory
+        """
+        self._spill.flush()
+        self._spill.seek(self._read_pos)
+        while self._unread and self._bytes < self.memory_cap / 2:
+            item = cPickle.load(self._spill)
+            size = self._size(item)
+            self._items.append((item, size))
+            self._bytes += size
+            self._unread -= 1
+        self._read_pos = self._spill.tell()
+        if not self._unread:
+            self._spill.seek(0)
+            self._spill.truncate()
+            self._read_pos = 0
+
+    def get(self, block=True, timeout=None):
+        """Return the next item, or END_OF_STREAM after close()
+            Raises Queue.Empty if nothing arrives within timeout
+        """
+        with self._cond:
+            if timeout is not None:
+                deadline = time() + timeout
+            while not self._items:
+                if self._unread:
+                    self._refill()
+                    break
+                if self._closed:
+                    return END_OF_STREAM
+                if not block:
+                    raise Queue.Empty
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        raise Queue.Empty
+                    self._cond.wait(remaining)
+            item, size = self._items.popleft()
+            self._bytes -= size
+            return item
+
+    def close(self):
+        """No more items will be put
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._items) + self._unread
+
+def shorturl_prep_worker(iterurls, shorturlq, journal=None):
     """Take each tuple from the iterurls iterator.
         Add it to the shorturlq queue.
         Repeat.
+        Items already in the journal are skipped.
+        Closes the queue when done, even if the source fails.
     """
-    for tweet in itertweets:
-        tweet_id = tweet.get('_id')
-        for u in tweet['twitter_entities']['urls']:
-            if 'expanded_url' in u:
-                shorturlq.put((tweet_id, u['expanded_url']))
-
-            shorturlq.put((
-
-    for (url_id, shorturl) in iterurls:
-        shorturlq.put((url_id, shorturl))
+    try:
+        items = iterurls
+        if journal is not None:
+            items = journal.pending(items)
+        for (url_id, shorturl) in items:
+            shorturlq.put((url_id, shorturl))
+    finally:
+        shorturlq.close()
     print u'Done reading URLs from source.'
 
-def shorturl_lengthener_worker(short_queue, long_queue):
+def shorturl_lengthener_worker(short_queue, long_queue, cache=None, memo=None, scheduler=None,
+                               classifier=None):
     """Lengthen URLs from shorturl_queue
         Put output into longurl_queue 
+        URLs the scheduler defers are picked up again when due
+        Puts END_OF_STREAM on longurl_queue when there's nothing left
     """
     print "zug zug!",
-    while True:
-        try:
-            (url_id, shorturl) = short_queue.get(block=True, timeout=THREAD_TIMEOUT)
-        except Queue.Empty: 
-            print u'url_queue empty. Nothing left to lengthen. Returning to my cave.'
-            break
-        short_long = lengthen_url(shorturl)
-        long_queue.put((url_id, short_long))
-        long_queue.task_done()
+    try:
+        while True:
+            item = None
+            timeout = None
+            if scheduler is not None:
+                item = scheduler.next_due()
+                timeout = scheduler.due_in()
+            if item is None:
+                try:
+                    item = short_queue.get(block=True, timeout=timeout)
+                except Queue.Empty: 
+                    # Time to look at the deferred URLs again
+                    continue
+                if item is END_OF_STREAM:
+                    wait = None
+                    if scheduler is not None:
+                        wait = scheduler.due_in()
+                    if wait is not None:
+                        # The queue is closed so get() won't wait:
+                        # sleep until the next deferred URL is due
+                        if wait > 0:
+                            sleep(min(wait, HOST_MAX_SLEEP))
+                        continue
+                    print u'No more URLs. Nothing left to lengthen. Returning to my cave.'
+                    break
+            (url_id, shorturl) = item
+            try:
+                if memo is not None:
+                    short_long = memo.lengthen(shorturl, cache, scheduler, classifier)
+                else:
+                    short_long = lengthen_url(shorturl, cache, scheduler=scheduler,
+                                              classifier=classifier)
+            except HostDeferred as e:
+                scheduler.defer(item, e.wait)
+                continue
+            except HostDown as e:
+                error_log(u'{0} is down, setting aside {1}'.format(e.host, shorturl))
+                continue
+            long_queue.put((url_id, shorturl, short_long))
+    finally:
+        long_queue.put(END_OF_STREAM)
     
-def short_long_writer_worker(longurl_queue, output_function):
+def short_long_writer_worker(longurl_queue, output_function, workers=1, journal=None):
     """Pop pairs off of queue
         Write them to short_long_fp
+        Then note them in the journal
+        Stops after END_OF_STREAM from each of the workers
     """
-    while True:
+    finished = 0
+    while finished < workers:
+        item = longurl_queue.get(block=True)
+        if item is END_OF_STREAM:
+            finished += 1
+            continue
+        (url_id, shorturl, short_long) = item
         try:
-            (url_id, short_long) = longurl_queue.get(block=True, timeout=THREAD_TIMEOUT)
-        except Queue.Empty:
-            print "short_long_queue empty. Nothing left to write."
-            break
-        output_function(url_id, short_long)
-        longurl_queue.task_done()
-
-def lengthen_each(iter_short_urls, output_long_urls):
+            output_function(url_id, short_long)
+        except Exception as e:
+            # Keep draining so the lengtheners don't block;
+            # unjournaled, so a resumed run tries it again
+            error_log(u'Could not write result for {0}'.format(to_unicode(shorturl)))
+            error_log(repr(e))
+            continue
+        if journal is not None:
+            journal.record(url_id, shorturl)
+    print "All lengtheners done. Nothing left to write."
+
+def lengthen_each(iter_short_urls, output_function, cache=None, memo=None, scheduler=None,
+                  classifier=None, journal=None, memory_cap=SPILL_MEMORY_CAP, spill_dir=None):
     """This is a manager function for a multithreaded process.
         It will start up multiple threads to lengthen URLs in parallel.
-        iter_short_urls is an iterator that yields tuples: (url_id, short_urls)
+        iter_short_urls is an iterator that yields tweets with twitter_entities
+        The rest is as for lengthen_pairs
     """
-
-    shorturl_queue = Queue.Queue()
-    longurl_queue = Queue.Queue()
+    lengthen_pairs(iter_tweet_urls(iter_short_urls), output_function, cache, memo, scheduler,
+                   classifier, journal, memory_cap, spill_dir)
+
+def lengthen_pairs(iter_pairs, output_function, cache=None, memo=None, scheduler=None,
+                   classifier=None, journal=None, memory_cap=SPILL_MEMORY_CAP, spill_dir=None):
+    """Lengthen (url_id, shorturl) pairs in parallel with THREAD_MAX threads
+        output_function is called with (url_id, short_long) for each URL
+        cache is an optional URLCache shared by the threads
+        memo is a RedirectMemo shared by the threads (new one if None)
+        scheduler is a HostScheduler shared by the threads (new one if None)
+        classifier is a ShortenerClassifier (bundled list if None)
+        journal is an optional CheckpointJournal of finished URLs
+        memory_cap is the bytes of pending URLs to hold in memory;
+            the source is read at full speed and the rest spill
+            to a temporary file in spill_dir
+    """
+    if memo is None:
+        memo = RedirectMemo()
+    if scheduler is None:
+        scheduler = HostScheduler()
+
+    shorturl_queue = SpillQueue(memory_cap, spill_dir)
+    # Bounded, so lengtheners wait for a slow writer
+    longurl_queue = Queue.Queue(maxsize=WRITE_QUEUE_SIZE)
     threads = []
 
 
     # Thread to read shortURLs out of source
     # and insert them into a queue
     threads.append(threading.Thread(target=shorturl_prep_worker, 
-                                    args=(iter_short_urls, shorturl_queue)))
+                                    args=(iter_pairs, shorturl_queue, journal)))
 
     # Thread(s) to read shortURLs out of the queue
     # Attempt to lengthen them
     # And insert them into the completed queue
     for _ in range(THREAD_MAX):
         threads.append(threading.Thread(target=shorturl_lengthener_worker, 
-                                        args=(shorturl_queue, longurl_queue)))
+                                        args=(shorturl_queue, longurl_queue, cache, memo,
+                                              scheduler, classifier)))
     
     # Thread to read completed URLs out of the queue
     # And output them according to the output function
     threads.append(threading.Thread(target=short_long_writer_worker, 
-                                    args=(short_long_pairs, short_long_fp)))
+                                    args=(longurl_queue, output_function, THREAD_MAX, journal)))
 
     for t in threads:
         t.start()
     for t in threads:
         t.join()
 
+    if shorturl_queue.spilled:
+        print u'{0} URLs spilled to disk along the way.'.format(shorturl_queue.spilled)
+
+
+#
+# Asynchronous lengthening
+#   One thread, thousands of requests in flight
+#   Same hop-by-hop semantics as lengthen_url
+#
+
+# Most requests in flight at once
+ASYNC_MAX_ACTIVE = 5000
+# Most open sockets, and most per host (kept alive between hops);
+# the scheduler decides how many of those a host actually gets
+ASYNC_MAX_CONNECTIONS = 1000
+ASYNC_HOST_CONNECTIONS = HOST_MAX_CONCURRENCY
+# Threads for DNS lookups (the only blocking calls)
+ASYNC_DNS_THREADS = 16
+# Seconds an idle connection stays open
+ASYNC_IDLE_TIMEOUT = 30
+# Read at most this much of a response body to keep a connection alive
+ASYNC_DRAIN_LIMIT = 65536
+ASYNC_POLL_INTERVAL = 0.05
+
+# Characters left alone when quoting request paths
+URL_PATH_SAFE = "%/:=&?~#+!$,;'@()*[]"
+
+try:
+    SSL_WANT_ERRORS = (ssl.SSLWantReadError, ssl.SSLWantWriteError)
+except AttributeError:
+    SSL_WANT_ERRORS = ()
+
+def split_request_url(url):
+    """Return ((scheme, host, port), path, host_header) for url
+        Raises ValueError if it can't be requested
+    """
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    if scheme not in ('http', 'https'):
+        raise ValueError('Unsupported URL: {0}'.format(url))
+    host = parts.hostname
+    if not host:
+        raise ValueError('No host in URL: {0}'.format(url))
+    default_port = 443 if scheme == 'https' else 80
+    port = parts.port or default_port
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    path = urllib.quote(path, safe=URL_PATH_SAFE)
+    host_header = '[{0}]'.format(host) if ':' in host else host
+    if port != default_port:
+        host_header += ':{0}'.format(port)
+    return (scheme, host, port), path, host_header
+
+def dns_worker(requests, results):
+    """Resolve (scheme, host, port) keys from requests
+        Put (key, (family, sockaddr) or None) into results
+    """
+    while True:
+        key = requests.get()
+        if key is None:
+            break
+        scheme, host, port = key
+        try:
+            info = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            family, _, _, _, sockaddr = info[0]
+            results.put((key, (family, sockaddr)))
+        except (socket.error, UnicodeError, ValueError):
+            results.put((key, None))
+
+class AsyncJob(object):
+    """One short URL being followed
+    """
+    __slots__ = ('url_id', 'source', 'hops', 'status', 'retried', 'host', 'sent')
+
+    def __init__(self, url_id, shorturl, source=None):
+        self.url_id = url_id
+        # The URL as it came from the input
+        self.source = source or shorturl
+        self.hops = [shorturl]
+        self.status = None
+        self.retried = False
+        # Host holding a scheduler slot for the current hop
+        self.host = None
+        self.sent = None
+
+class HostPool(object):
+    """Connections and queued requests for one (scheme, host, port)
+    """
+    def __init__(self):
+        self.addr = None
+        self.resolving = False
+        self.count = 0
+        self.idle = []
+        self.waiting = deque()
+
+class AsyncConnection(asyncore.dispatcher):
+    """A keep-alive HTTP(S) connection that sends one request
+        at a time and reports status and Location to the resolver
+    """
+    def __init__(self, resolver, key, family):
+        asyncore.dispatcher.__init__(self, map=resolver.map)
+        self.resolver = resolver
+        self.key = key
+        self.job = None
+        self.state = 'connecting'
+        self.outbuf = ''
+        self.inbuf = ''
+        self.framing = None
+        self.remaining = 0
+        self.drained = 0
+        self.keep_alive = False
+        self.requests = 0
+        self.responded = False
+        self.deadline = time() + resolver.timeout
+        self.create_socket(family, socket.SOCK_STREAM)
+
+    # asyncore hooks
+
+    def readable(self):
+        return self.state != 'closed'
+
+    def writable(self):
+        return (not self.connected or self.state == 'handshake' or bool(self.outbuf))
+
+    def handle_connect(self):
+        scheme, host, port = self.key
+        if scheme == 'https':
+            sock = self.resolver.wrap_ssl(self.socket, host)
+            self.del_channel()
+            self.set_socket(sock, self.resolver.map)
+            self.state = 'handshake'
+            self._handshake()
+        else:
+            self._ready()
+
+    def handle_read(self):
+        if self.state == 'handshake':
+            self._handshake()
+            return
+        try:
+            data = self.socket.recv(65536)
+            if data and self.key[0] == 'https':
+                while self.socket.pending():
+                    data += self.socket.recv(self.socket.pending())
+        except SSL_WANT_ERRORS:
+            return
+        except socket.error as err:
+            if err.args and err.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            self.lost('URLError')
+            return
+        if not data:
+            self.lost('URLError')
+            return
+        self.feed(data)
+
+    def handle_write(self):
+        if self.state == 'handshake':
+            self._handshake()
+            return
+        try:
+            sent = self.socket.send(self.outbuf)
+        except SSL_WANT_ERRORS:
+            return
+        except socket.error as err:
+            if err.args and err.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            self.lost('URLError')
+            return
+        self.outbuf = self.outbuf[sent:]
+
+    def handle_close(self):
+        self.lost('URLError')
+
+    def handle_error(self):
+        exc = sys.exc_info()[1]
+        if isinstance(exc, ssl.SSLError):
+            self.lost('SSLError')
+        else:
+            self.lost('URLError')
+
+    # Requests and responses
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except SSL_WANT_ERRORS:
+            return
+        except (ssl.SSLError, socket.error):
+            self.lost('SSLError')
+            return
+        self._ready()
+
+    def _ready(self):
+        self.state = 'idle'
+        self.deadline = time() + ASYNC_IDLE_TIMEOUT
+        self.resolver.release(self)
+
+    def send_request(self, job, path, host_header):
+        self.job = job
+        self.state = 'request'
+        self.requests += 1
+        self.responded = False
+        self.inbuf = ''
+        self.deadline = time() + self.resolver.timeout
+        self.outbuf = ('GET {0} HTTP/1.1\r\n'
+                       'Host: {1}\r\n'
+                       'User-Agent: {2}\r\n'
+                       'Accept: */*\r\n'
+                       'Accept-Encoding: identity\r\n'
+                       'Connection: keep-alive\r\n'
+                       '\r\n').format(path, host_header, self.resolver.user_agent)
+
+    def feed(self, data):
+        if self.state == 'request':
+            self.responded = True
+            self.inbuf += data
+            self._parse_head()
+        elif self.state == 'body':
+            self.inbuf += data
+            self._drain()
+        else:
+            # Nobody asked for this
+            self.close_connection()
+
+    def _parse_head(self):
+        while True:
+            end = self.inbuf.find('\r\n\r\n')
+            if end < 0:
+                if len(self.inbuf) > ASYNC_DRAIN_LIMIT:
+                    self.lost('BadStatusLine')
+                return
+            head = self.inbuf[:end]
+            self.inbuf = self.inbuf[end + 4:]
+            lines = head.split('\r\n')
+            parts = lines[0].split(None, 2)
+            if (len(parts) < 2 or not parts[0].startswith('HTTP/')
+                    or not parts[1].isdigit()):
+                self.lost('BadStatusLine')
+                return
+            code = int(parts[1])
+            if 100 <= code < 200:
+                # Interim response, the real one follows
+                continue
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            break
+
+        connection = headers.get('connection', '').lower()
+        if parts[0] == 'HTTP/1.0':
+            self.keep_alive = 'keep-alive' in connection
+        else:
+            self.keep_alive = 'close' not in connection
+        self.drained = 0
+        if code in (204, 304):
+            self.framing = None
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            self.framing = 'size'
+        elif headers.get('content-length', '').isdigit():
+            self.framing = 'length'
+            self.remaining = int(headers['content-length'])
+            if self.remaining > ASYNC_DRAIN_LIMIT:
+                self.keep_alive = False
+        else:
+            self.framing = 'close'
+            self.keep_alive = False
+
+        job = self.job
+        self.job = None
+        if self.keep_alive:
+            self.state = 'body'
+        else:
+            self.close_connection()
+        self.resolver.response(job, code, headers.get('location'))
+        if self.state == 'body':
+            self._drain()
+
+    def _drain(self):
+        """Discard the response body so the connection can be reused
+        """
+        while True:
+            if self.framing == 'length' or self.framing == 'data':
+                n = min(len(self.inbuf), self.remaining)
+                self.inbuf = self.inbuf[n:]
+                self.remaining -= n
+                if self.remaining:
+                    return
+                if self.framing == 'length':
+                    break
+                self.framing = 'size'
+            elif self.framing == 'size':
+                end = self.inbuf.find('\r\n')
+                if end < 0:
+                    return
+                line = self.inbuf[:end].split(';')[0].strip()
+                self.inbuf = self.inbuf[end + 2:]
+                try:
+                    size = int(line, 16)
+                except ValueError:
+                    self.close_connection()
+                    return
+                self.drained += size
+                if self.drained > ASYNC_DRAIN_LIMIT:
+                    self.close_connection()
+                    return
+                if size:
+                    self.framing = 'data'
+                    self.remaining = size + 2
+                else:
+                    self.framing = 'trailer'
+            elif self.framing == 'trailer':
+                if self.inbuf.startswith('\r\n'):
+                    break
+                end = self.inbuf.find('\r\n\r\n')
+                if end < 0:
+                    return
+                break
+            else:
+                break
+        self.inbuf = ''
+        self._ready()
+
+    def lost(self, status):
+        """The connection failed; fail or retry its request
+        """
+        if self.state == 'closed':
+            return
+        job = self.job
+        self.job = None
+        if job is None and self.state in ('connecting', 'handshake'):
+            # Never got as far as a request
+            self.resolver.connect_failed(self.key, status)
+        # Only a kept-alive connection the server closed or reset
+        # before answering is worth a retry; timeouts and errors
+        # after part of a response fail as they are
+        stale = (self.requests > 1 and not self.responded
+                 and status == 'URLError')
+        self.close_connection()
+        if job is not None:
+            if stale and not job.retried:
+                # The server dropped a kept-alive connection, try once more
+                job.retried = True
+                self.resolver.release_host(job, None)
+                self.resolver.dispatch(job)
+            else:
+                self.resolver.fail(job, status)
+
+    def close_connection(self):
+        if self.state == 'closed':
+            return
+        self.state = 'closed'
+        self.close()
+        self.resolver.closed(self)
+
+class AsyncResolver(object):
+    """Lengthen many URLs concurrently on one thread
+
+        Each hop is requested without following redirects, just
+        like lengthen_url, and each result is the same short_long
+        dict. Connections are pooled per host and kept alive, so
+        chains through the same shortener reuse sockets.
+
+        cache : optional URLCache consulted before any request
+        memo : RedirectMemo for hops already walked
+        scheduler : HostScheduler that paces the requests to each host
+        classifier : ShortenerClassifier; only short URLs are followed
+        journal : optional CheckpointJournal; journaled URLs are
+                  skipped and finished ones recorded
+    """
+    def __init__(self, max_active=ASYNC_MAX_ACTIVE,
+                       max_connections=ASYNC_MAX_CONNECTIONS,
+                       host_connections=ASYNC_HOST_CONNECTIONS,
+                       timeout=HTTP_TIMEOUT,
+                       max_redirects=HTTP_MAX_REDIRECTS,
+                       dns_threads=ASYNC_DNS_THREADS,
+                       cache=None,
+                       memo=None,
+                       scheduler=None,
+                       classifier=None,
+                       journal=None):
+        self.max_active = max_active
+        self.max_connections = max_connections
+        self.host_connections = host_connections
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.dns_threads = dns_threads
+        self.cache = cache
+        if memo is None:
+            memo = RedirectMemo()
+        self.memo = memo
+        if scheduler is None:
+            scheduler = HostScheduler()
+        self.scheduler = scheduler
+        if classifier is None:
+            classifier = default_classifier()
+        self.classifier = classifier
+        self.journal = journal
+        self.user_agent = USER_AGENT.encode('utf-8')
+        self.map = {}
+        self.pools = {}
+        self.active = 0
+        self.connections = 0
+        self.requests = 0
+        self._idle = OrderedDict()
+        self._starved = deque()
+        # (due, seq, job) for hops the scheduler put off
+        self._deferred = []
+        self._deferred_seq = 0
+        # url key -> (url_id, shorturl) waiting on the walk already under way
+        self._inflight = {}
+        self._output = None
+        self._dns_requests = Queue.Queue()
+        self._dns_results = Queue.Queue()
+        self._ssl_context = None
+        if hasattr(ssl, 'create_default_context'):
+            self._ssl_context = ssl.create_default_context()
+
+    def wrap_ssl(self, sock, host):
+        if self._ssl_context is not None:
+            return self._ssl_context.wrap_socket(sock,
+                                                 do_handshake_on_connect=False,
+                                                 server_hostname=host)
+        return ssl.wrap_socket(sock, do_handshake_on_connect=False)
+
+    def run(self, iter_short_urls, output_function):
+        """Lengthen every (url_id, shorturl) from iter_short_urls
+            Calls output_function(url_id, short_long) for each
+        """
+        self._output = output_function
+        dns_threads = []
+        for _ in range(self.dns_threads):
+            t = threading.Thread(target=dns_worker,
+                                 args=(self._dns_requests, self._dns_results))
+            t.daemon = True
+            t.start()
+            dns_threads.append(t)
+
+        source = iter(iter_short_urls)
+        if self.journal is not None:
+            source = self.journal.pending(source)
+        exhausted = False
+        last_sweep = time()
+        try:
+            while True:
+                while not exhausted and self.active < self.max_active:
+                    try:
+                        url_id, shorturl = next(source)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    self.start(url_id, shorturl)
+                self._drain_dns()
+                self._serve_starved()
+                self._wake_deferred()
+                if exhausted and not self.active:
+                    break
+                if self.map:
+                    asyncore.loop(timeout=ASYNC_POLL_INTERVAL, use_poll=True,
+                                  map=self.map, count=1)
+                else:
+                    # Only waiting on DNS
+                    sleep(ASYNC_POLL_INTERVAL)
+                now = time()
+                if now - last_sweep > ASYNC_POLL_INTERVAL:
+                    self._sweep(now)
+                    last_sweep = now
+        finally:
+            # Give back the scheduler slots of anything cut short
+            for conn in self.map.values():
+                if conn.job is not None:
+                    self.release_host(conn.job, None)
+            for pool in self.pools.values():
+                for job, _, _ in pool.waiting:
+                    self.release_host(job, None)
+                pool.waiting.clear()
+            for conn in self.map.values():
+                conn.close_connection()
+            for _ in dns_threads:
+                self._dns_requests.put(None)
+
+    def emit(self, url_id, source, short_long):
+        """Hand a result to the output function, then journal it
+        """
+        self._output(url_id, short_long)
+        if self.journal is not None:
+            self.journal.record(url_id, source)
+
+    def start(self, url_id, source):
+        if not self.classifier.is_shortener(source):
+            self.emit(url_id, source, {source: None})
+            return
+        if self.cache is not None:
+            entry = self.cache.get(source)
+            if entry is not None:
+                self.emit(url_id, source, short_long_from_chain([source] + entry.hops[1:] + [None]))
+                return
+        known = self.memo.chain(source)
+        if known is not None:
+            self.emit(url_id, source, short_long_from_chain(known[0]))
+            return
+        key = self.memo.canonicalizer.key(source)
+        if key in self._inflight:
+            self._inflight[key].append((url_id, source))
+            return
+        self._inflight[key] = []
+        self.active += 1
+        self.dispatch(AsyncJob(url_id, source))
+
+    def dispatch(self, job):
+        """Send job's current hop on a pooled connection or queue it
+            Defers it if the scheduler says its host is busy
+        """
+        try:
+            key, path, host_header = split_request_url(job.hops[-1])
+        except ValueError:
+            self.fail(job, 'ValueError')
+            return
+        host = key[1]
+        wait = self.scheduler.acquire(host)
+        if wait is None:
+            self.set_aside(job, host)
+            return
+        if wait:
+            self._deferred_seq += 1
+            heapq.heappush(self._deferred, (time() + wait, self._deferred_seq, job))
+            return
+        job.host = host
+        job.sent = time()
+        pool = self.pools.get(key)
+        if pool is None:
+            pool = self.pools[key] = HostPool()
+        if pool.idle:
+            conn = pool.idle.pop()
+            self._idle.pop(conn, None)
+            self.requests += 1
+            conn.send_request(job, path, host_header)
+        else:
+            pool.waiting.append((job, path, host_header))
+            self._grow(key, pool)
+
+    def _grow(self, key, pool):
+        """Open connections for the queued requests of a host
+        """
+        if pool.addr is None:
+            if not pool.resolving:
+                pool.resolving = True
+                self._dns_requests.put(key)
+            return
+        while pool.waiting and pool.count < min(len(pool.waiting), self.host_connections):
+            if self.connections >= self.max_connections:
+                if not self._idle:
+                    self._starved.append(key)
+                    return
+                idle, _ = self._idle.popitem(last=False)
+                idle.close_connection()
+            family, sockaddr = pool.addr
+            pool.count += 1
+            self.connections += 1
+            conn = AsyncConnection(self, key, family)
+            try:
+                conn.connect(sockaddr)
+            except socket.error:
+                conn.lost('URLError')
+                return
+
+    def _wake_deferred(self):
+        now = time()
+        while self._deferred and self._deferred[0][0] <= now:
+            job = heapq.heappop(self._deferred)[2]
+            self.dispatch(job)
+
+    def release_host(self, job, status):
+        """Give back the scheduler slot held by job, if any
+        """
+        if job.host is not None:
+            self.scheduler.release(job.host, status, time() - job.sent)
+            job.host = None
+
+    def _serve_starved(self):
+        while self._starved and self.connections < self.max_connections:
+            key = self._starved.popleft()
+            self._grow(key, self.pools[key])
+
+    def _drain_dns(self):
+        while True:
+            try:
+                key, addr = self._dns_results.get_nowait()
+            except Queue.Empty:
+                return
+            pool = self.pools[key]
+            pool.resolving = False
+            if addr is None:
+                self.connect_failed(key, 'URLError')
+            else:
+                pool.addr = addr
+                self._grow(key, pool)
+
+    def _sweep(self, now):
+        """Time out slow requests and long idle connections
+        """
+        for conn in self.map.values():
+            if conn.deadline < now:
+                if conn.state == 'idle':
+                    self._idle.pop(conn, None)
+                    conn.close_connection()
+                else:
+                    conn.lost('timeout')
 
+    def release(self, conn):
+        """conn is ready for another request
+        """
+        pool = self.pools[conn.key]
+        if pool.waiting:
+            job, path, host_header = pool.waiting.popleft()
+            self.requests += 1
+            conn.send_request(job, path, host_header)
+        else:
+            pool.idle.append(conn)
+            self._idle[conn] = True
+
+    def closed(self, conn):
+        pool = self.pools[conn.key]
+        pool.count -= 1
+        self.connections -= 1
+        self._idle.pop(conn, None)
+        if conn in pool.idle:
+            pool.idle.remove(conn)
+        if pool.waiting:
+            self._grow(conn.key, pool)
+
+    def connect_failed(self, key, status):
+        """Couldn't reach a host, or open one more connection to it
+            While other connections to the host are open (or being
+            opened) only the request the failed one was for is
+            failed; once none are left, everything queued fails
+        """
+        pool = self.pools[key]
+        # pool.count still includes the connection that failed
+        if pool.count > 1 and pool.waiting:
+            job, path, host_header = pool.waiting.popleft()
+            self.fail(job, status)
+            return
+        while pool.waiting:
+            job, path, host_header = pool.waiting.popleft()
+            self.fail(job, status)
+
+    def response(self, job, code, location):
+        self.release_host(job, code)
+        job.status = code
+        nexturl = None
+        if code in HTTP_REDIRECT_CODES and location:
+            if not location[:4] == 'http':
+                nexturl = urllib.basejoin(job.hops[-1], location)
+            else:
+                nexturl = location
+        job.hops.append(nexturl)
+        if nexturl and not self.classifier.is_shortener(nexturl):
+            # Landed somewhere that isn't a shortener
+            job.hops.append(None)
+            self.finish(job)
+        elif nexturl and len(job.hops) < self.max_redirects:
+            known = self.memo.chain(nexturl)
+            if known is not None:
+                job.hops.extend(known[0][1:])
+                del job.hops[self.max_redirects:]
+                job.status = known[1]
+                self.finish(job)
+            else:
+                self.dispatch(job)
+        else:
+            self.finish(job)
+
+    def set_aside(self, job, host):
+        """job's host is down: drop it and the lookups waiting on it
+            without a result, so a later run tries them again
+        """
+        self.active -= 1
+        waiting = self._inflight.pop(self.memo.canonicalizer.key(job.hops[0]), [])
+        error_log(u'{0} is down, setting aside {1}'.format(host, job.source))
+        for url_id, source in waiting:
+            error_log(u'{0} is down, setting aside {1}'.format(host, source))
+
+    def fail(self, job, status):
+        self.release_host(job, status)
+        job.status = status
+        job.hops.append(None)
+        self.finish(job)
+
+    def finish(self, job):
+        hops = job.hops
+        short_long = short_long_from_chain(hops)
+        self.memo.record(hops, job.status)
+        if self.cache is not None:
+            chain = hops[:-1] if hops[-1] is None else hops
+            self.cache.put(hops[0], chain[-1], chain, job.status)
+        self.active -= 1
+        self.emit(job.url_id, job.source, short_long)
+        for url_id, source in self._inflight.pop(self.memo.canonicalizer.key(hops[0]), []):
+            # Same URL, maybe spelled differently: key the result by its own spelling
+            self.emit(url_id, source, short_long_from_chain([source] + hops[1:]))
+
+def iter_tweet_urls(tweets):
+    """Yield (tweet_id, url) for every URL in tweets
+        Prefers the expanded_url Twitter provides and
+        falls back on the body if there are no URL entities
+    """
+    for tweet in tweets:
+        tweet_id = tweet.get('_id')
+        for url in tweet_urls(tweet):
+            yield (tweet_id, url)
+
+def lengthen_each_async(iter_short_urls, output_function, cache=None, **options):
+    """Like lengthen_each but on one asynchronous thread
+        iter_short_urls is an iterator that yields tweets with twitter_entities
+        options are passed on to AsyncResolver
+    """
+    resolver = AsyncResolver(cache=cache, **options)
+    resolver.run(iter_tweet_urls(iter_short_urls), output_function)
+    return resolver
+
+def fill_work_queue(work_queue, iter_short_urls, chunk=WORK_BATCH_SIZE):
+    """Add the URLs of tweets from iter_short_urls to work_queue
+        Returns how many were new
+    """
+    added = 0
+    batch = []
+    for item in iter_tweet_urls(iter_short_urls):
+        batch.append(item)
+        if len(batch) >= chunk:
+            added += work_queue.add(batch)
+            batch = []
+    if batch:
+        added += work_queue.add(batch)
+    return added
+
+def lengthen_from_queue(work_queue, output_function, cache=None, memo=None, scheduler=None,
+                        classifier=None, worker=None, batch_size=WORK_BATCH_SIZE,
+                        lease=WORK_LEASE_SECONDS, use_async=False):
+    """Lease batches from work_queue and lengthen them until
+        every item is finished, by this worker or another
+        Run as many of these as you like, in as many processes
+        and on as many machines as the queue reaches.
+        worker names this process in the queue (host:pid if None)
+        use_async lengthens each batch with an AsyncResolver,
+            otherwise with lengthen_pairs
+        Returns how many items this worker finished
+    """
+    if worker is None:
+        worker = default_worker()
+    if memo is None:
+        memo = RedirectMemo()
+    if scheduler is None:
+        scheduler = HostScheduler()
+    finished = 0
+    try:
+        while True:
+            batch = work_queue.lease(worker, batch_size, lease)
+            if not batch:
+                if not work_queue.unfinished():
+                    break
+                # The rest is leased; wait in case a lease runs out
+                sleep(WORK_POLL_INTERVAL)
+                continue
+            journal = LeaseJournal(work_queue, worker, lease)
+            try:
+                if use_async:
+                    resolver = AsyncResolver(cache=cache, memo=memo, scheduler=scheduler,
+                                             classifier=classifier, journal=journal)
+                    resolver.run(batch, output_function)
+                else:
+                    lengthen_pairs(batch, output_function, cache, memo, scheduler,
+                                   classifier, journal)
+            finally:
+                journal.close()
+                finished += journal.completed
+    finally:
+        # Anything still held goes straight back to the others
+        work_queue.release(worker)
+    return finished
 
 
 
 if __name__=="__main__":
 
+    parser = argparse.ArgumentParser(description='Lengthen the URLs in a collection of tweets')
+    parser.add_argument('--async',
+                        dest='use_async',
+                        action='store_true',
+                        help='Resolve on one asynchronous thread instead of THREAD_MAX threads')
+    parser.add_argument('--host-rate',
+                        type=float,
+                        default=HOST_RATE,
+                        help='Requests per second allowed to any one host')
+    parser.add_argument('--host-stats',
+                        action='store_true',
+                        help='Print per-host request stats after each period')
+    parser.add_argument('--journal',
+                        default=JOURNAL_PATH,
+                        help='File that records which URLs are finished')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='Skip URLs already in the journal instead of starting over')
+    parser.add_argument('--fresh',
+                        action='store_true',
+                        help='Start over even if the journal has URLs in it (erases it)')
+    parser.add_argument('--queue',
+                        help='Share the work through this sqlite queue (same machine)')
+    parser.add_argument('--mongo-queue',
+                        help='Share the work through this collection (any machine)')
+    parser.add_argument('--fill',
+                        action='store_true',
+                        help='Add the observation periods to the queue before working')
+    parser.add_argument('--worker',
+                        help='Name of this worker in the queue (default host:pid)')
+    parser.add_argument('--jsonl',
+                        help='Read tweets from this file through its time index instead of Mongo')
+    args = parser.parse_args()
+
     host = "localhost"
     port = 9001
     database = "debate"
     input_collection = "oct2012"
     output_collection = "urls"
 
+    # Fields read from each tweet with --jsonl
+    jsonl_fields = ['id', 'id_str', 'postedTime', 'created_at', 'body', 'text',
+                    'twitter_entities.urls', 'entities.urls']
+
     observation_periods = [
         (datetime.datetime(2012, 10, 1),
         datetime.datetime(2012, 10, 4)), 
@@ -445,9 +2347,39 @@ if __name__=="__main__":
     mongo = pymongo.Connection(host=host, port=port)
     db = mongo[database]
 
+    # Resolutions from earlier runs
+    cache = URLCache(URL_CACHE_PATH)
+
+    # Hops seen so far, shared across observation periods
+    memo = RedirectMemo()
+
+    # Per-host pacing, also shared so throttled hosts stay throttled
+    scheduler = HostScheduler(rate=args.host_rate)
+
+    # Work shared with other lengtheners, if any
+    work_queue = None
+    if args.queue:
+        work_queue = SQLiteWorkQueue(args.queue)
+    elif args.mongo_queue:
+        work_queue = MongoWorkQueue(db[args.mongo_queue])
+
+    # Finished URLs, so a crash doesn't mean starting from scratch
+    # The queue keeps its own track of what is finished
+    journal = None
+    if work_queue is None:
+        if (not args.resume and not args.fresh and os.path.exists(args.journal)
+                and os.path.getsize(args.journal) > 0):
+            # Starting over would wipe the only record of a crashed run
+            die(u'{0} has URLs in it: pass --resume to pick up where it '
+                u'left off or --fresh to start over'.format(args.journal))
+        journal = CheckpointJournal(args.journal, resume=args.resume)
+        if args.resume:
+            sys.stderr.write(u'Resuming, {0} URLs already done\n'.format(len(journal)))
+
     # This is a little funky
     # The idea is to have a simple function that we can pass to a worker 
-    output_function = lambda obj: db[output_collection].save(obj)
+    output_function = lambda url_id, short_long: db[output_collection].insert(
+        {'tweet_id': url_id, 'short_long': short_long.items()})
 
     # TODO debuggin output 
     sys.stderr.write(u'Started at ')
@@ -462,11 +2394,41 @@ if __name__=="__main__":
                         'twitter_entities': True, 
                         'body': True, 
                         'postedTimeObj': True}
-        # TODO limit() is for testing
-        cursor = db.oct2012.find(query, projection).limit(50) 
+        if args.jsonl:
+            # Index is built on first use, then only the period is read
+            # Only what the Mongo projection would have returned is decoded
+            cursor = with_mongo_ids(itertweets_between(args.jsonl, start, end,
+                                                       fields=jsonl_fields))
+        else:
+            # TODO limit() is for testing
+            cursor = db.oct2012.find(query, projection).limit(50) 
         
         # Kick off the manager
-        lengthen_each(cursor, db, output_collection)
+        if work_queue is not None:
+            if args.fill:
+                added = fill_work_queue(work_queue, cursor)
+                sys.stderr.write(u'Queued {0} new URLs\n'.format(added))
+            continue
+        if args.use_async:
+            lengthen_each_async(cursor, output_function, cache, memo=memo,
+                                scheduler=scheduler, journal=journal)
+        else:
+            lengthen_each(cursor, output_function, cache, memo, scheduler,
+                          journal=journal)
+        if args.host_stats:
+            scheduler.report()
+
+    if work_queue is not None:
+        finished = lengthen_from_queue(work_queue, output_function, cache, memo, scheduler,
+                                       worker=args.worker, use_async=args.use_async)
+        sys.stderr.write(u'Finished {0} URLs from the queue\n'.format(finished))
+        if args.host_stats:
+            scheduler.report()
+        work_queue.close()
+
+    cache.close()
+    if journal is not None:
+        journal.close()
 
     # TODO output the time for debugging
     sys.stderr.write(u'Finished at ')
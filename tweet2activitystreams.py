@@ -20,22 +20,6 @@ import json
 import re
 import tweetutils
   
-def rfc2822_to_iso8601(time_str):
-    """Converts a timestamp string from RFC 2822 format to ISO 8601.
-
-    Example RFC 2822 timestamp string generated by Twitter:
-      'Wed May 23 06:01:13 +0000 2007'
-
-    Resulting ISO 8610 timestamp string:
-      '2007-05-23T06:01:13'
-    """
-    if not time_str:
-      return None
-
-    without_timezone = re.sub(' [+-][0-9]{4} ', ' ', time_str)
-    dt = datetime.datetime.strptime(without_timezone, '%a %b %d %H:%M:%S %Y')
-    return dt.isoformat()
-
 def tag_uri(name):
     """Returns a tag URI string for the given domain and name.
 
@@ -70,12 +54,24 @@ def get_provider(tweet):
             u'link': u'http://www.twitter.com',
             u'objectType': u'service'}
 
+# Sources seen so far: (name, url), or False if there's no link
+_generator_cache = tweetutils.LRUCache(tweetutils.LOW_CARDINALITY_CACHE_SIZE)
+
 def build_generator(tweet):
     # yes, the source field has an embedded HTML link. bleh.
     # https://dev.twitter.com/docs/api/1.1/get/statuses/show/
-    parsed = re.search('<a href="([^"]+)".*>(.+)</a>', tweet.get('source', ''))
+    source = tweet.get('source', '')
+    parsed = _generator_cache.get(source)
+    if parsed is None:
+        parsed = re.search('<a href="([^"]+)".*>(.+)</a>', source)
+        if parsed:
+            url, name = parsed.groups()
+            parsed = (tweetutils.intern_generator(name), tweetutils.intern_url(url))
+        else:
+            parsed = False
+        _generator_cache.set(source, parsed)
     if parsed:
-      url, name = parsed.groups()
+      name, url = parsed
       generator = {'displayName': name, 'url': url, 'link': url}
       return generator
     return None
@@ -83,7 +79,7 @@ def build_generator(tweet):
 def native_to_post(original):
     _id = unicode(original.get('id'))
     actor = native_user_to_actor(original.get('user'))
-    postedTime = rfc2822_to_iso8601(original.get('created_at'))
+    postedTime = tweetutils.rfc2822_to_iso8601(original.get('created_at'))
     post = {u'_id': _id,
             u'actor': actor,
             u'body': original.get('text'),
@@ -104,7 +100,7 @@ def native_to_post(original):
 def native_to_share(rt):
     _id = unicode(rt.get('id'))
     actor = native_user_to_actor(rt.get('user'))
-    postedTime = rfc2822_to_iso8601(rt.get('created_at'))
+    postedTime = tweetutils.rfc2822_to_iso8601(rt.get('created_at'))
     _object = native_to_post(rt.get('retweeted_status'))
     share = {u'_id': _id,
                 u'actor': actor,
@@ -130,7 +126,7 @@ def native_to_object(tweet):
                 u'id_str': _id,
                 u'link': status_url(screen_name, _id),
                 u'objectType': u'note',
-                u'postedTime': rfc2822_to_iso8601(tweet.get('created_at')),
+                u'postedTime': tweetutils.rfc2822_to_iso8601(tweet.get('created_at')),
                 u'summary': tweet.get('text')}
     return _object
 
@@ -142,17 +138,17 @@ def native_user_to_actor(user):
                 u'id': tag_uri(_id),
                 u'id_str': _id, 
                 u'image': user.get('profile_image_url'),
-                u'languages': user.get('lang'),
+                u'languages': tweetutils.intern_language(user.get('lang')),
                 u'link': user_url(user.get('screen_name')),
                 u'links': [{u'href': user.get('url'), u'rel': u'me'}], 
                 u'listedCount': user.get('listed_count'),
                 u'location': {u'displayName': user.get('location'), u'objectType': u'place'},
                 u'objectType': u'person',
-                u'postedTime': rfc2822_to_iso8601(user.get('created_at')),
+                u'postedTime': tweetutils.rfc2822_to_iso8601(user.get('created_at')),
                 u'preferredUsername': user.get('screen_name'), 
                 u'statusesCount': user.get('statuses_count'),
                 u'summary': user.get('description'),
-                u'twitterTimeZone': user.get(u'time_zone'),
+                u'twitterTimeZone': tweetutils.intern_time_zone(user.get(u'time_zone')),
                 u'utcOffset': user.get(u'utf_offset'), 
                 u'verified': user.get(u'verified')}
     return actor
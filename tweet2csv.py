@@ -16,20 +16,23 @@ import tweetutils
 
 
 def build_row(tweet):
-    rt = tweetutils.parse_retweet(tweet)
-    hashtags = ','.join([t.get('text', '') for t in tweet.get('entities', {}).get('hashtags', [])])
-    urls = ','.join([t.get('expanded_url', '') for t in tweet.get('entities', {}).get('urls', [])])
-    mentions = ','.join([t.get('screen_name', '') for t in tweet.get('entities', {}).get('user_mentions', [])])
-    mention_ids = ','.join([t.get('id_str', '') for t in tweet.get('entities', {}).get('user_mentions', [])])
-    row = (tweet.get('id_str', ''),
-            tweetutils.rfc2822_to_iso8601(tweet.get('created_at', '')),
-            tweet.get('user', {}).get('screen_name', '').encode('ascii', errors="replace"),
-            str(tweet.get('user', {}).get('id', '')),
-            tweet.get('text', '').encode('ascii', errors="replace"),
-            int(bool(rt)),
-            int(rt.get('edited', False)),
-            rt.get('retweeted_author_id_str', ''),
-            rt.get('retweeted_author_screenname', '').encode('ascii', errors="replace"),
+    """Row for a tweet or tweetutils.TweetRecord
+    """
+    record = tweetutils.tweet_record(tweet)
+    posted = record.posted_datetime()
+    hashtags = ','.join(record.hashtags)
+    urls = ','.join([expanded for url, expanded in record.urls])
+    mentions = ','.join([name for name, user_id in record.mentions])
+    mention_ids = ','.join([tweetutils.id_string(user_id) for name, user_id in record.mentions])
+    row = (tweetutils.id_string(record.id),
+            posted.isoformat() if posted is not None else '',
+            record.actor.username.encode('ascii', errors="replace"),
+            tweetutils.id_string(record.actor.id),
+            record.text.encode('ascii', errors="replace"),
+            int(record.is_retweet),
+            int(record.edited),
+            tweetutils.id_string(record.retweet_author_id),
+            record.retweet_author.encode('ascii', errors="replace"),
             int(bool(hashtags)),
             hashtags,
             int(bool(urls)),
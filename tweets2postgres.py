@@ -26,60 +26,31 @@ def next_line():
     return sys.stdin.readline().strip()
 
 def parse_tweets_columns(tweet):
-    if 'text' in tweet:
-        return parse_tweets_columns_native(tweet)
-    elif 'body' in tweet:
-        return parse_tweets_columns_activity_streams(tweet)
-    else:
-        return {}
-
-def parse_tweets_columns_activity_streams(tweet):
-    id_str = extract_tweet_id(tweet.get('id', ''))
-    posted_time = from_postedTime(tweet['postedTime'])
-    rt = parse_retweet(tweet)
-    actor_id = extract_user_id(tweet.get('actor', {}).get('id', ''))
-    inreplyto_id = tweet.get('inReplyTo', {}).get('link', '').rsplit('/', 1)[-1]
-    urls = tweet.get('twitter_entities',{}).get('urls', [])
-    hashtags = tweet.get('twitter_entities',{}).get('hashtags', [])
-    user_mentions = tweet.get('twitter_entities',{}).get('user_mentions', [])
-    return {'id': id_str,
-            'posted_time': posted_time,
-            'verb': tweet.get('verb', ''),
-            'retweet_id': rt.get('retweeted_status_id_str', ''),
-            'actor_id': actor_id, 
-            'body': tweet.get('body', ''),
-            'generator': tweet.get('generator', {}).get('displayName', ''),
+    """Columns of the tweets table for a tweet or TweetRecord
+    """
+    if not isinstance(tweet, TweetRecord):
+        if not ('text' in tweet or 'body' in tweet):
+            return {}
+        tweet = tweet_record(tweet)
+    # Entities are stored as the tweet gave them
+    urls = tweet.entities.get('urls', [])
+    hashtags = tweet.entities.get('hashtags', [])
+    user_mentions = tweet.entities.get('user_mentions', [])
+    inreplyto_id = id_string(tweet.in_reply_to_id)
+    if tweet.in_reply_to_id is None and not tweet.activity_streams:
+        # Native tweets that aren't replies have a null id: NULL
+        inreplyto_id = None
+    return {'id': id_string(tweet.id),
+            'posted_time': tweet.posted_datetime(),
+            'verb': tweet.verb,
+            'retweet_id': id_string(tweet.retweet_id),
+            'actor_id': id_string(tweet.actor.id),
+            'body': tweet.text,
+            'generator': tweet.generator,
             'inreplyto_id': inreplyto_id,
             'body_tsv': None,
-            'is_retweet': int(bool(rt)),
-            'edited_retweet': int(rt.get('edited', False)),
-            'urls': json.dumps(urls),
-            'hashtags': json.dumps(hashtags),
-            'user_mentions': json.dumps(user_mentions),
-            'num_urls': len(urls),
-            'num_hashtags': len(hashtags),
-            'num_user_mentions': len(user_mentions)}
-
-def parse_tweets_columns_native(tweet):
-    created_at = tweet.get('created_at')
-    dt = datetime.datetime.strptime(created_at, GNIP_DATETIME_FORMAT)
-    user = tweet.get('user', {})
-    source_name, source_url = extract_source(tweet.get('source', ''))
-    urls = tweet.get('entities',{}).get('urls', [])
-    hashtags = tweet.get('entities',{}).get('hashtags', [])
-    user_mentions = tweet.get('entities',{}).get('user_mentions', [])
-    rt = parse_retweet(tweet)
-    return {'id': tweet.get('id_str', ''),
-            'posted_time': dt,
-            'verb': '',
-            'retweet_id': rt.get('retweeted_status_id_str', ''),
-            'actor_id': user.get('id_str', ''),
-            'body': tweet.get('text', ''),
-            'generator': source_name,
-            'inreplyto_id': tweet.get('in_reply_to_status_id_str', ''),
-            'body_tsv': None, 
-            'is_retweet': int(bool(rt)),
-            'edited_retweet': int(rt.get('edited', False)),
+            'is_retweet': int(tweet.is_retweet),
+            'edited_retweet': int(tweet.edited),
             'urls': json.dumps(urls),
             'hashtags': json.dumps(hashtags),
             'user_mentions': json.dumps(user_mentions),
@@ -88,49 +59,36 @@ def parse_tweets_columns_native(tweet):
             'num_user_mentions': len(user_mentions)}
 
 def parse_users_columns(tweet):
-    if 'user' in tweet:
-        return parse_users_columns_native(tweet)
-    elif 'actor' in tweet:
-        return parse_users_columns_activity_streams(tweet)
-    else:
+    """Columns of the users table for the author of a tweet or TweetRecord
+    """
+    if not isinstance(tweet, TweetRecord):
+        if not ('user' in tweet or 'actor' in tweet):
+            return {}
+        tweet = tweet_record(tweet)
+    user = tweet.actor
+    if user.id is None:
         return {}
-
-def parse_users_columns_native(tweet):
-    created_at = tweet.get('created_at')
-    obs_time = datetime.datetime.strptime(created_at, GNIP_DATETIME_FORMAT)
-    user = tweet.get('user')
-    created_at = user.get('created_at')
-    created_time = datetime.datetime.strptime(created_at, GNIP_DATETIME_FORMAT)
-    return {'id': user.get('id_str', ''),
-            'friends_count': user.get('friends_count', -1),
-            'num_follower': user.get('followers_count', -1),
-            'displayname': user.get('name', ''),
-            'preferredname': user.get('screen_name', ''),
-            'obs_time': obs_time,
-            'summary': user.get('description', ''),
-            'status_count': user.get('statuses_count', -1),
-            'languages': user.get('lang', ''),
-            'listedcount': user.get('listed_count', -1),
+    created_time = None
+    if user.created is not None:
+        created_time = datetime.datetime.utcfromtimestamp(user.created)
+    return {'id': id_string(user.id),
+            'friends_count': count_or_missing(user.friends),
+            'num_follower': count_or_missing(user.followers),
+            'displayname': user.name,
+            'preferredname': user.username,
+            'obs_time': tweet.posted_datetime(),
+            'summary': user.summary,
+            'status_count': count_or_missing(user.statuses),
+            'languages': user.languages,
+            'listedcount': count_or_missing(user.listed),
             'created_time': created_time}
 
-def parse_users_columns_activity_streams(tweet):
-    obs_time = from_postedTime(tweet['postedTime'])
-
-    user = tweet.get('actor')
-    created_time = from_postedTime(user['postedTime'])
-    id_str = extract_user_id(user['id'])
-    lang = ','.join(user.get('languages', []))
-    return {'id': id_str,
-            'friends_count': user.get('friendsCount', -1),
-            'num_follower': user.get('followersCount', -1),
-            'displayname': user.get('displayName', ''),
-            'preferredname': user.get('preferredUsername', ''),
-            'obs_time': obs_time,
-            'summary': user.get('summary', ''),
-            'status_count': user.get('statusesCount', -1),
-            'languages': lang,
-            'listedcount': user.get('listedCount', -1),
-            'created_time': created_time}
+def count_or_missing(n):
+    """Counts the tweet didn't give are stored as -1
+    """
+    if n is None:
+        return -1
+    return n
 
 
 if __name__=="__main__":
@@ -158,6 +116,12 @@ if __name__=="__main__":
                         type=str, 
                         default='', 
                         help='Path to file with Gnip rules, one per line')
+    parser.add_argument('--powertrack',
+                        action='store_true',
+                        help='Evaluate --rules as PowerTrack rules instead of substrings')
+    parser.add_argument('--prefilter',
+                        action='store_true',
+                        help='Skip lines that cannot match before decoding the JSON')
     parser.add_argument('db', 
                         metavar='DB', 
                         type=str, 
@@ -180,6 +144,14 @@ if __name__=="__main__":
             sys.exit()
         else:
             print "Found {0} rules.".format(len(rules))
+            # Compile once so matching doesn't scale with rule count
+            if args.powertrack:
+                try:
+                    rules = PowerTrackRules(rules)
+                except ValueError as e:
+                    die(u'Could not parse rules: {0}'.format(e))
+            else:
+                rules = RuleMatcher(rules)
 
     print 'Inserting tweets from stdin into:'
     print '\tHost       :\t{0}'.format(args.host)
@@ -195,6 +167,10 @@ if __name__=="__main__":
     #
     #db = init(args.host, args.port, args.db)
 
+    # Most lines get thrown out, so check the raw bytes first
+    prefilter = None
+    if args.prefilter:
+        prefilter = RawPrefilter(rules, keys=('text', 'body'))
 
     # Initialize counters
     inserts  = 0
@@ -205,6 +181,19 @@ if __name__=="__main__":
     # keep reading until there are no lines left
     line = next_line()
     while line:
+        if prefilter:
+            if not prefilter.has_keys(line):
+                sys.stderr.write(line)
+                sys.stderr.write('\n')
+                nottweet += 1
+                if nottweet % 500 == 0:
+                    print '{0}\t{1}\t{2}'.format(inserts, valueerror, nottweet)
+                line = next_line()
+                continue
+            if not prefilter.may_match(line):
+                line = next_line()
+                continue
+
         # try to make a json obj out of it
         try:
             tweet = json.loads(line)
@@ -238,28 +227,23 @@ if __name__=="__main__":
             continue
 
 
+        # Native or Activity Streams, worked out once
+        record = tweet_record(tweet)
+
         # Parse the information we need for the tweets table
-        tweet_data = parse_tweets_columns(tweet)
+        tweet_data = parse_tweets_columns(record)
 
         # Parse out the data we need for the users table
-        user_data = parse_users_columns(tweet)
+        user_data = parse_users_columns(record)
 
 
         # If this was a mechanical retweet, get the retweeted tweet/user data
+        # (a manual RT doesn't carry the retweeted tweet, so record.retweeted is None)
         retweeted_tweet_data = None
         retweeted_user_data = None
-        if tweet_data.get('is_retweet'):
-            if 'object' in tweet:
-                retweeted_tweet = tweet['object']
-                retweeted_tweet_data = parse_tweets_columns(retweeted_tweet)
-                retweeted_user_data = parse_users_columns(retweeted_tweet)
-            elif 'retweeted_status' in tweet:
-                retweeted_tweet = tweet['retweeted_status']
-                retweeted_tweet_data = parse_tweets_columns(retweeted_tweet)
-                retweeted_user_data = parse_users_columns(retweeted_tweet)
-            else:
-                # This might have been a manual RT, in which case we don't have all the data
-                pass 
+        if record.retweeted is not None:
+            retweeted_tweet_data = parse_tweets_columns(record.retweeted)
+            retweeted_user_data = parse_users_columns(record.retweeted)
                 
 
         # Now insert these data into the database
@@ -12,23 +12,40 @@ projects. Import at your own risk!
 Kevin Driscoll (c) 2011
 
 """
+import array
+import bisect
+import bz2
 import codecs
 import csv
 import datetime
+import gzip
+import heapq
 import httplib
 import json
+import mmap
+import multiprocessing
 import os
 import re
 import socket
+import sqlite3
+import struct
 import sys
+import tempfile
+import threading
 import urllib2
 from calendar import timegm
 from time import time, strftime, strptime, gmtime 
-from urlparse import urlsplit
-from collections import defaultdict
+from urlparse import urlsplit, urlunsplit
+from collections import defaultdict, deque, namedtuple, OrderedDict
 from glob import glob
 from operator import add 
 
+# Only columnar batches need NumPy
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 #
 # Globals
@@ -56,25 +73,27 @@ RETWEET_RE = re.compile(r'(\"@|RT @|MT @|via @)([A-Za-z0-9_]+)')
 VIA_RE = re.compile(r'via @[a-z0-9_]*$')
 
 SOURCE_RE = re.compile(r'<a href="([^"]*?)" rel="nofollow">([^<]*?)</a>')
-# INSANE URI matching regex from:
-# http://daringfireball.net/2010/07/improved_regex_for_matching_urls
-URL_RE = re.compile(r'(?i)\b((?:[a-z][\w-]+:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:\'".,<>?��....]))')
+# Pieces of extract_urls
+URL_CHUNK_RE = re.compile(r'[^\s<>]+')
+URL_HINT_RE = re.compile(r'(?i)[:/]|www')
+URL_WWW_RE = re.compile(r'(?i)www\d{0,3}[.]')
+URL_SCHEME_RUN_RE = re.compile(r'[\w-]+')
+URL_DOMAIN_RUN_RE = re.compile(r'[A-Za-z0-9.-]+')
+URL_BOUNDARY_RE = re.compile(r'\b')
+URL_ALPHA = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+URL_ALNUM = URL_ALPHA.union('0123456789')
+# Characters a URL found in text can't end with
+URL_TRAILING_PUNCT_STR = u'`!()[]{};:\'".,<>?\xab\xbb\u201c\u201d\u2018\u2019'
+URL_TRAILING_PUNCT = frozenset(URL_TRAILING_PUNCT_STR)
 
-# YouTube URLs come in a few forms:
-re_youtube_id = [
-    re.compile(r'youtube.com/v/([A-Za-z0-9_-]{11})'), # youtube.com/v/{vidid}
-    re.compile(r'youtube.com/vi/([A-Za-z0-9_-]{11})'), # youtube.com/vi/{vidid}
-    re.compile(r'youtube.com/\?v=([A-Za-z0-9_-]{11})'), # youtube.com/?v={vidid}
-    re.compile(r'youtube.com/\?vi=([A-Za-z0-9_-]{11})'), # youtube.com/?vi={vidid}
-    re.compile(r'youtube.com/watch\?feature=player_embedded&v=([A-Za-z0-9_-]{11})'),
-    re.compile(r'youtube.com/watch\?v=([A-Za-z0-9_-]{11})'), # youtube.com/watch?v={vidid}
-    re.compile(r'youtube.com/watch\?vi=([A-Za-z0-9_-]{11})'), # youtube.com/watch?vi={vidid}
-    re.compile(r'youtu.be/([A-Za-z0-9_-]{11})')     # youtu.be/{vidid}
-]
+# YouTube video IDs are 11 of these
+YOUTUBE_ID_RE = re.compile(r'[A-Za-z0-9_-]{11}')
+# Cheap test that rules out most URLs before they are split
+YOUTUBE_HINT_RE = re.compile(r'youtu', re.I)
 
-# Regex to match Twitter ID substrings from Gnip object
-re_tweet_id = re.compile(r':([0-9]*)$')
-re_user_id = re.compile(r':([0-9]*)$')                
+# Gnip ids end in the Twitter id after the last colon:
+#   tag:search.twitter.com,2005:255195785545601024
+#   id:twitter.com:16129920
 
 
 #
@@ -145,79 +164,620 @@ def parse_retweet_activity_streams(tweet):
     return rt
 
 def parse_retweet(tweet):
+    if isinstance(tweet, TweetRecord):
+        return record_retweet(tweet)
     if 'gnip' in tweet:
         return parse_retweet_activity_streams(tweet)
     else:
         return parse_retweet_native(tweet)
 
 def tweet_matches_rules(thistweet, somerules):
-    """ Returns true if thistweet matched one 
+    """ Returns true if thistweet matched one
         of the Gnip rules in somerules
+        somerules is a RuleMatcher, PowerTrackRules or a
+        list of rules (compile the list once with RuleMatcher
+        when checking more than a handful of tweets)
     """
-    match_found = False
+    if not hasattr(somerules, 'matches_native'):
+        somerules = RuleMatcher(somerules)
     if 'gnip' in thistweet:
+        values = somerules.values
         for match in thistweet['gnip']['matching_rules']:
-            if match['value'] in somerules:
-                match_found = True
-                break
+            if match['value'] in values:
+                return True
+        return False
     else:
         # Assume this is a 'native' tweet
         # Gnip provided this format until Feb 28, 2012
-        s = thistweet.get('text','')
-        for u in thistweet.get('entities',{}).get('urls',[]):
-            url = u.get('url','')
+        return somerules.matches_native(thistweet)
+
+def native_match_fields(tweet):
+    """Yield the strings that rules are matched against
+        in a native tweet: text and entity URLs of the
+        tweet and of its retweeted_status
+    """
+    statuses = [tweet]
+    if 'retweeted_status' in tweet:
+        statuses.append(tweet.get('retweeted_status'))
+    for status in statuses:
+        text = status.get('text', '')
+        if text:
+            yield text
+        for u in status.get('entities', {}).get('urls', []):
+            url = u.get('url', '')
             if url:
-                s += ' ' + url
-            expanded = u.get('expanded_url','')
+                yield url
+            expanded = u.get('expanded_url', '')
             if expanded:
-                s += ' ' + expanded
-        if 'retweeted_status' in thistweet:
-            rt = thistweet.get('retweeted_status')
-            s += rt.get('text','')
-            for u in rt.get('entities',{}).get('urls',[]):
-                url = u.get('url','')
-                if url:
-                    s += ' ' + url
-                expanded = u.get('expanded_url','')
-                if expanded:
-                    s += ' ' + expanded
-        for rule in somerules:
-            if rule in s:
-                match_found = True
-                break
-    return match_found
+                yield expanded
+
+def _trailing_id(s):
+    """ Return the digits after the last colon in s
+        ('' if there are none), or None if s has no colon
+        or anything else follows it
+    """
+    head, colon, digits = s.rpartition(':')
+    # Only ASCII digits, which unicode.isdigit doesn't promise
+    if colon and not digits.lstrip('0123456789'):
+        return digits
+    return None
 
 def extract_user_id(s):
     """ Return Twitter User ID found in s
         Return None if no matches found
     """
-    m = re_user_id.search(s)
-    if m:
-        return m.group(1)
-    else:
-        return None
+    return _trailing_id(s)
 
 def extract_tweet_id(s):
     """ Return Twitter Tweet ID found in s
         Return None if no matches found
     """
-    m = re_tweet_id.search(s)
-    if m:
-        return m.group(1)
-    else:
-        return None
+    return _trailing_id(s)
+
+def extract_user_id_int(s):
+    """ Return Twitter User ID found in s as an int
+        Return None if no matches found
+    """
+    digits = _trailing_id(s)
+    if digits:
+        return int(digits)
+    return None
+
+def extract_tweet_id_int(s):
+    """ Return Twitter Tweet ID found in s as an int
+        Return None if no matches found
+    """
+    digits = _trailing_id(s)
+    if digits:
+        return int(digits)
+    return None
 
 def extract_source(source):
     """Return (name, url) from source field
+        Each distinct source is parsed once, and its name
+        and url are shared between the tweets that have it
     """
-    m = SOURCE_RE.match(source)
-    if m:
-        url = m.group(1)
-        name = m.group(2)
-    else:
-        url = ''
-        name = source
-    return name, url
+    parsed = _source_cache.get(source)
+    if parsed is None:
+        m = SOURCE_RE.match(source)
+        if m:
+            url = m.group(1)
+            name = m.group(2)
+        else:
+            url = ''
+            name = source
+        parsed = (intern_generator(name), intern_url(url))
+        _source_cache.set(source, parsed)
+    return parsed
+
+#
+# Rule matching
+#
+
+class RuleMatcher(object):
+    """Matches many substring rules at once
+
+        Rules are compiled into an Aho-Corasick automaton
+        so each string is scanned once, however many rules
+        there are. The rule values are also kept in a set
+        for the Gnip matching_rules lookup.
+    """
+    # Below this many rules plain substring tests are faster
+    SCAN_LIMIT = 24
+
+    def __init__(self, rules):
+        self.rules = [to_unicode(rule) for rule in rules]
+        self.values = frozenset(self.rules)
+        # Substrings a matching native tweet must contain
+        self.literals = self.rules
+        self.case_sensitive = True
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [False]
+        for rule in self.rules:
+            self._add(rule)
+        self._link()
+
+    def __len__(self):
+        return len(self.rules)
+
+    def _add(self, rule):
+        state = 0
+        for ch in rule:
+            nextstate = self._goto[state].get(ch)
+            if nextstate is None:
+                nextstate = len(self._goto)
+                self._goto[state][ch] = nextstate
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(False)
+            state = nextstate
+        self._out[state] = True
+
+    def _link(self):
+        """Breadth-first pass to set the failure links
+        """
+        goto, fail, out = self._goto, self._fail, self._out
+        queue = deque(goto[0].itervalues())
+        while queue:
+            r = queue.popleft()
+            for ch, s in goto[r].iteritems():
+                queue.append(s)
+                state = fail[r]
+                while state and ch not in goto[state]:
+                    state = fail[state]
+                f = goto[state].get(ch, 0)
+                if f == s:
+                    f = 0
+                fail[s] = f
+                out[s] = out[s] or out[f]
+
+    def search(self, s):
+        """Return True if any rule is a substring of s
+        """
+        goto, fail, out = self._goto, self._fail, self._out
+        if out[0]:
+            # An empty rule matches everything
+            return True
+        if isinstance(s, str):
+            s = s.decode('utf-8', 'replace')
+        if len(self.rules) < self.SCAN_LIMIT:
+            for rule in self.rules:
+                if rule in s:
+                    return True
+            return False
+        state = 0
+        for ch in s:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                return True
+        return False
+
+    def matches_native(self, tweet):
+        """Return True if any rule is found in a native tweet
+        """
+        for s in native_match_fields(tweet):
+            if self.search(s):
+                return True
+        return False
+
+
+#
+# PowerTrack rules
+#   Compiled into an evaluation plan so native tweets
+#   can be re-filtered offline with the same rules
+#
+
+# Keywords match whole tokens; #hashtags and @mentions keep their sigil
+POWERTRACK_TOKEN_RE = re.compile(r'[#@$]?\w+', re.UNICODE)
+
+class _RuleContext(object):
+    """Fields of one tweet, each computed only when a rule needs it
+    """
+    def __init__(self, tweet):
+        self.tweet = tweet
+        self._statuses = None
+        self._urls = None
+        self._tokens = None
+        self._token_string = None
+
+    def statuses(self):
+        """The tweet and the status it retweets, if any
+        """
+        if self._statuses is None:
+            tweet = self.tweet
+            self._statuses = [tweet]
+            if 'retweeted_status' in tweet:
+                self._statuses.append(tweet['retweeted_status'])
+            elif tweet.get('verb') == 'share' and 'object' in tweet:
+                self._statuses.append(tweet['object'])
+        return self._statuses
+
+    def user(self):
+        """Return (user id, lowercase screen name) of the author
+        """
+        tweet = self.tweet
+        if 'user' in tweet:
+            user = tweet['user'] or {}
+            return (user.get('id_str', ''),
+                    (user.get('screen_name') or '').lower())
+        actor = tweet.get('actor', {})
+        return (extract_user_id(actor.get('id', '')),
+                (actor.get('preferredUsername') or '').lower())
+
+    def urls(self):
+        """Lowercase short and expanded URLs
+        """
+        if self._urls is None:
+            self._urls = []
+            for status in self.statuses():
+                entities = status.get('entities') or status.get('twitter_entities') or {}
+                for u in entities.get('urls', []):
+                    for key in ('url', 'expanded_url'):
+                        if u.get(key):
+                            self._urls.append(u[key].lower())
+        return self._urls
+
+    def texts(self):
+        for status in self.statuses():
+            text = status.get('text') or status.get('body')
+            if text:
+                yield text
+
+    def tokens(self):
+        if self._tokens is None:
+            self._tokens = set()
+            for text in self.texts():
+                self._tokens.update(POWERTRACK_TOKEN_RE.findall(text.lower()))
+        return self._tokens
+
+    def token_string(self):
+        """Space separated tokens for phrase matching
+            Texts are separated by | so phrases can't span them
+        """
+        if self._token_string is None:
+            self._token_string = u' | '.join(
+                u' {0} '.format(u' '.join(POWERTRACK_TOKEN_RE.findall(text.lower())))
+                for text in self.texts())
+        return self._token_string
+
+class _Keyword(object):
+    """Keyword or "quoted phrase" matched against tokenized text
+    """
+    cost = 4
+    def __init__(self, words):
+        self.words = tuple(words)
+        if len(self.words) == 1:
+            self.cost = 3
+        self.phrase = u' {0} '.format(u' '.join(self.words))
+
+    def match(self, ctx):
+        if len(self.words) == 1:
+            return self.words[0] in ctx.tokens()
+        return self.phrase in ctx.token_string()
+
+    def literals(self):
+        return set([max(self.words, key=len)])
+
+class _From(object):
+    """from: numeric user id or screen name
+    """
+    cost = 1
+    def __init__(self, value):
+        self.value = value.lower()
+
+    def match(self, ctx):
+        user_id, screen_name = ctx.user()
+        if self.value.isdigit():
+            return self.value == user_id
+        return self.value == screen_name
+
+    def literals(self):
+        return None
+
+class _HasLinks(object):
+    cost = 1
+    def match(self, ctx):
+        if ctx.urls():
+            return True
+        for text in ctx.texts():
+            if u'http://' in text or u'https://' in text:
+                return True
+        return False
+
+    def literals(self):
+        return None
+
+class _UrlContains(object):
+    cost = 2
+    def __init__(self, value):
+        self.value = value.lower()
+
+    def match(self, ctx):
+        for url in ctx.urls():
+            if self.value in url:
+                return True
+        return False
+
+    def literals(self):
+        return set([self.value])
+
+class _Not(object):
+    def __init__(self, clause):
+        self.clause = clause
+        self.cost = clause.cost
+
+    def match(self, ctx):
+        return not self.clause.match(ctx)
+
+    def literals(self):
+        return None
+
+class _And(object):
+    def __init__(self, clauses):
+        # Cheapest first so a failed field check skips the text scan
+        self.clauses = sorted(clauses, key=lambda c: c.cost)
+        self.cost = sum(c.cost for c in self.clauses)
+
+    def match(self, ctx):
+        for clause in self.clauses:
+            if not clause.match(ctx):
+                return False
+        return True
+
+    def literals(self):
+        # Any one required clause will do; take the most selective
+        found = [c.literals() for c in self.clauses]
+        found = [lits for lits in found if lits is not None]
+        if not found:
+            return None
+        return min(found, key=len)
+
+class _Or(object):
+    def __init__(self, clauses):
+        self.clauses = sorted(clauses, key=lambda c: c.cost)
+        self.cost = sum(c.cost for c in self.clauses)
+
+    def match(self, ctx):
+        for clause in self.clauses:
+            if clause.match(ctx):
+                return True
+        return False
+
+    def literals(self):
+        return _union_literals(self.clauses)
+
+def _union_literals(clauses):
+    """Literals of which one must appear for any clause to match
+        None if some clause can match without any text
+    """
+    literals = set()
+    for clause in clauses:
+        lits = clause.literals()
+        if lits is None:
+            return None
+        literals.update(lits)
+    return literals
+
+def _lex_powertrack(rule):
+    """Split a PowerTrack rule into tokens
+        Returns list of (kind, value) tuples
+    """
+    tokens = []
+    i = 0
+    n = len(rule)
+    while i < n:
+        ch = rule[i]
+        if ch.isspace():
+            i += 1
+        elif ch in u'()':
+            tokens.append((ch, ch))
+            i += 1
+        elif ch == u'-' and i + 1 < n and not rule[i + 1].isspace():
+            tokens.append((u'-', ch))
+            i += 1
+        elif ch == u'"':
+            end = rule.find(u'"', i + 1)
+            if end < 0:
+                raise ValueError(u'Unbalanced quote in rule: {0}'.format(rule))
+            tokens.append((u'phrase', rule[i + 1:end]))
+            i = end + 1
+        else:
+            start = i
+            while i < n and not (rule[i].isspace() or rule[i] in u'()"'):
+                i += 1
+            word = rule[start:i]
+            op, colon, value = word.partition(u':')
+            if word == u'OR':
+                tokens.append((u'OR', word))
+            elif colon and op in (u'from', u'has', u'url_contains'):
+                if not value and i < n and rule[i] == u'"':
+                    end = rule.find(u'"', i + 1)
+                    if end < 0:
+                        raise ValueError(u'Unbalanced quote in rule: {0}'.format(rule))
+                    value = rule[i + 1:end]
+                    i = end + 1
+                tokens.append((op, value))
+            else:
+                tokens.append((u'word', word))
+    return tokens
+
+def _parse_or(tokens, pos):
+    clauses = []
+    clause, pos = _parse_and(tokens, pos)
+    clauses.append(clause)
+    while pos < len(tokens) and tokens[pos][0] == u'OR':
+        clause, pos = _parse_and(tokens, pos + 1)
+        clauses.append(clause)
+    if len(clauses) == 1:
+        return clauses[0], pos
+    return _Or(clauses), pos
+
+def _parse_and(tokens, pos):
+    clauses = []
+    while pos < len(tokens) and tokens[pos][0] not in (u'OR', u')'):
+        clause, pos = _parse_unary(tokens, pos)
+        clauses.append(clause)
+    if not clauses:
+        raise ValueError(u'Empty clause in rule')
+    if len(clauses) == 1:
+        return clauses[0], pos
+    return _And(clauses), pos
+
+def _parse_unary(tokens, pos):
+    kind, value = tokens[pos]
+    if kind == u'-':
+        if pos + 1 >= len(tokens):
+            raise ValueError(u'Nothing to negate in rule')
+        clause, pos = _parse_unary(tokens, pos + 1)
+        return _Not(clause), pos
+    if kind == u'(':
+        clause, pos = _parse_or(tokens, pos + 1)
+        if pos >= len(tokens) or tokens[pos][0] != u')':
+            raise ValueError(u'Unbalanced parentheses in rule')
+        return clause, pos + 1
+    if kind == u'from':
+        return _From(value), pos + 1
+    if kind == u'url_contains':
+        return _UrlContains(value), pos + 1
+    if kind == u'has':
+        if value != u'links':
+            raise ValueError(u'Unsupported operator: has:{0}'.format(value))
+        return _HasLinks(), pos + 1
+    words = POWERTRACK_TOKEN_RE.findall(value.lower())
+    if not words:
+        raise ValueError(u'Nothing to match in: {0}'.format(value))
+    return _Keyword(words), pos + 1
+
+def parse_powertrack_rule(rule):
+    """Parse one PowerTrack rule into a tree of clauses
+        Raises ValueError if the rule can't be parsed
+    """
+    rule = to_unicode(rule)
+    tokens = _lex_powertrack(rule)
+    if not tokens:
+        raise ValueError(u'Empty rule')
+    clause, pos = _parse_or(tokens, 0)
+    if pos != len(tokens):
+        raise ValueError(u'Unbalanced parentheses in rule: {0}'.format(rule))
+    return clause
+
+class PowerTrackRules(object):
+    """Gnip PowerTrack rules compiled into an evaluation plan
+
+        Supports keywords, "quoted phrases", OR, negation,
+        parentheses, from:, has:links and url_contains:
+        Within each rule the cheap field checks run before
+        any text scan and evaluation stops as soon as the
+        outcome is known. Drop-in for RuleMatcher.
+    """
+    def __init__(self, rules):
+        self.rules = [to_unicode(rule) for rule in rules]
+        self.values = frozenset(self.rules)
+        self.plan = sorted([parse_powertrack_rule(rule) for rule in self.rules],
+                           key=lambda clause: clause.cost)
+        # Lowercase substrings a matching tweet must contain
+        self.literals = _union_literals(self.plan)
+        self.case_sensitive = False
+
+    def __len__(self):
+        return len(self.rules)
+
+    def matches(self, tweet):
+        """Return True if any rule matches tweet
+            Works with native and Activity Streams tweets
+        """
+        ctx = _RuleContext(tweet)
+        for clause in self.plan:
+            if clause.match(ctx):
+                return True
+        return False
+
+    matches_native = matches
+
+
+#
+# Raw line prefilter
+#   Rejects JSON lines that can't match before paying for json.loads
+#
+
+# String values that rules are matched against
+RAW_MATCH_FIELD_RE = re.compile(r'"(?:text|body|url|expanded_url)"\s*:\s*"([^"\\]*(?:\\.[^"\\]*)*)"')
+# Values of the Gnip matching_rules
+RAW_RULE_VALUE_RE = re.compile(r'"value"\s*:\s*"([^"\\]*(?:\\.[^"\\]*)*)"')
+
+def raw_json_string(raw):
+    """Decode the contents of a JSON string literal
+    """
+    if '\\' in raw:
+        try:
+            return json.loads(u'"{0}"'.format(to_unicode(raw)))
+        except ValueError:
+            pass
+    return to_unicode(raw)
+
+class RawPrefilter(object):
+    """Cheap checks on a raw JSON line so only lines
+        that can possibly pass get decoded
+
+        rules : RuleMatcher, PowerTrackRules or None
+        keys  : the line must contain at least one of these keys
+
+        Never rejects a line that the full checks would keep:
+        Gnip lines are checked against their matching_rules,
+        native lines against the text and URL fields.
+    """
+    def __init__(self, rules=None, keys=()):
+        if rules and not hasattr(rules, 'matches_native'):
+            rules = RuleMatcher(rules)
+        self.rules = rules
+        self.keys = tuple('"{0}"'.format(key) for key in keys)
+        self._matcher = None
+        self._case_sensitive = True
+        if rules:
+            literals = getattr(rules, 'literals', None)
+            if literals is not None:
+                self._matcher = RuleMatcher(literals)
+                self._case_sensitive = rules.case_sensitive
+
+    def has_keys(self, line):
+        """False if line lacks all of the required keys
+        """
+        if not self.keys:
+            return True
+        for key in self.keys:
+            if key in line:
+                return True
+        return False
+
+    def may_match(self, line):
+        """False if line can't match the rules
+        """
+        if not self.rules:
+            return True
+        if '"gnip"' in line:
+            if not '"matching_rules"' in line:
+                return True
+            values = self.rules.values
+            for raw in RAW_RULE_VALUE_RE.findall(line):
+                if raw_json_string(raw) in values:
+                    return True
+            return False
+        if self._matcher is None:
+            # Some rule needs no text at all (e.g. only from:)
+            return True
+        for raw in RAW_MATCH_FIELD_RE.findall(line):
+            value = raw_json_string(raw)
+            if not self._case_sensitive:
+                value = value.lower()
+            if self._matcher.search(value):
+                return True
+        return False
+
+    def accepts(self, line):
+        return self.has_keys(line) and self.may_match(line)
 
 #
 # String utilities 
@@ -240,6 +800,13 @@ def force_utf8(s):
         raise
     return s_utf8
 
+def to_unicode(s):
+    """Return s as unicode, decoding UTF-8 bytes if needed
+    """
+    if isinstance(s, str):
+        return s.decode('utf-8', 'replace')
+    return s
+
 def force_ascii(s):
     """Return string s encoded with ASCII
        Non-ASCII chars replaced with _
@@ -264,53 +831,669 @@ def dumb_csv_row(seq):
 # URLs
 #
 
+def url_parts(url):
+    """Return (host, path, query) of url
+        host is lowercase without a trailing dot
+        Returns (u'', u'', u'') if there isn't a host
+    """
+    if not url:
+        return (u'', u'', u'')
+    try:
+        parts = urlsplit(clean_url(url))
+        host = parts.hostname
+    except ValueError:
+        return (u'', u'', u'')
+    if not host:
+        return (u'', u'', u'')
+    return (host.rstrip('.'), parts.path, parts.query)
+
+# YouTube URLs come in a few forms:
+#   youtube.com/v/{vidid}, /vi/{vidid}, /embed/{vidid}
+#   youtube.com/watch?v={vidid}, /?v={vidid} (or vi=), params in any order
+#   youtu.be/{vidid}
+# on any subdomain (www., m.)
+YOUTUBE_ID_PATHS = (u'/v/', u'/vi/', u'/embed/')
+YOUTUBE_WATCH_PATHS = frozenset([u'', u'/', u'/watch'])
+
+def _youtube_id(s):
+    m = YOUTUBE_ID_RE.match(s)
+    if m:
+        return m.group(0)
+    return ''
+
+def _youtube_com_id(path, query):
+    for prefix in YOUTUBE_ID_PATHS:
+        if path.startswith(prefix):
+            return _youtube_id(path[len(prefix):])
+    if path in YOUTUBE_WATCH_PATHS:
+        for param in query.split('&'):
+            # Tweet bodies escape & as &amp;
+            if param.startswith('amp;'):
+                param = param[4:]
+            if param.startswith('v='):
+                ytid = _youtube_id(param[2:])
+            elif param.startswith('vi='):
+                ytid = _youtube_id(param[3:])
+            else:
+                continue
+            if ytid:
+                return ytid
+    return ''
+
+def _youtu_be_id(path, query):
+    return _youtube_id(path[1:])
+
+# Which function finds the video ID for each YouTube host
+YOUTUBE_ID_HOSTS = {
+    u'youtube.com': _youtube_com_id,
+    u'youtube-nocookie.com': _youtube_com_id,
+    u'youtu.be': _youtu_be_id,
+}
+
+def youtube_id_from_parts(host, path, query):
+    """Return the YouTube ID of a URL split by url_parts
+        or '' if it isn't a link to a YouTube video
+    """
+    while host:
+        parse = YOUTUBE_ID_HOSTS.get(host)
+        if parse is not None:
+            return parse(path, query)
+        dot = host.find('.')
+        if dot < 0:
+            break
+        host = host[dot + 1:]
+    return ''
+
 def parse_youtube_id(url):
     """Parse a URL in search of a YouTube ID
         Returns str with YT ID or '' if not found
     """
-    ytid = ''
-    for regex in re_youtube_id:
-        m = regex.search(url)
-        if m:
-            ytid = m.group(1)
-            break
-    return ytid
+    if not url or not YOUTUBE_HINT_RE.search(url):
+        return ''
+    return youtube_id_from_parts(*url_parts(url))
+
+def parse_youtube_ids(urls):
+    """Return a list with the parse_youtube_id of each of urls
+        Repeated URLs are only parsed once
+    """
+    seen = {}
+    ids = []
+    for url in urls:
+        ytid = seen.get(url)
+        if ytid is None:
+            ytid = seen[url] = parse_youtube_id(url)
+        ids.append(ytid)
+    return ids
 
 def extract_domain(url):
-    """Try to extract domain and TLD from url
-        Returns empty str if not found
+    """Try to extract the registrable domain from url
+        (bbc.co.uk from news.bbc.co.uk/...)
+        Returns None if not found
     """
-    if url:
-        url = clean_url(url)
-        urlparts = urlsplit(url)
-        try:
-            domain = '.'.join(urlparts.hostname.rsplit('.',2)[-2:]) 
-        except AttributeError:
-            domain = None
-        return domain
-    else:
-        return None
+    return default_domain_extractor().domain(url)
 
 def clean_url(url):
     """Return with http:// added if neccessary
     """
     # Sometimes urls don't include http(s)
-    if not (url[0:4] == 'http'):
+    if not (url[0:4].lower() == 'http'):
         url = 'http://'+url
     return url.strip()
 
-def lengthen(shorturl):
+#
+# Finding URLs in text
+#   Same rules as John Gruber's pattern
+#   http://daringfireball.net/2010/07/improved_regex_for_matching_urls
+#   but in one pass, so no tweet can make it backtrack for minutes
+#
+
+def _url_paren_end(s, i, n):
+    """End of the parenthesized group opening at s[i]
+        or 0 if it doesn't close. Groups nest one level deep
+        and inner groups can't be empty, as in Gruber's pattern.
+    """
+    j = i + 1
+    while j < n:
+        c = s[j]
+        if c == ')':
+            return j + 1
+        if c == '(':
+            k = j + 1
+            while k < n and s[k] not in '()':
+                k += 1
+            if k == j + 1 or k == n or s[k] == '(':
+                return 0
+            j = k
+        j += 1
+    return 0
+
+def _chunk_urls(s, urls):
+    """Append the URLs in s, which has no whitespace or <>, to urls
+    """
+    n = len(s)
+    # A URL is a start (scheme:, www. or domain.tld/) followed by
+    # atoms: single characters other than parens, or balanced
+    # groups. It ends with the last atom that isn't trailing
+    # punctuation, and needs at least two atoms after its start.
+    if '(' in s or ')' in s:
+        # atom_end[p] is where the atom at p ends, 0 if none starts
+        # there. last_end[p] is the end of the last atom, from p
+        # on, that a URL may finish with
+        atom_end = [0] * (n + 1)
+        for p in xrange(n):
+            c = s[p]
+            if c == '(':
+                atom_end[p] = _url_paren_end(s, p, n)
+            elif c != ')':
+                atom_end[p] = p + 1
+        last_end = [0] * (n + 1)
+        for p in xrange(n - 1, -1, -1):
+            e = atom_end[p]
+            if e:
+                if last_end[e]:
+                    last_end[p] = last_end[e]
+                elif s[p] not in URL_TRAILING_PUNCT or s[p] == '(':
+                    last_end[p] = e
+        def tail(e):
+            if e < n and atom_end[e]:
+                return last_end[atom_end[e]]
+            return 0
+    else:
+        # Every character is an atom
+        last = len(s.rstrip(URL_TRAILING_PUNCT_STR))
+        def tail(e):
+            if last >= e + 2:
+                return last
+            return 0
+
+    # Where runs of scheme characters and domain characters end
+    scheme_end = range(n + 1)
+    for m in URL_SCHEME_RUN_RE.finditer(s):
+        a, b = m.span()
+        scheme_end[a:b] = [b] * (b - a)
+    domain_end = range(n + 1)
+    for m in URL_DOMAIN_RUN_RE.finditer(s):
+        a, b = m.span()
+        domain_end[a:b] = [b] * (b - a)
+
+    def match_at(i):
+        c = s[i]
+        # scheme: then 1-3 slashes or a letter, digit or %
+        if c in URL_ALPHA:
+            colon = scheme_end[i]
+            if colon > i + 1 and colon < n - 1 and s[colon] == ':':
+                after = s[colon + 1]
+                if after == '/':
+                    slashes = 1
+                    while slashes < 3 and colon + 1 + slashes < n and s[colon + 1 + slashes] == '/':
+                        slashes += 1
+                    for k in xrange(slashes, 0, -1):
+                        end = tail(colon + 1 + k)
+                        if end:
+                            return end
+                elif after in URL_ALNUM or after == '%':
+                    end = tail(colon + 2)
+                    if end:
+                        return end
+        # www, up to 3 digits and a dot
+        if c in 'wW':
+            m = URL_WWW_RE.match(s, i)
+            if m:
+                end = tail(m.end())
+                if end:
+                    return end
+        # domain.tld/ with a 2-4 letter tld
+        slash = domain_end[i]
+        if slash > i and slash < n and s[slash] == '/':
+            letters = 0
+            while (letters < 5 and slash - 1 - letters > i and
+                   s[slash - 1 - letters] in URL_ALPHA):
+                letters += 1
+            dot = slash - 1 - letters
+            if 2 <= letters <= 4 and dot > i and s[dot] == '.':
+                end = tail(slash + 1)
+                if end:
+                    return end
+        return 0
+
+    # Only at word boundaries
+    end = 0
+    for m in URL_BOUNDARY_RE.finditer(s):
+        i = m.start()
+        if i < end or i == n:
+            continue
+        found = match_at(i)
+        if found:
+            urls.append(s[i:found])
+            end = found
+
+def extract_urls(text):
+    """Return a list of the URLs found in text
+        Takes time in proportion to the length of text
+    """
+    urls = []
+    if not text:
+        return urls
+    for m in URL_CHUNK_RE.finditer(text):
+        chunk = m.group()
+        if URL_HINT_RE.search(chunk):
+            _chunk_urls(chunk, urls)
+    return urls
+
+def tweet_urls(tweet):
+    """Return the URLs in a native or Activity Streams tweet
+        Prefers the expanded_url Twitter provides
+        If the tweet has no URL entities at all, the URLs
+        are recovered from its text with extract_urls
+    """
+    entities = tweet.get('twitter_entities')
+    if entities is None:
+        entities = tweet.get('entities')
+    if entities is not None and 'urls' in entities:
+        urls = []
+        for u in entities['urls']:
+            if u.get('expanded_url'):
+                urls.append(u['expanded_url'])
+            elif u.get('url'):
+                urls.append(u['url'])
+        return urls
+    return extract_urls(tweet.get('body') or tweet.get('text'))
+
+#
+# Canonical URLs
+#   Different spellings of one URL share one cache entry
+#
+
+# Query parameters that only say where a click came from
+TRACKING_PARAMS = frozenset([
+    'fb_action_ids', 'fb_action_types', 'fb_source', 'fbclid',
+    'gclid', 'mc_cid', 'mc_eid', 'ncid', 'cmpid', 'dlvrit',
+    'ocid', 'smid', 'wt.mc_id', 'xtor', '_r', 'hootpostid',
+])
+TRACKING_PARAM_PREFIXES = ('utm_',)
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+class URLCanonicalizer(object):
+    """Rewrites equivalent spellings of a URL to one form
+
+        canonicalize(url) is still the same resource: scheme and
+        host lowercased, default port, userinfo and fragment dropped,
+        tracking parameters removed, empty path made '/'. A '#!'
+        fragment is kept since it is the page (old twitter.com/#!/...
+        links). The lengtheners use it only to compare URLs; they
+        request and report URLs as they were found.
+
+        key(url) goes further for cache and dedup keys: optionally
+        http and https, www. and bare hosts, and trailing slashes are
+        folded together and the query parameters sorted.
+
+        tracking_params, tracking_prefixes : query parameters to drop
+        rules : extra functions applied to each canonical URL
+    """
+    def __init__(self, tracking_params=TRACKING_PARAMS,
+                       tracking_prefixes=TRACKING_PARAM_PREFIXES,
+                       fold_scheme=True,
+                       fold_www=True,
+                       fold_trailing_slash=True,
+                       sort_query=True,
+                       rules=()):
+        self.tracking_params = frozenset(p.lower() for p in tracking_params)
+        self.tracking_prefixes = tuple(tracking_prefixes)
+        self.fold_scheme = fold_scheme
+        self.fold_www = fold_www
+        self.fold_trailing_slash = fold_trailing_slash
+        self.sort_query = sort_query
+        self.rules = list(rules)
+
+    def _tracking(self, param):
+        name = param.split('=', 1)[0].lower()
+        return (name in self.tracking_params or
+                name.startswith(self.tracking_prefixes))
+
+    def canonicalize(self, url):
+        """Return the canonical spelling of url
+            URLs that can't be parsed come back as they are
+        """
+        if not url:
+            return url
+        url = clean_url(url)
+        try:
+            parts = urlsplit(url)
+            port = parts.port
+        except ValueError:
+            return url
+        scheme = parts.scheme.lower()
+        host = parts.hostname
+        if not host:
+            return url
+        netloc = host.rstrip('.')
+        if ':' in netloc:
+            netloc = '[' + netloc + ']'
+        if port and port != DEFAULT_PORTS.get(scheme):
+            netloc += ':' + str(port)
+        query = parts.query
+        if query:
+            query = '&'.join(p for p in query.split('&')
+                             if p and not self._tracking(p))
+        fragment = parts.fragment
+        if not fragment.startswith('!'):
+            fragment = ''
+        url = urlunsplit((scheme, netloc, parts.path or '/', query, fragment))
+        for rule in self.rules:
+            url = rule(url)
+        return url
+
+    def key(self, url):
+        """Return the key under which url is cached and deduplicated
+        """
+        url = self.canonicalize(url)
+        if not url:
+            return url
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        if self.fold_scheme and scheme == 'https':
+            scheme = 'http'
+        if self.fold_www and netloc.startswith('www.'):
+            netloc = netloc[4:]
+        if self.fold_trailing_slash and len(path) > 1:
+            path = path.rstrip('/') or '/'
+        if self.sort_query and query:
+            query = '&'.join(sorted(query.split('&')))
+        return urlunsplit((scheme, netloc, path, query, fragment))
+
+_default_canonicalizer = None
+
+def default_canonicalizer():
+    """Return the URLCanonicalizer with the default rules
+    """
+    global _default_canonicalizer
+    if _default_canonicalizer is None:
+        _default_canonicalizer = URLCanonicalizer()
+    return _default_canonicalizer
+
+def canonicalize_url(url):
+    """Return url in canonical form using the default rules
+    """
+    return default_canonicalizer().canonicalize(url)
+
+def url_key(url):
+    """Return the cache and dedup key of url using the default rules
+    """
+    return default_canonicalizer().key(url)
+
+#
+# Registrable domains
+#   bbc.co.uk, not co.uk: the public suffix of a host
+#   plus one more label, found by walking a suffix trie
+#
+
+# Bundled public suffix rules, kept next to this module
+PUBLIC_SUFFIXES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    'public_suffixes.txt')
+# Hosts remembered by a DomainExtractor
+DOMAIN_CACHE_SIZE = 100000
+# Host part of the usual http(s) URL, without a full urlsplit
+NETLOC_RE = re.compile(r'(?i)https?://([^/?#]*)')
+
+# Marks on the nodes of a suffix trie, under the key ''
+SUFFIX_RULE = 1
+SUFFIX_EXCEPTION = 2
+
+def load_public_suffixes(path=PUBLIC_SUFFIXES_PATH):
+    """Return a trie of the rules in a Public Suffix List file
+        Each node is a dict from label to child, read from the
+        right, marked with SUFFIX_RULE or SUFFIX_EXCEPTION
+        under '' where a rule ends
+    """
+    trie = {}
+    with codecs.open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('//'):
+                continue
+            rule = line.split()[0].lower()
+            mark = SUFFIX_RULE
+            if rule.startswith('!'):
+                rule = rule[1:]
+                mark = SUFFIX_EXCEPTION
+            node = trie
+            for label in reversed(rule.split('.')):
+                node = node.setdefault(label, {})
+            node[''] = mark
+    return trie
+
+class DomainExtractor(object):
+    """Finds the registrable domain of hosts and URLs
+
+        suffixes : trie from load_public_suffixes (bundled list if None)
+        cache_size : hosts whose domain is remembered
+        Domains are handed out from the cache, so a histogram
+        over millions of URLs holds one copy of each.
+    """
+    def __init__(self, suffixes=None, cache_size=DOMAIN_CACHE_SIZE):
+        if suffixes is None:
+            suffixes = load_public_suffixes()
+        self.suffixes = suffixes
+        self._cache = LRUCache(cache_size)
+
+    def suffix_labels(self, labels):
+        """Number of labels at the end of labels that are a public suffix
+        """
+        node = self.suffixes
+        # Default rule: the TLD
+        found = 1
+        depth = 0
+        for label in reversed(labels):
+            depth += 1
+            child = node.get(label)
+            if child is None:
+                if '*' in node:
+                    found = depth
+                break
+            mark = child.get('')
+            if mark == SUFFIX_EXCEPTION:
+                found = depth - 1
+                break
+            if mark == SUFFIX_RULE or '*' in node:
+                found = depth
+            node = child
+        return found
+
+    def registrable_domain(self, host):
+        """Return the public suffix of host plus one label
+            Hosts that are public suffixes or IP addresses
+            come back as they are
+        """
+        if not host:
+            return host
+        labels = host.split('.')
+        if labels[-1].isdigit() or ':' in host:
+            return host
+        suffix = self.suffix_labels(labels)
+        if suffix >= len(labels):
+            return host
+        return '.'.join(labels[-suffix - 1:])
+
+    def domain(self, url):
+        """Return the registrable domain of url
+            or None if there isn't one
+        """
+        if not url:
+            return None
+        host = None
+        m = NETLOC_RE.match(url)
+        if m is not None and '[' not in m.group(1):
+            netloc = m.group(1)
+        else:
+            # No scheme, or an IPv6 address
+            netloc = host = url_host(url)
+        domain = self._cache.get(netloc)
+        if domain is None:
+            if host is None:
+                host = netloc.rpartition('@')[2].partition(':')[0].lower().rstrip('.')
+            if not host:
+                return None
+            domain = self.registrable_domain(host)
+            # One copy of each domain
+            domain = self._cache.get(domain, domain)
+            self._cache.set(domain, domain)
+            self._cache.set(netloc, domain)
+        return domain
+
+    def domains(self, urls):
+        """Return a list with the domain of each of urls
+        """
+        domain = self.domain
+        return [domain(url) for url in urls]
+
+_default_domain_extractor = None
+
+def default_domain_extractor():
+    """Return the DomainExtractor for the bundled suffixes
+        Loaded on first use
+    """
+    global _default_domain_extractor
+    if _default_domain_extractor is None:
+        _default_domain_extractor = DomainExtractor()
+    return _default_domain_extractor
+
+def extract_domains(urls):
+    """Return a list with the registrable domain of each of urls
+        (None where there isn't one)
+    """
+    return default_domain_extractor().domains(urls)
+
+#
+# Classifying URLs
+#   Decides without any I/O whether a URL is worth resolving
+#
+
+# Bundled list of shortener hosts, kept next to this module
+SHORTENERS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'shorteners.txt')
+
+# What classify returns
+URL_YOUTUBE = 'youtube'
+URL_SHORT = 'short'
+URL_LONG = 'long'
+
+def load_shorteners(path=SHORTENERS_PATH):
+    """Return frozenset of hosts listed in path
+        Blank lines and # comments are skipped
+    """
+    hosts = set()
+    with codecs.open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip().lower()
+            if line:
+                hosts.add(line)
+    return frozenset(hosts)
+
+def save_shorteners(hosts, path=SHORTENERS_PATH):
+    """Write hosts to path, one per line, for load_shorteners
+    """
+    with codecs.open(path, 'w', encoding='utf-8') as f:
+        f.write(u'# Hosts whose links are worth resolving\n')
+        for host in sorted(set(h.lower() for h in hosts)):
+            f.write(host)
+            f.write(u'\n')
+
+def url_host(url):
+    """Return lowercase host of url without a trailing dot
+        Returns u'' if there isn't one
+    """
+    return url_parts(url)[0]
+
+class ShortenerClassifier(object):
+    """Sorts URLs into YouTube links, short links worth resolving
+        and links that are already long, all in memory
+
+        hosts : shortener hosts, read from SHORTENERS_PATH if None
+        A host matches if it or any parent domain is listed,
+        so www.bit.ly counts as bit.ly.
+    """
+    def __init__(self, hosts=None):
+        if hosts is None:
+            hosts = load_shorteners()
+        self.hosts = frozenset(h.lower() for h in hosts)
+
+    def update(self, hosts):
+        """Add hosts to the set of shorteners
+        """
+        self.hosts = self.hosts.union(h.lower() for h in hosts)
+
+    def _listed(self, host, hosts):
+        while host:
+            if host in hosts:
+                return True
+            dot = host.find('.')
+            if dot < 0:
+                return False
+            host = host[dot + 1:]
+        return False
+
+    def is_shortener(self, url):
+        return self._listed(url_host(url), self.hosts)
+
+    def classify(self, url):
+        """Return URL_YOUTUBE, URL_SHORT or URL_LONG for url
+        """
+        return self.classify_youtube(url)[0]
+
+    def classify_youtube(self, url):
+        """Return (kind, youtube_id) for url, splitting it only once
+            youtube_id is '' unless kind is URL_YOUTUBE
+        """
+        host, path, query = url_parts(url)
+        ytid = youtube_id_from_parts(host, path, query)
+        if ytid:
+            return URL_YOUTUBE, ytid
+        if self._listed(host, self.hosts):
+            return URL_SHORT, ''
+        return URL_LONG, ''
+
+_default_classifier = None
+
+def default_classifier():
+    """Return the ShortenerClassifier for the bundled list
+        Loaded on first use
+    """
+    global _default_classifier
+    if _default_classifier is None:
+        _default_classifier = ShortenerClassifier()
+    return _default_classifier
+
+def classify_url(url):
+    """Return URL_YOUTUBE, URL_SHORT or URL_LONG for url
+        using the bundled list of shorteners
+    """
+    return default_classifier().classify(url)
+
+def lengthen(shorturl, cache=None, classifier=None):
     """ Lengthen a shortened URL
         shorturl : string containing a shortened URL
+        cache : optional URLCache to check before going to the network
+        classifier : ShortenerClassifier, bundled list if None;
+                     URLs on other hosts are returned as they are
         Returns longurl as unicode string
     """
+    if classifier is None:
+        classifier = default_classifier()
+    if not classifier.is_shortener(shorturl):
+        return to_unicode(shorturl)
+    if cache is not None:
+        entry = cache.get(shorturl)
+        if entry is not None:
+            return entry.longurl
     longurl = shorturl
+    status = None
     # Try to resolve the URL over the network
     # TODO this takes a long time, must be a better way?
     # Looks like some good ideas here:
     # http://stackoverflow.com/questions/316866/ping-a-site-in-python
     try:
         u = urllib2.urlopen(shorturl, timeout=LENGTHEN_TIMEOUT)
+        status = u.getcode()
         encoding = 'utf-8'
         if 'content-type' in u.headers.keys():
             if (u.headers['content-type'].find('charset') > -1):
@@ -324,40 +1507,309 @@ def lengthen(shorturl):
         except LookupError:
             # Unknown encoding
             longurl = u'Unknown encoding.'
+            status = 'LookupError'
     except UnicodeDecodeError, e:
         error_log(u'UnicodeDecodeError trying to lengthen this URL: {0}'.format(shorturl))
         error_log(unicode(e))
         longurl = unicode(e)
+        status = 'UnicodeDecodeError'
     except UnicodeEncodeError, e:
         error_log(u'UnicodeEncodeError trying to lengthen this URL: {0}'.format(shorturl))
         error_log(unicode(e))
         longurl = unicode(e)
+        status = 'UnicodeEncodeError'
     except urllib2.URLError, e:
         error_log(u'urllib2.URLError trying to lengthen this URL: {0}'.format(shorturl))
         error_log(unicode(e))
         longurl = unicode(e)
+        status = getattr(e, 'code', 'URLError')
     except socket.timeout:
         # Found out about this weird bug the hard way
         # http://heyman.info/2010/apr/22/python-urllib2-timeout-issue/
         error_log(u'socket.timeout error trying to lengthen this URL: {0}'.format(shorturl))
         error_log(u'Socket timed out.')
         longurl = u'Socket timed out.'
+        status = 'timeout'
     except httplib.InvalidURL:
         # This happened once with:
         # http://www.http.com//motherboard.tv/2011/11/18/who-smashed-the-laptops-from-occupy-wall-street-inside-the-nypd-s-lost-and-found
         error_log(u'httplib.InvalidURL trying to lengthen this URL: {0}'.format(shorturl))
         longurl = u'Invalid URL.'
+        status = 'InvalidURL'
     except httplib.BadStatusLine:
         # This happened once with:
         # http://www.feministas.org/spip.php?article230
         error_log(u'Error trying to lengthen this URL: {0}'.format(shorturl))
         longurl = u'BadStatusLine.'
+        status = 'BadStatusLine'
+    if cache is not None:
+        if is_failure(status):
+            cache.put(shorturl, longurl, [shorturl], status)
+        else:
+            cache.put(shorturl, longurl, [shorturl, longurl], status)
     return longurl
 
+
+#
+# Caching resolved URLs
+#   so re-runs over the same corpus stay off the network
+#
+
+# Default location of the on-disk cache
+URL_CACHE_PATH = 'url_cache.sqlite'
+# Resolved URLs are trusted for 30 days
+URL_CACHE_TTL = 30 * 24 * 60 * 60
+# Dead links and errors are retried after a day
+URL_CACHE_NEGATIVE_TTL = 24 * 60 * 60
+# Entries kept in memory in front of the database
+URL_CACHE_LRU_SIZE = 100000
+
+URLCacheEntry = namedtuple('URLCacheEntry', 'longurl hops status resolved')
+
+def is_failure(status):
+    """True if status (HTTP code or error name) means the URL didn't resolve
+    """
+    if isinstance(status, (int, long)):
+        return status >= 400
+    return True
+
+class LRUCache(object):
+    """Dict that forgets its least recently used keys
+        once it holds more than maxsize of them
+
+        Recency is kept CLOCK style: get() marks a key used and
+        eviction sweeps the keys oldest first, sparing (and
+        unmarking) the used ones. A hit is a dict lookup instead
+        of a reordering, so it is cheap enough for memoizing
+        small parsers.
+
+        Safe to share between threads: set() and clear() take a
+        lock, get() doesn't need one (marking a key used is a
+        single store).
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        # key: [value, used since the last sweep]
+        self._data = {}
+        self._clock = deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        entry[1] = True
+        return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                entry[0] = value
+                entry[1] = True
+                return
+            self._data[key] = [value, False]
+            self._clock.append(key)
+            while len(self._data) > self.maxsize:
+                oldest = self._clock.popleft()
+                entry = self._data[oldest]
+                if entry[1]:
+                    entry[1] = False
+                    self._clock.append(oldest)
+                else:
+                    del self._data[oldest]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._clock.clear()
+
+class URLCache(object):
+    """Persistent cache of short URL resolutions
+
+        Backed by a sqlite file keyed by canonical short URL with the
+        final URL, the full hop chain, the status (HTTP code
+        or error name) and when it was resolved. Failures are
+        cached too but expire sooner. An LRU sits in front.
+        Safe to share between threads.
+
+        path : sqlite file, or ':memory:' for a per-process cache
+        canonicalizer : URLCanonicalizer whose key() the short
+                        URLs are stored under (default rules if None)
+    """
+    def __init__(self, path=URL_CACHE_PATH,
+                       ttl=URL_CACHE_TTL,
+                       negative_ttl=URL_CACHE_NEGATIVE_TTL,
+                       lru_size=URL_CACHE_LRU_SIZE,
+                       commit_every=500,
+                       canonicalizer=None):
+        self.path = path
+        if canonicalizer is None:
+            canonicalizer = default_canonicalizer()
+        self.canonicalizer = canonicalizer
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.commit_every = commit_every
+        self._lru = LRUCache(lru_size)
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS urls ('
+                         'short TEXT PRIMARY KEY, '
+                         'long TEXT, '
+                         'hops TEXT, '
+                         'status, '
+                         'resolved REAL)')
+        self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM urls').fetchone()[0]
+
+    def _expired(self, entry, now):
+        if is_failure(entry.status):
+            ttl = self.negative_ttl
+        else:
+            ttl = self.ttl
+        return (now - entry.resolved) > ttl
+
+    def get(self, shorturl):
+        """Return URLCacheEntry for shorturl
+            or None if it is unknown or expired
+        """
+        key = self.canonicalizer.key(shorturl)
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is None:
+                row = self._db.execute('SELECT long, hops, status, resolved '
+                                       'FROM urls WHERE short = ?',
+                                       (key,)).fetchone()
+                if row is None:
+                    return None
+                entry = URLCacheEntry(row[0], json.loads(row[1]), row[2], row[3])
+                self._lru.set(key, entry)
+        if self._expired(entry, time()):
+            return None
+        return entry
+
+    def put(self, shorturl, longurl, hops=None, status=None):
+        """Record that shorturl resolved to longurl
+            hops : every URL visited, starting with shorturl
+            status : final HTTP code or name of the error
+        """
+        if hops is None:
+            hops = [shorturl, longurl]
+        key = self.canonicalizer.key(shorturl)
+        entry = URLCacheEntry(longurl, list(hops), status, time())
+        with self._lock:
+            self._lru.set(key, entry)
+            self._db.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?, ?)',
+                             (key, longurl, json.dumps(entry.hops),
+                              status, entry.resolved))
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every:
+                self._db.commit()
+                self._uncommitted = 0
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+            self._uncommitted = 0
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+#
+# Low-cardinality strings
+#   Generators, languages and time zones come in a few thousand
+#   values across millions of tweets: parse each value once and
+#   share one copy of it
+#
+
+# Distinct values remembered per field
+LOW_CARDINALITY_CACHE_SIZE = 50000
+
+class StringInterner(object):
+    """Hands back one shared copy of each distinct string
+        Call it on a string; falsy values come back as they are
+    """
+    def __init__(self, maxsize=LOW_CARDINALITY_CACHE_SIZE):
+        self._cache = LRUCache(maxsize)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __call__(self, s):
+        if not s:
+            return s
+        shared = self._cache.get(s)
+        if shared is None:
+            self._cache.set(s, s)
+            shared = s
+        return shared
+
+intern_generator = StringInterner()
+intern_language = StringInterner()
+intern_time_zone = StringInterner()
+intern_url = StringInterner()
+
+# Raw source HTML: (name, url) from extract_source
+_source_cache = LRUCache(LOW_CARDINALITY_CACHE_SIZE)
+
 #
 # Dates and times
+#   Tweets come in time order and users tweet again and again,
+#   so the same timestamps turn up over and over: each parser
+#   slices its fixed format apart and remembers what it found
 #
 
+# Timestamps remembered by each parser
+TIMESTAMP_CACHE_SIZE = 20000
+
+MONTH_NUMBERS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+                 'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+
+_created_at_cache = LRUCache(TIMESTAMP_CACHE_SIZE)
+_postedTime_cache = LRUCache(TIMESTAMP_CACHE_SIZE)
+_iso8601_cache = LRUCache(TIMESTAMP_CACHE_SIZE)
+_epoch_cache = LRUCache(TIMESTAMP_CACHE_SIZE)
+
+def created_at_fields(created_at):
+    """Return (year, month, day, hour, minute, second) from
+        'Wed May 23 06:01:13 +0000 2007' (GNIP_DATETIME_FORMAT)
+        or None if it isn't laid out exactly like that
+    """
+    month = MONTH_NUMBERS.get(created_at[4:7])
+    if month and len(created_at) == 30 and created_at[19] == ' ' and created_at[25] == ' ':
+        try:
+            return (int(created_at[26:30]), month, int(created_at[8:10]),
+                    int(created_at[11:13]), int(created_at[14:16]), int(created_at[17:19]))
+        except ValueError:
+            pass
+    return None
+
+def rfc2822_fields(timestamp):
+    """Return (year, month, day, hour, minute, second) from
+        'Wed, 23 May 2007 06:01:13 +0000' (TWITTER_DATETIME_FORMAT)
+        or None if it isn't laid out exactly like that
+    """
+    month = MONTH_NUMBERS.get(timestamp[8:11])
+    if month and len(timestamp) == 31 and timestamp[25] == ' ':
+        try:
+            return (int(timestamp[12:16]), month, int(timestamp[5:7]),
+                    int(timestamp[17:19]), int(timestamp[20:22]), int(timestamp[23:25]))
+        except ValueError:
+            pass
+    return None
+
 def rfc2822_to_iso8601(time_str):
     """Converts a timestamp string from RFC 2822 format to ISO 8601.
 
@@ -370,16 +1822,21 @@ def rfc2822_to_iso8601(time_str):
     if not time_str:
       return None
 
-    without_timezone = re.sub(' [+-][0-9]{4} ', ' ', time_str)
-    dt = datetime.datetime.strptime(without_timezone, '%a %b %d %H:%M:%S %Y')
-    return dt.isoformat()
+    iso = _iso8601_cache.get(time_str)
+    if iso is None:
+        iso = from_created_at(time_str).isoformat()
+        _iso8601_cache.set(time_str, iso)
+    return iso
 
 def extract_datetime(tweet):
     """ Try to identify the datetime that the tweet was posted
         and returns it as a datetime obj
 
         Works with Activity Streams as well as native Twitter objects
+        and TweetRecords
     """
+    if isinstance(tweet, TweetRecord):
+        return tweet.posted_datetime()
     if 'created_at' in tweet:
         return from_created_at(tweet.get('created_at'))
     elif 'postedTime' in tweet:
@@ -394,20 +1851,34 @@ def from_created_at(created_at):
       'Wed May 23 06:01:13 +0000 2007'
 
     """
-    without_timezone = re.sub(' [+-][0-9]{4} ', ' ', created_at)
-    return datetime.datetime.strptime(without_timezone, '%a %b %d %H:%M:%S %Y')
+    dt = _created_at_cache.get(created_at)
+    if dt is None:
+        fields = created_at_fields(created_at)
+        if fields is not None:
+            dt = datetime.datetime(*fields)
+        else:
+            without_timezone = re.sub(' [+-][0-9]{4} ', ' ', created_at)
+            dt = datetime.datetime.strptime(without_timezone, '%a %b %d %H:%M:%S %Y')
+        _created_at_cache.set(created_at, dt)
+    return dt
 
 def from_postedTime(postedTime):
     """Convert date an ISO formatted strings to Python datetime objects
         Note: this is much faster than parsing the string
                 but requires strictly formatted input.
     """
-    return datetime.datetime(int(postedTime[:4]),
-                             int(postedTime[5:7]),
-                             int(postedTime[8:10]),
-                             int(postedTime[11:13]),
-                             int(postedTime[14:16]),
-                             int(postedTime[17:19]))
+    # Milliseconds are dropped anyway
+    key = postedTime[:19]
+    dt = _postedTime_cache.get(key)
+    if dt is None:
+        dt = datetime.datetime(int(key[:4]),
+                               int(key[5:7]),
+                               int(key[8:10]),
+                               int(key[11:13]),
+                               int(key[14:16]),
+                               int(key[17:19]))
+        _postedTime_cache.set(key, dt)
+    return dt
 
 def epoch_to_timestamp(epoch, timestamp_format=GNIP_DATETIME_FORMAT):
     """Convert string timestamp to sec since epoch
@@ -426,13 +1897,567 @@ def timestamp_to_epoch(timestamp, timestamp_format=GNIP_DATETIME_FORMAT):
     using date_format to decode the string
     default format stored in GNIP_DATETIME_FORMAT const
     """
+    key = (timestamp_format, timestamp)
+    epoch = _epoch_cache.get(key)
+    if epoch is not None:
+        return epoch
+    fields = None
+    if timestamp_format == GNIP_DATETIME_FORMAT and timestamp[20:25] == '+0000':
+        fields = created_at_fields(timestamp)
+    elif timestamp_format == TWITTER_DATETIME_FORMAT and timestamp[26:31] == '+0000':
+        fields = rfc2822_fields(timestamp)
+    if fields is not None:
+        epoch = timegm(fields)
+    else:
+        try:
+            epoch = timegm(strptime(timestamp, timestamp_format)) 
+        except ValueError:
+            # timestamp didn't match the timestamp_format
+            return u''
+    _epoch_cache.set(key, epoch)
+    return epoch
+
+#
+# Normalized tweet records
+#   Native and Activity Streams tweets boiled down once to the
+#   same compact record: ids as ints, times as seconds since
+#   the epoch, entities as tuples
+#
+
+def _int_or_none(s):
     try:
-        epoch = timegm(strptime(timestamp, timestamp_format)) 
-    except ValueError:
-        # timestamp didn't match the timestamp_format
-        epoch = u''
+        return int(s)
+    except (TypeError, ValueError):
+        return None
+
+def _posted_epoch(timestamp, activity_streams):
+    """Seconds since the epoch for a postedTime or created_at
+        string, or None
+    """
+    if not timestamp:
+        return None
+    try:
+        if activity_streams:
+            return timegm(from_postedTime(timestamp).utctimetuple())
+        epoch = timestamp_to_epoch(timestamp)
+    except (TypeError, ValueError):
+        return None
+    if epoch == u'':
+        return None
     return epoch
 
+def is_activity_streams(tweet):
+    """True for Gnip Activity Streams tweets, including the
+        object of a share, which has no gnip field
+    """
+    return 'gnip' in tweet or 'body' in tweet or 'postedTime' in tweet
+
+class UserRecord(object):
+    """Profile of the author of a tweet, as of that tweet
+        Counts are None when the tweet doesn't say
+    """
+    __slots__ = ('id', 'username', 'name', 'summary', 'friends', 'followers',
+                 'statuses', 'listed', 'languages', 'time_zone', 'created')
+
+    def __init__(self, id=None, username=u'', name=u'', summary=u'', friends=None,
+                 followers=None, statuses=None, listed=None, languages=u'', time_zone=u'',
+                 created=None):
+        self.id = id
+        self.username = username
+        self.name = name
+        self.summary = summary
+        self.friends = friends
+        self.followers = followers
+        self.statuses = statuses
+        self.listed = listed
+        self.languages = languages
+        self.time_zone = time_zone
+        self.created = created
+
+    def __repr__(self):
+        return 'UserRecord(id={0!r}, username={1!r})'.format(self.id, self.username)
+
+class TweetRecord(object):
+    """The parts of a tweet most jobs need, the same for native
+        and Activity Streams tweets; build with tweet_record
+
+        id, in_reply_to_id, retweet_id : ints or None
+        posted : seconds since the epoch, or None
+        lang : language Twitter or Gnip detected, u'' if neither did
+        actor : UserRecord of the author
+        retweeted : TweetRecord of the retweeted status, if the
+                    tweet carries it (mechanical retweets)
+        retweet_author, retweet_author_id : who was retweeted,
+                    also known for manual RTs by name only
+        hashtags : (text, ...)
+        urls : ((url, expanded url), ...)
+        mentions : ((screen name, user id or None), ...)
+        entities : the tweet's own entities dict, for loaders
+                   that store the entities as Twitter gave them
+        activity_streams : True if built from a Gnip tweet
+    """
+    __slots__ = ('id', 'posted', 'actor', 'text', 'lang', 'verb', 'generator',
+                 'generator_url', 'in_reply_to_id', 'is_retweet', 'edited',
+                 'retweet_id', 'retweet_author_id', 'retweet_author', 'retweeted',
+                 'hashtags', 'urls', 'mentions', 'entities', 'activity_streams')
+
+    def __init__(self, id=None, posted=None, actor=None, text=u'', lang=u'', verb=u'',
+                 generator=u'', generator_url=u'', in_reply_to_id=None,
+                 is_retweet=False, edited=False, retweet_id=None,
+                 retweet_author_id=None, retweet_author=u'', retweeted=None,
+                 hashtags=(), urls=(), mentions=(), entities=None,
+                 activity_streams=False):
+        self.id = id
+        self.posted = posted
+        self.actor = actor if actor is not None else UserRecord()
+        self.text = text
+        self.lang = lang
+        self.verb = verb
+        self.generator = generator
+        self.generator_url = generator_url
+        self.in_reply_to_id = in_reply_to_id
+        self.is_retweet = is_retweet
+        self.edited = edited
+        self.retweet_id = retweet_id
+        self.retweet_author_id = retweet_author_id
+        self.retweet_author = retweet_author
+        self.retweeted = retweeted
+        self.hashtags = hashtags
+        self.urls = urls
+        self.mentions = mentions
+        self.entities = entities if entities is not None else {}
+        self.activity_streams = activity_streams
+
+    def __repr__(self):
+        return 'TweetRecord(id={0!r}, posted={1!r})'.format(self.id, self.posted)
+
+    @property
+    def actor_id(self):
+        return self.actor.id
+
+    def posted_datetime(self):
+        """When it was posted as a (naive, UTC) datetime, or None
+        """
+        if self.posted is None:
+            return None
+        return datetime.datetime.utcfromtimestamp(self.posted)
+
+def _entity_tuples(entities):
+    hashtags = tuple(h.get('text', u'') for h in entities.get('hashtags') or ())
+    urls = tuple((u.get('url') or u'', u.get('expanded_url') or u'')
+                 for u in entities.get('urls') or ())
+    mentions = tuple((m.get('screen_name', u''), _int_or_none(m.get('id_str') or m.get('id')))
+                     for m in entities.get('user_mentions') or ())
+    return hashtags, urls, mentions
+
+def _retweet_fields(record, rt):
+    """Copy what parse_retweet found onto record
+    """
+    if rt:
+        record.is_retweet = True
+        record.edited = rt.get(u'edited', False)
+        record.retweet_id = _int_or_none(rt.get(u'retweeted_status_id_str'))
+        record.retweet_author_id = _int_or_none(rt.get(u'retweeted_author_id_str'))
+        record.retweet_author = (rt.get(u'retweeted_author_username') or
+                                 rt.get(u'retweeted_author_screenname') or u'')
+
+def _native_record(tweet, nested):
+    user = tweet.get('user') or {}
+    actor = UserRecord(id=_int_or_none(user.get('id_str') or user.get('id')),
+                       username=user.get('screen_name', u''),
+                       name=user.get('name', u''),
+                       summary=user.get('description', u''),
+                       friends=user.get('friends_count'),
+                       followers=user.get('followers_count'),
+                       statuses=user.get('statuses_count'),
+                       listed=user.get('listed_count'),
+                       languages=intern_language(user.get('lang', u'')),
+                       time_zone=intern_time_zone(user.get('time_zone') or u''),
+                       created=_posted_epoch(user.get('created_at'), False))
+    generator, generator_url = extract_source(tweet.get('source', u''))
+    entities = tweet.get('entities') or {}
+    hashtags, urls, mentions = _entity_tuples(entities)
+    record = TweetRecord(id=tweet_id_number(tweet),
+                         posted=_posted_epoch(tweet.get('created_at'), False),
+                         actor=actor,
+                         text=tweet.get('text', u''),
+                         lang=intern_language(tweet.get('lang') or u''),
+                         generator=generator,
+                         generator_url=generator_url,
+                         in_reply_to_id=_int_or_none(tweet.get('in_reply_to_status_id_str')),
+                         hashtags=hashtags,
+                         urls=urls,
+                         mentions=mentions,
+                         entities=entities)
+    _retweet_fields(record, parse_retweet_native(tweet))
+    retweeted_status = tweet.get('retweeted_status')
+    if retweeted_status and not nested:
+        record.retweeted = _native_record(retweeted_status, True)
+    return record
+
+def _activity_streams_record(tweet, nested):
+    user = tweet.get('actor') or {}
+    actor = UserRecord(id=extract_user_id_int(user.get('id', u'')),
+                       username=user.get('preferredUsername', u''),
+                       name=user.get('displayName', u''),
+                       summary=user.get('summary', u''),
+                       friends=user.get('friendsCount'),
+                       followers=user.get('followersCount'),
+                       statuses=user.get('statusesCount'),
+                       listed=user.get('listedCount'),
+                       languages=intern_language(u','.join(user.get('languages') or ())),
+                       time_zone=intern_time_zone(user.get('twitterTimeZone') or u''),
+                       created=_posted_epoch(user.get('postedTime'), True))
+    generator = tweet.get('generator') or {}
+    lang = tweet.get('twitter_lang')
+    if not lang:
+        lang = ((tweet.get('gnip') or {}).get('language') or {}).get('value')
+    in_reply_to = (tweet.get('inReplyTo') or {}).get('link', u'')
+    entities = tweet.get('twitter_entities') or {}
+    hashtags, urls, mentions = _entity_tuples(entities)
+    record = TweetRecord(id=tweet_id_number(tweet),
+                         posted=_posted_epoch(tweet.get('postedTime'), True),
+                         actor=actor,
+                         text=tweet.get('body', u''),
+                         lang=intern_language(lang or u''),
+                         verb=tweet.get('verb', u''),
+                         generator=intern_generator(generator.get('displayName', u'')),
+                         generator_url=intern_url(generator.get('link', u'')),
+                         in_reply_to_id=_int_or_none(in_reply_to.rsplit('/', 1)[-1]),
+                         hashtags=hashtags,
+                         urls=urls,
+                         mentions=mentions,
+                         entities=entities,
+                         activity_streams=True)
+    _retweet_fields(record, parse_retweet_activity_streams(tweet))
+    shared = tweet.get('object')
+    if record.verb == 'share' and shared and not nested:
+        record.retweeted = _activity_streams_record(shared, True)
+    return record
+
+def id_string(n):
+    """Decimal string of an id from a record, '' for None
+    """
+    if n is None:
+        return ''
+    return str(n)
+
+def record_retweet(record):
+    """What parse_retweet returns, from a TweetRecord
+    """
+    if not record.is_retweet:
+        return {}
+    return {u'edited': record.edited,
+            u'retweeted_status_id_str': id_string(record.retweet_id),
+            u'retweeted_author_id_str': id_string(record.retweet_author_id),
+            u'retweeted_author_username': record.retweet_author,
+            u'retweeted_author_screenname': record.retweet_author}
+
+def tweet_record(tweet):
+    """Return a TweetRecord for a native or Activity Streams tweet
+        (a record is returned as it is)
+        Keep the record instead of the tweet: it takes a fraction
+        of the memory and saves working everything out again
+    """
+    if isinstance(tweet, TweetRecord):
+        return tweet
+    if is_activity_streams(tweet):
+        return _activity_streams_record(tweet, False)
+    return _native_record(tweet, False)
+
+#
+# Columnar batches
+#   Tweets in fixed-size chunks of NumPy columns, so counts,
+#   histograms and joins run over arrays instead of dicts
+#
+
+# Tweets per TweetBatch
+TWEET_BATCH_SIZE = 65536
+# Stands for a missing id or time in the int columns
+MISSING_INT = -1
+# Columns of TweetBatch, by type
+TWEET_BATCH_INT_COLUMNS = ('id', 'actor_id', 'retweet_id', 'retweet_author_id', 'posted')
+TWEET_BATCH_BOOL_COLUMNS = ('is_retweet', 'edited')
+TWEET_BATCH_CODE_COLUMNS = ('generator', 'lang')
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError(u'Columnar batches need NumPy')
+
+class StringDictionary(object):
+    """Gives each distinct string a small int code
+        Share one between batches so their codes agree
+    """
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def code(self, s):
+        """Code for s, given a new one if it hasn't been seen
+        """
+        c = self.codes.get(s)
+        if c is None:
+            c = self.codes[s] = len(self.values)
+            self.values.append(s)
+        return c
+
+    def lookup(self, s):
+        """Code for s, or -1 (which no row has) if it hasn't been seen
+        """
+        return self.codes.get(s, -1)
+
+class TweetBatch(object):
+    """Columns for a chunk of tweets, one row per tweet
+
+        id, actor_id, retweet_id, retweet_author_id, posted : int64,
+            MISSING_INT where the tweet has none
+        is_retweet, edited : bool
+        generator, lang : int32 codes into the generators and
+            languages StringDictionaries
+        text_offsets, text_buffer : the UTF-8 text of row i is
+            text_buffer[text_offsets[i]:text_offsets[i + 1]]
+
+        Masks from between, where_generator, where_lang and isin
+        combine with & and | and pick rows with select.
+    """
+    def __init__(self, columns, text_offsets, text_buffer, generators, languages):
+        _require_numpy()
+        for name in TWEET_BATCH_INT_COLUMNS + TWEET_BATCH_BOOL_COLUMNS + TWEET_BATCH_CODE_COLUMNS:
+            setattr(self, name, columns[name])
+        self.text_offsets = text_offsets
+        self.text_buffer = text_buffer
+        self.generators = generators
+        self.languages = languages
+
+    def __len__(self):
+        return len(self.id)
+
+    def column(self, name):
+        return getattr(self, name)
+
+    def text(self, i):
+        start, end = self.text_offsets[i], self.text_offsets[i + 1]
+        return self.text_buffer[start:end].tostring().decode('utf-8')
+
+    def texts(self):
+        for i in xrange(len(self)):
+            yield self.text(i)
+
+    def select(self, mask):
+        """Return a TweetBatch of the rows where mask is True
+            (or of the rows at the given indexes)
+        """
+        rows = numpy.asarray(mask)
+        if rows.dtype == bool:
+            rows = numpy.flatnonzero(rows)
+        columns = {}
+        for name in TWEET_BATCH_INT_COLUMNS + TWEET_BATCH_BOOL_COLUMNS + TWEET_BATCH_CODE_COLUMNS:
+            columns[name] = getattr(self, name)[rows]
+        starts = self.text_offsets[rows]
+        lengths = self.text_offsets[rows + 1] - starts
+        offsets = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+        numpy.cumsum(lengths, out=offsets[1:])
+        # Index of every byte kept: its row's old start, plus how
+        # far it is into the row
+        positions = (numpy.repeat(starts - offsets[:-1], lengths) +
+                     numpy.arange(offsets[-1], dtype=numpy.int64))
+        return TweetBatch(columns, offsets, self.text_buffer[positions],
+                          self.generators, self.languages)
+
+    def between(self, start, end):
+        """Mask of the tweets posted in [start, end) (datetimes or epochs)
+        """
+        start, end = to_epoch(start), to_epoch(end)
+        return (self.posted >= start) & (self.posted < end)
+
+    def where_generator(self, name):
+        return self.generator == self.generators.lookup(name)
+
+    def where_lang(self, lang):
+        return self.lang == self.languages.lookup(lang)
+
+    def isin(self, name, values):
+        """Mask of the rows whose column name is one of values
+        """
+        return numpy.in1d(getattr(self, name), values)
+
+    def time_buckets(self, width, origin=0):
+        """Bucket of each tweet: (posted - origin) // width seconds
+        """
+        return (self.posted - to_epoch(origin)) // width
+
+    def histogram(self, width, start, end):
+        """Tweets per width seconds from start up to end
+        """
+        start, end = to_epoch(start), to_epoch(end)
+        bins = int(-(-(end - start) // width))
+        buckets = self.time_buckets(width, start)[self.between(start, end)]
+        return numpy.bincount(buckets.astype(numpy.int64), minlength=bins)[:bins]
+
+    def counts(self, name):
+        """Return (values, counts) of column name, leaving out
+            MISSING_INT in int columns
+        """
+        column = getattr(self, name)
+        if name in TWEET_BATCH_INT_COLUMNS:
+            column = column[column != MISSING_INT]
+        return numpy.unique(column, return_counts=True)
+
+class TweetBatchBuilder(object):
+    """Turns tweets (or TweetRecords) into TweetBatches of size rows
+        add returns a batch each time one fills up; flush returns
+        the last, partial one
+    """
+    def __init__(self, size=TWEET_BATCH_SIZE, generators=None, languages=None):
+        _require_numpy()
+        self.size = size
+        self.generators = generators if generators is not None else StringDictionary()
+        self.languages = languages if languages is not None else StringDictionary()
+        self._reset()
+
+    def _reset(self):
+        self._columns = dict((name, []) for name in TWEET_BATCH_INT_COLUMNS +
+                             TWEET_BATCH_BOOL_COLUMNS + TWEET_BATCH_CODE_COLUMNS)
+        self._texts = []
+
+    def add(self, tweet):
+        record = tweet_record(tweet)
+        columns = self._columns
+        for name, value in (('id', record.id),
+                            ('actor_id', record.actor.id),
+                            ('retweet_id', record.retweet_id),
+                            ('retweet_author_id', record.retweet_author_id),
+                            ('posted', record.posted)):
+            columns[name].append(MISSING_INT if value is None else value)
+        columns['is_retweet'].append(record.is_retweet)
+        columns['edited'].append(record.edited)
+        columns['generator'].append(self.generators.code(record.generator))
+        columns['lang'].append(self.languages.code(record.lang))
+        text = record.text or u''
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self._texts.append(text)
+        if len(self._texts) >= self.size:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """Return a TweetBatch of the tweets added since the last one
+            or None if there are none
+        """
+        if not self._texts:
+            return None
+        columns = {}
+        for name in TWEET_BATCH_INT_COLUMNS:
+            columns[name] = numpy.array(self._columns[name], dtype=numpy.int64)
+        for name in TWEET_BATCH_BOOL_COLUMNS:
+            columns[name] = numpy.array(self._columns[name], dtype=bool)
+        for name in TWEET_BATCH_CODE_COLUMNS:
+            columns[name] = numpy.array(self._columns[name], dtype=numpy.int32)
+        offsets = numpy.zeros(len(self._texts) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(text) for text in self._texts], out=offsets[1:])
+        buf = numpy.frombuffer(''.join(self._texts), dtype=numpy.uint8).copy()
+        self._reset()
+        return TweetBatch(columns, offsets, buf, self.generators, self.languages)
+
+def iter_tweet_batches(tweets, size=TWEET_BATCH_SIZE, generators=None, languages=None):
+    """Yield TweetBatches of size rows from tweets, e.g. from itertweets
+        All batches share one pair of StringDictionaries
+    """
+    builder = TweetBatchBuilder(size, generators, languages)
+    for tweet in tweets:
+        batch = builder.add(tweet)
+        if batch is not None:
+            yield batch
+    batch = builder.flush()
+    if batch is not None:
+        yield batch
+
+def time_histogram(batches, width, start, end):
+    """Return (bucket start times, tweets in each) over batches
+        for width-second buckets from start up to end
+    """
+    _require_numpy()
+    start, end = to_epoch(start), to_epoch(end)
+    bins = int(-(-(end - start) // width))
+    counts = numpy.zeros(bins, dtype=numpy.int64)
+    for batch in batches:
+        counts += batch.histogram(width, start, end)
+    return start + width * numpy.arange(bins, dtype=numpy.int64), counts
+
+#
+# Interning ids
+#   Tweet and user ids as small dense ints, so graphs and
+#   counts can live in arrays indexed by them
+#
+
+# Dense indexes are stored as int32
+ID_INTERNER_MAX = 2 ** 31 - 1
+
+def id_number(value):
+    """Int id from an int, a decimal string or a Gnip id string
+        or None
+    """
+    if isinstance(value, (int, long)):
+        return value
+    if not value:
+        return None
+    if not value.lstrip('0123456789'):
+        return int(value)
+    return extract_tweet_id_int(value)
+
+class IdInterner(object):
+    """Numbers ids 0, 1, 2... in the order they are first seen
+
+        Ids may be ints, decimal strings or Gnip id strings; the
+        same id in any form gets the same index. Use one interner
+        per kind of id (tweets, users). index_many gives an int32
+        array('i'), ready for numpy.frombuffer.
+    """
+    def __init__(self):
+        self._index = {}
+        self.ids = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, value):
+        return id_number(value) in self._index
+
+    def index(self, value):
+        """Dense index of value, given a new one if it is new
+        """
+        n = id_number(value)
+        if n is None:
+            raise ValueError(u'Not an id: {0!r}'.format(value))
+        i = self._index.get(n)
+        if i is None:
+            i = len(self.ids)
+            if i >= ID_INTERNER_MAX:
+                raise OverflowError(u'More ids than fit in int32')
+            self._index[n] = i
+            self.ids.append(n)
+        return i
+
+    def lookup(self, value):
+        """Dense index of value, or -1 if it hasn't been seen
+        """
+        return self._index.get(id_number(value), -1)
+
+    def id_of(self, i):
+        """The id with dense index i
+        """
+        return self.ids[i]
+
+    def index_many(self, values):
+        """array('i') of the dense indexes of values
+        """
+        index = self.index
+        return array.array('i', (index(value) for value in values))
+
 #
 # Error management 
 #
@@ -454,50 +2479,894 @@ def error_log(s):
         sys.stderr.write(s.encode('utf-8', 'replace'))
 
 
+#
+# Reading only some fields
+#   A projection (dotted paths, as in a Mongo find) picks the
+#   fields a job needs; the rest of each line is skipped over
+#   by its brackets without building anything
+#
+
+# Pieces of JSON text, for skipping over values
+JSON_STRING = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+JSON_SCALAR = r'[^\s,\]}]+'
+JSON_PLAIN = r'[^"{}\[\]]*'
+# Objects and arrays nested this deep are matched by one regex;
+# deeper ones are walked bracket by bracket
+JSON_REGEX_DEPTH = 8
+
+def _json_bracket_pattern(depth):
+    """Pattern for an object or array nested at most depth deep
+    """
+    pattern = None
+    for _ in xrange(depth):
+        if pattern is None:
+            value = JSON_STRING
+        else:
+            value = '(?:{0}|{1})'.format(JSON_STRING, pattern)
+        pattern = r'[\[{{]{0}(?:{1}{0})*[\]}}]'.format(JSON_PLAIN, value)
+    return pattern
+
+# One member of an object: key, value and the , or } after it
+JSON_MEMBER_RE = re.compile(r'\s*"((?:[^"\\]|\\.)*)"\s*:\s*({0}|{1}|{2})\s*([,}}])'.format(
+    JSON_STRING, _json_bracket_pattern(JSON_REGEX_DEPTH), JSON_SCALAR))
+JSON_KEY_RE = re.compile(r'\s*"((?:[^"\\]|\\.)*)"\s*:\s*')
+JSON_SKIP_RE = re.compile(JSON_PLAIN + '(?:' + JSON_STRING + JSON_PLAIN + ')*')
+JSON_STRING_RE = re.compile(JSON_STRING)
+JSON_SCALAR_RE = re.compile(JSON_SCALAR)
+JSON_SPACE_RE = re.compile(r'\s*')
+
+_json_decoder = json.JSONDecoder()
+
+# Top-level fields only one of the two tweet formats has
+NATIVE_TWEET_FIELDS = frozenset([
+    'created_at', 'id_str', 'text', 'user', 'entities', 'source',
+    'truncated', 'in_reply_to_status_id', 'in_reply_to_status_id_str',
+    'in_reply_to_user_id', 'in_reply_to_user_id_str',
+    'in_reply_to_screen_name', 'retweeted_status', 'retweet_count',
+    'favorite_count', 'favorited', 'retweeted', 'coordinates',
+    'contributors', 'place', 'lang',
+])
+ACTIVITY_STREAMS_FIELDS = frozenset([
+    'postedTime', 'body', 'actor', 'object', 'verb', 'objectType',
+    'generator', 'provider', 'link', 'twitter_entities', 'twitter_lang',
+    'twitter_filter_level', 'gnip', 'inReplyTo', 'retweetCount',
+    'favoritesCount', 'location',
+])
+
+def projection_tree(fields):
+    """Return {key: True or {subkey: ...}} from dotted paths
+        ('actor.id_str', 'body', ...) or a Mongo projection dict
+    """
+    if isinstance(fields, dict):
+        fields = [path for path, wanted in fields.iteritems() if wanted]
+    tree = {}
+    for path in fields:
+        node = tree
+        keys = path.split('.')
+        for key in keys[:-1]:
+            child = node.get(key)
+            if child is True:
+                break
+            if child is None:
+                child = node[key] = {}
+            node = child
+        else:
+            node[keys[-1]] = True
+    return tree
+
+def tweet_projection(fields, also=()):
+    """Return (native tree, Activity Streams tree) for fields
+        Jobs list the names of both formats ('created_at' and
+        'postedTime'...); each tree leaves out the other format's
+        names so a view of a line stops reading once it has found
+        everything its own format can have
+        also : more dotted paths to read
+    """
+    if isinstance(fields, dict):
+        fields = [path for path, wanted in fields.iteritems() if wanted]
+    tree = projection_tree(list(fields) + list(also))
+    native = dict((key, node) for key, node in tree.iteritems()
+                  if key not in ACTIVITY_STREAMS_FIELDS)
+    activity = dict((key, node) for key, node in tree.iteritems()
+                    if key not in NATIVE_TWEET_FIELDS)
+    return native, activity
+
+def _skip_json_value(s, pos):
+    """Return where the JSON value starting at s[pos] ends
+    """
+    c = s[pos:pos + 1]
+    if c == '{' or c == '[':
+        depth = 0
+        n = len(s)
+        while pos < n:
+            c = s[pos]
+            if c == '{' or c == '[':
+                depth += 1
+            elif c == '}' or c == ']':
+                depth -= 1
+                if not depth:
+                    return pos + 1
+            else:
+                raise ValueError('Unexpected {0!r} at {1}'.format(c, pos))
+            pos = JSON_SKIP_RE.match(s, pos + 1).end()
+        raise ValueError('Unterminated value')
+    if c == '"':
+        m = JSON_STRING_RE.match(s, pos)
+    else:
+        m = JSON_SCALAR_RE.match(s, pos)
+    if m is None:
+        raise ValueError('No JSON value at {0}'.format(pos))
+    return m.end()
+
+def next_json_member(s, pos):
+    """Return (key, raw JSON text of the value, position after it,
+        True if it was the last member) for the member of an
+        object at s[pos]
+    """
+    m = JSON_MEMBER_RE.match(s, pos)
+    if m is not None:
+        key, value, c = m.group(1, 2, 3)
+        pos = m.end()
+    else:
+        # Too deep for the regex, or broken
+        m = JSON_KEY_RE.match(s, pos)
+        if m is None:
+            raise ValueError('Expecting property name at {0}'.format(pos))
+        key = m.group(1)
+        pos = _skip_json_value(s, m.end())
+        value = s[m.end():pos]
+        pos = JSON_SPACE_RE.match(s, pos).end()
+        c = s[pos:pos + 1]
+        pos += 1
+        if c != ',' and c != '}':
+            raise ValueError('Expecting , or }} at {0}'.format(pos - 1))
+    if '\\' in key:
+        key = json.loads('"' + key + '"')
+    return key, value, pos, c == '}'
+
+def _json_object_start(s):
+    """Return where the first member of the object in s starts
+        or None if the object is empty
+    """
+    pos = JSON_SPACE_RE.match(s).end()
+    if s[pos:pos + 1] != '{':
+        raise ValueError('Not a JSON object')
+    pos = JSON_SPACE_RE.match(s, pos + 1).end()
+    if s[pos:pos + 1] == '}':
+        return None
+    return pos
+
+def decode_projected(raw, tree):
+    """Decode raw JSON text, keeping only what tree asks for
+        Members of objects that aren't asked for are skipped
+    """
+    if tree is True or raw[:1] != '{':
+        # Arrays and scalars under a dotted path are kept whole
+        return _json_decoder.decode(raw)
+    result = {}
+    pos = _json_object_start(raw)
+    while pos is not None:
+        key, value, pos, last = next_json_member(raw, pos)
+        if key in tree:
+            result[key] = decode_projected(value, tree[key])
+        if last:
+            break
+    return result
+
+class TweetView(object):
+    """Read-only, dict-like view of the projected fields of a
+        tweet on one line of JSON
+
+        The members asked for are found when the view is made,
+        reading the line only as far as the last of them, so a
+        broken line raises ValueError there instead of wherever
+        it is first read. Each field is decoded the first time it
+        is read, so tweets that are dropped early cost little. The
+        line itself is kept instead of the decoded tweet, which
+        weighs several times more. dict(view) gives a plain dict,
+        e.g. to insert into Mongo.
+    """
+    __slots__ = ('_line', '_tree', '_raw', '_values')
+
+    def __init__(self, line, tree):
+        self._line = line
+        self._tree = tree
+        self._raw = raw = {}
+        self._values = {}
+        pos = _json_object_start(line)
+        wanted = len(tree)
+        while pos is not None and len(raw) < wanted:
+            key, value, pos, last = next_json_member(line, pos)
+            if last:
+                pos = None
+            if key in tree and key not in raw:
+                raw[key] = value
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        value = decode_projected(self._raw[key], self._tree[key])
+        self._values[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        # Fields added after reading, like a Mongo _id
+        self._raw.setdefault(key, None)
+        self._values[key] = value
+
+    def __contains__(self, key):
+        return key in self._raw
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self):
+        return len(self._raw)
+
+    def __reduce__(self):
+        return (TweetView, (self._line, self._tree))
+
+    def __repr__(self):
+        return 'TweetView({0!r})'.format(dict(self))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+def line_projection(line, projection):
+    """Return the tree of projection (from tweet_projection) for the
+        format of the tweet on line, or None if it isn't a tweet
+        (a cheap test: no Twitter or Gnip key, no tweet)
+    """
+    if '"gnip"' in line:
+        return projection[1]
+    if '"created_at"' in line:
+        return projection[0]
+    return None
+
+
 #
 #  File I/O
 #
 
-def itertweets(gnipfn):
+# Uncompressed files bigger than this are split between processes
+TWEET_CHUNK_SIZE = 32 * 1024 * 1024
+
+def parse_tweet_line(raw, projection=None):
+    """Return the tweet on one line of a Gnip or Twitter file
+        or None if it is blank, broken or not a tweet
+        projection : from tweet_projection, to get a TweetView of
+                     just those fields instead of the whole tweet
+    """
+    # Strip out extra space, newlines
+    line = raw.strip()
+    # Is it a blank line?
+    if not line:
+        return None
+
+    if projection is not None:
+        tree = line_projection(line, projection)
+        if tree is None:
+            return None
+        try:
+            return TweetView(line, tree)
+        except ValueError as e:
+            print u'Caught exception: ',
+            print e
+            print u'With this data: ',
+            print line
+            return None
+
+    # Is it a valid JSON object?
+    try:
+        tweet = json.loads(line)
+    except ValueError as e:
+        print u'Caught exception: ',
+        print e
+        print u'With this data: ',
+        print line
+        return None
+    
+    # Is it a dict?
+    # (Sometimes a broken line can sneak through as a valid int or str)
+    if not type(tweet) == dict:
+        print u'Hm. That was not a dict.'
+        return None
+
+    # Is it a Twitter object? (Specifically, does it have a 'created_at' key?)
+    # Or is it a Gnip Activity Streams object?
+    if u'created_at' in tweet or u'gnip' in tweet:
+        return tweet
+
+    # Otherwise, ditch it
+    return None
+
+def itertweets(gnipfn, fields=None):
     """Iterator yields valid tweet objects found in gnipfn 
         gnipfn : (str) path to input file (gnip tweets)
+        fields : dotted paths to read, yielding TweetViews
+                 instead of whole tweets (see TweetView)
     """
+    projection = None
+    if fields is not None:
+        projection = tweet_projection(fields)
     # Try to open gnipfn
     try:
-        gnipfp = open(gnipfn, 'rb')
+        gnipfp = open_tweet_file(gnipfn)
     except:
         print 'Could not access {0}'.format(gnipfn) 
     else:
         for raw in gnipfp:
-            # Strip out extra space, newlines
-            line = raw.strip()
-            # Is it a blank line?
-            if not line:
-                continue
+            tweet = parse_tweet_line(raw, projection)
+            if tweet is not None:
+                yield(tweet)
+
+def open_tweet_file(path):
+    """Open path for reading, decompressing .gz and .bz2 files
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'rb')
+    return open(path, 'rb')
+
+def expand_tweet_paths(patterns):
+    """Return the files matching patterns (glob patterns or paths)
+        Each pattern's matches are sorted; no file is listed twice
+    """
+    if isinstance(patterns, basestring):
+        patterns = [patterns]
+    paths = []
+    seen = set()
+    for pattern in patterns:
+        for path in sorted(glob(pattern)) or [pattern]:
+            if path not in seen:
+                seen.add(path)
+                paths.append(path)
+    return paths
 
-            # Is it a valid JSON object?
+def tweet_file_chunks(paths, chunk_size=TWEET_CHUNK_SIZE):
+    """Yield (path, start, end) pieces of work for paths
+        Compressed files are read whole (end is None)
+        Uncompressed files are cut into byte ranges of chunk_size;
+        a line belongs to the range it starts in
+    """
+    for path in paths:
+        if path.endswith(('.gz', '.bz2')):
+            yield (path, 0, None)
+            continue
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        if size <= chunk_size:
+            yield (path, 0, None)
+            continue
+        for start in xrange(0, size, chunk_size):
+            yield (path, start, min(start + chunk_size, size))
+
+def iter_tweet_chunk(path, start=0, end=None):
+    """Yield the raw lines of one piece from tweet_file_chunks
+    """
+    try:
+        f = open_tweet_file(path)
+    except IOError:
+        print 'Could not access {0}'.format(path)
+        return
+    with f:
+        if end is None:
             try:
-                tweet = json.loads(line)
-            except ValueError as e:
-                print u'Caught exception: ',
-                print e
-                print u'With this data: ',
-                print line
-                continue
-            
-            # Is it a dict?
-            # (Sometimes a broken line can sneak through as a valid int or str)
-            if not type(tweet) == dict:
-                print u'Hm. That was not a dict.'
-                continue
+                for raw in f:
+                    yield raw
+            except (IOError, EOFError) as e:
+                # Truncated archive: keep what could be read
+                print 'Could not finish {0}: {1}'.format(path, e)
+            return
+        if start:
+            # Skip the line that started in the piece before
+            f.seek(start - 1)
+            f.readline()
+        data = f.read(max(end - f.tell(), 0))
+        if data and not data.endswith('\n'):
+            # Finish the last line, which may run past end
+            data += f.readline()
+        for raw in data.splitlines():
+            yield raw
 
-            # Is it a Twitter object? (Specifically, does it have a 'created_at' key?)
-            if (u'created_at' in tweet.keys()):
-                yield(tweet)
-                
-            # Or is it a Gnip Activity Streams object?
-            if (u'gnip' in tweet.keys()):
-                yield(tweet)
+# Set in each process of an itertweets_parallel pool
+_tweet_function = None
+_tweet_projection = None
+
+def _init_tweet_worker(function, projection=None):
+    global _tweet_function, _tweet_projection
+    _tweet_function = function
+    _tweet_projection = projection
 
-            # Otherwise, ditch it
+def _read_tweet_chunk(chunk):
+    """Return the tweets, or results of _tweet_function, in one piece
+    """
+    function = _tweet_function
+    projection = _tweet_projection
+    results = []
+    for raw in iter_tweet_chunk(*chunk):
+        tweet = parse_tweet_line(raw, projection)
+        if tweet is None:
             continue
+        if function is not None:
+            tweet = function(tweet)
+            if tweet is None:
+                continue
+        results.append(tweet)
+    return results
+
+def itertweets_parallel(patterns, function=None, processes=None, ordered=False,
+                        chunk_size=TWEET_CHUNK_SIZE, fields=None):
+    """Yield the tweets in every file matching patterns, read
+        and decoded by a pool of processes, one piece of a
+        file (see tweet_file_chunks) per task
+        patterns : glob pattern or path, or a list of them;
+                   .gz and .bz2 files are decompressed
+        function : called on each tweet in the worker, the
+                   result is yielded instead unless it is None.
+                   Must be picklable (defined at module level);
+                   use it to send back only what you need, since
+                   whole tweets are costly to ship between processes
+        processes : size of the pool (one per core if None);
+                    1 reads everything in this process
+        ordered : yield in file order instead of as pieces finish
+        fields : dotted paths to read, so function gets TweetViews
+                 (which are also cheap to send back whole)
+    """
+    projection = None
+    if fields is not None:
+        projection = tweet_projection(fields)
+    chunks = tweet_file_chunks(expand_tweet_paths(patterns), chunk_size)
+    if processes == 1:
+        _init_tweet_worker(function, projection)
+        for chunk in chunks:
+            for item in _read_tweet_chunk(chunk):
+                yield item
+        return
+    pool = multiprocessing.Pool(processes, _init_tweet_worker, (function, projection))
+    try:
+        if ordered:
+            results = pool.imap(_read_tweet_chunk, chunks)
+        else:
+            results = pool.imap_unordered(_read_tweet_chunk, chunks)
+        for batch in results:
+            for item in batch:
+                yield item
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+#
+# Indexing tweet files by id
+#   A sorted file of (id, offset, length) records, so single
+#   tweets can be pulled out of a huge file without scanning it
+#
+
+# Index files start with this, then the number of records and
+# the size of the data file they describe
+TWEET_INDEX_MAGIC = 'TWIDX1\0\0'
+TWEET_INDEX_HEADER = struct.Struct('<8sQQ')
+# Each record: tweet id, byte offset and length of its line
+TWEET_INDEX_RECORD = struct.Struct('<QQI')
+# All an index needs from each tweet
+TWEET_ID_PROJECTION = tweet_projection(['id', 'id_str'])
+# Records sorted in memory at a time while building an index
+TWEET_INDEX_RUN_SIZE = 1000000
+
+def tweet_id_number(tweet):
+    """Return the numeric id of a native or Activity Streams tweet
+        or None if it hasn't got one
+    """
+    try:
+        if tweet.get('id_str'):
+            return int(tweet['id_str'])
+        tweet_id = tweet.get('id')
+        if isinstance(tweet_id, (int, long)):
+            return tweet_id
+        if tweet_id:
+            number = extract_tweet_id_int(tweet_id)
+            if number is None:
+                number = int(tweet_id)
+            return number
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def _write_index_run(records):
+    """Sort records and spill them to a temporary file
+    """
+    records.sort()
+    run = tempfile.TemporaryFile()
+    pack = TWEET_INDEX_RECORD.pack
+    for record in records:
+        run.write(pack(*record))
+    run.seek(0)
+    return run
+
+def _read_index_run(run):
+    size = TWEET_INDEX_RECORD.size
+    unpack = TWEET_INDEX_RECORD.unpack
+    while True:
+        data = run.read(size)
+        if len(data) < size:
+            return
+        yield unpack(data)
+
+def build_tweet_index(path, index_path=None, run_size=TWEET_INDEX_RUN_SIZE):
+    """Index the valid tweets in the uncompressed file path
+        Writes path + '.idx' (or index_path) and returns the
+        number of tweets indexed. Lines are checked as
+        itertweets checks them; anything else is left out.
+        Sorting happens in runs of run_size records, so
+        memory stays flat however big the file is.
+    """
+    if path.endswith(('.gz', '.bz2')):
+        raise ValueError(u'Can only index uncompressed files: {0}'.format(path))
+    if index_path is None:
+        index_path = path + '.idx'
+    runs = []
+    records = []
+    count = 0
+    offset = 0
+    with open(path, 'rb') as f:
+        for raw in f:
+            tweet = parse_tweet_line(raw, TWEET_ID_PROJECTION)
+            if tweet is not None:
+                tweet_id = tweet_id_number(tweet)
+                if tweet_id is not None:
+                    records.append((tweet_id, offset, len(raw)))
+                    if len(records) >= run_size:
+                        runs.append(_write_index_run(records))
+                        records = []
+            offset += len(raw)
+    runs.append(_write_index_run(records))
+    records = None
+
+    partial = index_path + '.tmp'
+    with open(partial, 'wb') as out:
+        out.write(TWEET_INDEX_HEADER.pack(TWEET_INDEX_MAGIC, 0, offset))
+        pack = TWEET_INDEX_RECORD.pack
+        for record in heapq.merge(*[_read_index_run(run) for run in runs]):
+            out.write(pack(*record))
+            count += 1
+        out.seek(0)
+        out.write(TWEET_INDEX_HEADER.pack(TWEET_INDEX_MAGIC, count, offset))
+    for run in runs:
+        run.close()
+    os.rename(partial, index_path)
+    return count
+
+class TweetIndex(object):
+    """Fetches tweets from a file by id through its index
+
+        Both files are memory-mapped and the index is binary
+        searched, so only the pages holding the wanted tweets
+        are read. Build the index with build_tweet_index;
+        an index that doesn't match the file raises ValueError.
+    """
+    def __init__(self, path, index_path=None):
+        if index_path is None:
+            index_path = path + '.idx'
+        self.path = path
+        self._data_fp = open(path, 'rb')
+        self._index_fp = open(index_path, 'rb')
+        header = self._index_fp.read(TWEET_INDEX_HEADER.size)
+        if len(header) < TWEET_INDEX_HEADER.size:
+            raise ValueError(u'Not a tweet index: {0}'.format(index_path))
+        magic, self.count, size = TWEET_INDEX_HEADER.unpack(header)
+        if magic != TWEET_INDEX_MAGIC:
+            raise ValueError(u'Not a tweet index: {0}'.format(index_path))
+        if size != os.path.getsize(path):
+            raise ValueError(u'{0} has changed since it was indexed'.format(path))
+        self._data = None
+        self._index = None
+        if size:
+            self._data = mmap.mmap(self._data_fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.count:
+            self._index = mmap.mmap(self._index_fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, tweet_id):
+        return self._find(tweet_id) is not None
+
+    def _record(self, i):
+        return TWEET_INDEX_RECORD.unpack_from(self._index,
+                                              TWEET_INDEX_HEADER.size + i * TWEET_INDEX_RECORD.size)
+
+    def _find(self, tweet_id, lo=0):
+        """Return the first record for tweet_id at or after lo, or None
+        """
+        if not isinstance(tweet_id, (int, long)):
+            tweet_id = extract_tweet_id(tweet_id) or tweet_id
+            try:
+                tweet_id = int(tweet_id)
+            except ValueError:
+                return None
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid)[0] < tweet_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count:
+            record = self._record(lo)
+            if record[0] == tweet_id:
+                return record
+        return None
+
+    def get_raw(self, tweet_id, default=None):
+        """Return the line holding tweet_id, without its newline
+        """
+        record = self._find(tweet_id)
+        if record is None:
+            return default
+        _, offset, length = record
+        return self._data[offset:offset + length].rstrip('\r\n')
+
+    def get(self, tweet_id, default=None):
+        """Return the tweet with tweet_id (int, id_str or Gnip id)
+        """
+        raw = self.get_raw(tweet_id)
+        if raw is None:
+            return default
+        return json.loads(raw)
+
+    def get_many(self, tweet_ids):
+        """Yield (tweet id, tweet) for those of tweet_ids in the file
+            Tweets come in file order, so the reads move forward
+        """
+        found = []
+        for tweet_id in tweet_ids:
+            record = self._find(tweet_id)
+            if record is not None:
+                found.append((record[1], record[2], tweet_id))
+        found.sort()
+        for offset, length, tweet_id in found:
+            yield tweet_id, json.loads(self._data[offset:offset + length])
+
+    def close(self):
+        for m in (self._data, self._index):
+            if m is not None:
+                m.close()
+        self._data_fp.close()
+        self._index_fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+#
+# Indexing tweet files by time
+#   Earliest and latest posting time of each block of a file,
+#   so a window can be read without touching the rest. Works
+#   on any file; the closer to time order, the less is read.
+#
+
+# Time index files start with this, then the number of blocks
+# and the size of the data file they describe
+TWEET_TIME_INDEX_MAGIC = 'TWTIX1\0\0'
+TWEET_TIME_INDEX_HEADER = struct.Struct('<8sQQ')
+# Each block: byte offset where it starts and the earliest and
+# latest posting times in it, in seconds since the epoch
+TWEET_TIME_INDEX_RECORD = struct.Struct('<Qqq')
+# Bytes of tweets per block
+TWEET_TIME_BLOCK_SIZE = 1024 * 1024
+# All a time index needs from each tweet
+TWEET_TIME_FIELDS = ('postedTime', 'created_at')
+TWEET_TIME_PROJECTION = tweet_projection(TWEET_TIME_FIELDS)
+
+def tweet_epoch(tweet):
+    """Return when a native or Activity Streams tweet was posted,
+        in seconds since the epoch, or None
+    """
+    try:
+        if 'postedTime' in tweet:
+            return timegm(from_postedTime(tweet['postedTime']).utctimetuple())
+        if 'created_at' in tweet:
+            return timegm(from_created_at(tweet['created_at']).utctimetuple())
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def to_epoch(when):
+    """Seconds since the epoch for a (UTC) datetime or a number
+    """
+    if isinstance(when, datetime.datetime):
+        return timegm(when.utctimetuple())
+    return when
+
+def build_tweet_time_index(path, index_path=None, block_size=TWEET_TIME_BLOCK_SIZE):
+    """Index the posting times of the tweets in the uncompressed
+        file path, one record per block_size bytes of lines
+        Writes path + '.tidx' (or index_path) and returns the
+        number of blocks
+    """
+    if path.endswith(('.gz', '.bz2')):
+        raise ValueError(u'Can only index uncompressed files: {0}'.format(path))
+    if index_path is None:
+        index_path = path + '.tidx'
+    blocks = []
+    block_start = 0
+    earliest = latest = None
+    offset = 0
+    with open(path, 'rb') as f:
+        for raw in f:
+            # Blocks start on a line and hold at least one tweet
+            if offset - block_start >= block_size and earliest is not None:
+                blocks.append((block_start, earliest, latest))
+                block_start = offset
+                earliest = latest = None
+            tweet = parse_tweet_line(raw, TWEET_TIME_PROJECTION)
+            if tweet is not None:
+                posted = tweet_epoch(tweet)
+                if posted is not None:
+                    if earliest is None or posted < earliest:
+                        earliest = posted
+                    if latest is None or posted > latest:
+                        latest = posted
+            offset += len(raw)
+    if earliest is not None:
+        blocks.append((block_start, earliest, latest))
+
+    partial = index_path + '.tmp'
+    with open(partial, 'wb') as out:
+        out.write(TWEET_TIME_INDEX_HEADER.pack(TWEET_TIME_INDEX_MAGIC, len(blocks), offset))
+        for block in blocks:
+            out.write(TWEET_TIME_INDEX_RECORD.pack(*block))
+    os.rename(partial, index_path)
+    return len(blocks)
+
+class TweetTimeIndex(object):
+    """Reads the tweets of a file posted in a window of time
+        through its index from build_tweet_time_index
+
+        Only blocks whose span of posting times overlaps the
+        window are read. An index that doesn't match the
+        file raises ValueError.
+    """
+    def __init__(self, path, index_path=None):
+        if index_path is None:
+            index_path = path + '.tidx'
+        self.path = path
+        with open(index_path, 'rb') as f:
+            header = f.read(TWEET_TIME_INDEX_HEADER.size)
+            if len(header) < TWEET_TIME_INDEX_HEADER.size:
+                raise ValueError(u'Not a time index: {0}'.format(index_path))
+            magic, count, self.size = TWEET_TIME_INDEX_HEADER.unpack(header)
+            if magic != TWEET_TIME_INDEX_MAGIC:
+                raise ValueError(u'Not a time index: {0}'.format(index_path))
+            if self.size != os.path.getsize(path):
+                raise ValueError(u'{0} has changed since it was indexed'.format(path))
+            data = f.read(count * TWEET_TIME_INDEX_RECORD.size)
+        record = TWEET_TIME_INDEX_RECORD
+        blocks = [record.unpack_from(data, i * record.size) for i in xrange(count)]
+        self.offsets = [block[0] for block in blocks]
+        self.earliest = [block[1] for block in blocks]
+        self.latest = [block[2] for block in blocks]
+        # Latest time in any block so far and earliest in any block
+        # from here on: both only grow, so the blocks that can
+        # overlap a window are found by bisection
+        self._latest_so_far = []
+        latest = None
+        for t in self.latest:
+            latest = t if latest is None else max(latest, t)
+            self._latest_so_far.append(latest)
+        self._earliest_after = [0] * count
+        earliest = None
+        for i in xrange(count - 1, -1, -1):
+            t = self.earliest[i]
+            earliest = t if earliest is None else min(earliest, t)
+            self._earliest_after[i] = earliest
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def ranges(self, start, end):
+        """Return [(offset, end offset)] of the bytes that may hold
+            tweets posted in [start, end) (datetimes or epochs)
+        """
+        start, end = to_epoch(start), to_epoch(end)
+        first = bisect.bisect_left(self._latest_so_far, start)
+        last = bisect.bisect_left(self._earliest_after, end)
+        spans = []
+        for i in xrange(first, last):
+            if self.earliest[i] < end and self.latest[i] >= start:
+                offset = self.offsets[i]
+                if i + 1 < len(self.offsets):
+                    stop = self.offsets[i + 1]
+                else:
+                    stop = self.size
+                if spans and spans[-1][1] == offset:
+                    spans[-1] = (spans[-1][0], stop)
+                else:
+                    spans.append((offset, stop))
+        return spans
+
+    def between(self, start, end, fields=None):
+        """Yield the tweets posted in [start, end) in file order
+            fields : dotted paths to read, as in itertweets
+        """
+        start, end = to_epoch(start), to_epoch(end)
+        # With fields, one view gives both the time and the fields
+        projection = TWEET_TIME_PROJECTION
+        if fields is not None:
+            projection = tweet_projection(fields, also=TWEET_TIME_FIELDS)
+        with open(self.path, 'rb') as f:
+            for offset, stop in self.ranges(start, end):
+                f.seek(offset)
+                while offset < stop:
+                    raw = f.readline()
+                    if not raw:
+                        break
+                    offset += len(raw)
+                    # Only the time is read from tweets outside the window
+                    view = parse_tweet_line(raw, projection)
+                    if view is None:
+                        continue
+                    posted = tweet_epoch(view)
+                    if posted is not None and start <= posted < end:
+                        if fields is not None:
+                            yield view
+                        else:
+                            tweet = parse_tweet_line(raw)
+                            if tweet is not None:
+                                yield tweet
+
+def itertweets_between(path, start, end, index_path=None, fields=None):
+    """Yield the tweets in path posted in [start, end)
+        Builds the time index first if it is missing or stale
+        fields : dotted paths to read, as in itertweets
+    """
+    try:
+        index = TweetTimeIndex(path, index_path)
+    except (IOError, ValueError):
+        build_tweet_time_index(path, index_path)
+        index = TweetTimeIndex(path, index_path)
+    return index.between(start, end, fields)
+
+def with_mongo_ids(tweets):
+    """Yield tweets with _id set to the id string, as the Mongo
+        loaders do, so raw tweets can stand in for a cursor
+        Like activitystreams2mongo, also derive postedTimeObj and
+        actor.id_str from the Gnip postedTime and actor.id
+    """
+    for tweet in tweets:
+        if '_id' not in tweet:
+            tweet_id = tweet.get('id_str') or tweet.get('id')
+            if isinstance(tweet_id, basestring):
+                tweet_id = extract_tweet_id(tweet_id) or tweet_id
+            elif tweet_id is not None:
+                tweet_id = str(tweet_id)
+            tweet['_id'] = tweet_id
+        if 'postedTime' in tweet and 'postedTimeObj' not in tweet:
+            tweet['postedTimeObj'] = from_postedTime(tweet['postedTime'])
+        actor = tweet.get('actor')
+        if isinstance(actor, dict):
+            if 'postedTime' in actor and 'postedTimeObj' not in actor:
+                actor['postedTimeObj'] = from_postedTime(actor['postedTime'])
+            if 'id' in actor and 'id_str' not in actor:
+                actor['id_str'] = extract_user_id(actor['id'])
+        yield tweet